@@ -1,16 +1,33 @@
+import asyncio
 import json
 import logging
-import sys
-from typing import List, Callable, Dict, Tuple, Union
-
-from fastapi import FastAPI, HTTPException
+import weakref
+from contextlib import contextmanager
+from typing import AsyncIterator, List, Callable, Dict, Tuple, Union
+
+import httpx
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
 from redis import Redis
-from redis.exceptions import ConnectionError
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import ConnectionError, RedisError
 
 from planchet.core import Job, COMPLETE, READ_ONLY, WRITE_ONLY, READ_WRITE
+from planchet.ledger import (
+    AsyncLedger, ItemLedger, Ledger, RedisLedger, item_ledger
+)
 from planchet.config import (
-    REDIS_HOST, REDIS_PORT, REDIS_PWD, MAX_PACKAGE_SIZE, MASTER_TOKEN
+    REDIS_HOST, REDIS_PORT, REDIS_PWD, SQLITE_PATH, MEMORY_LEDGER_PATH,
+    SNAPSHOT_INTERVAL, MAX_PACKAGE_SIZE, MASTER_TOKEN, INSTANCE_URL,
+    OWNER_TTL, COMPRESSION, COMPRESSION_MIN_SIZE
 )
+from planchet.middleware import BodySizeLimit, Compression
+from planchet.metrics import render as render_metrics
+from planchet.ownership import Ownership
+from planchet.memory_ledger import MemoryLedger
+from planchet.sqlite_ledger import SqliteLedger
 import planchet.io as io
 import planchet.util as util
 
@@ -18,6 +35,15 @@ _fmt = '%(message)s'
 logging.basicConfig(level=logging.DEBUG, format=_fmt)
 
 app = FastAPI()
+# The size of request bodies is checked before they are parsed, both as sent
+# and decompressed; streamed items are written a chunk at a time and are not
+# limited. The last middleware added is the outermost.
+app.add_middleware(BodySizeLimit, max_size=MAX_PACKAGE_SIZE,
+                   exclude=['/receive-stream'])
+app.add_middleware(Compression, min_size=COMPRESSION_MIN_SIZE,
+                   preferred=COMPRESSION)
+app.add_middleware(BodySizeLimit, max_size=MAX_PACKAGE_SIZE,
+                   exclude=['/receive-stream'])
 
 logging.info(util.blue('PLANCHET IS STARTING!'))
 
@@ -25,24 +51,143 @@ OUTPUT_REGISTRY = set()
 
 logging.info(util.yellow(f'MASTER TOKEN: {MASTER_TOKEN}'))
 
+# with an instance URL, several instances can share a ledger: each job is
+# owned by one of them and requests for it are forwarded to its owner
+OWNERSHIP: Union[Ownership, None] = \
+    Ownership(INSTANCE_URL, OWNER_TTL) if INSTANCE_URL else None
+if OWNERSHIP is not None and (SQLITE_PATH or MEMORY_LEDGER_PATH):
+    # an embedded ledger cannot be shared between instances
+    logging.critical(util.redfill('Several instances need a Redis ledger; '
+                                  'ignoring PLANCHET_INSTANCE_URL'))
+    OWNERSHIP = None
+FORWARDED_HEADER = 'X-Planchet-Forwarded'
+
+NDJSON = 'application/x-ndjson'
+PROMETHEUS = 'text/plain; version=0.0.4; charset=utf-8'
+# number of items served or received at a time by the streaming endpoints
+STREAM_CHUNK = 1000
+# number of seconds between checks for buffered output that is due to be
+# flushed
+FLUSH_CHECK_INTERVAL = 1
+
+
+def _make_ledger() -> Ledger:
+    if MEMORY_LEDGER_PATH:
+        path = None if MEMORY_LEDGER_PATH == ':memory:' else MEMORY_LEDGER_PATH
+        return MemoryLedger(path, SNAPSHOT_INTERVAL)
+    if SQLITE_PATH:
+        return SqliteLedger(SQLITE_PATH)
+    return RedisLedger(Redis(host=REDIS_HOST, port=REDIS_PORT,
+                             password=REDIS_PWD))
+
+
+def _make_async_ledger() -> Union[AsyncRedis, AsyncLedger]:
+    if isinstance(LEDGER, (SqliteLedger, MemoryLedger)):
+        return AsyncLedger(LEDGER)
+    return AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PWD)
+
+
+def _make_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(timeout=None)
+
+
+class _LoopState:
+    """
+    Async ledger client, HTTP client and job locks of an event loop; the
+    connections of the clients can only be used in the loop that opened them.
+    """
+    def __init__(self):
+        self.ledger: Union[AsyncRedis, AsyncLedger] = _make_async_ledger()
+        self.locks: Dict[str, asyncio.Lock] = {}
+        self.slots: Dict[Tuple[str, str, int], asyncio.Semaphore] = {}
+        self._http: Union[httpx.AsyncClient, None] = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = _make_http_client()
+        return self._http
+
+
+_LOOP_STATES: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _loop_state() -> _LoopState:
+    loop = asyncio.get_running_loop()
+    state = _LOOP_STATES.get(loop)
+    if state is None:
+        state = _LOOP_STATES[loop] = _LoopState()
+    return state
 
-def _add_token(job_name: str, ledger: Redis, token: str):
+
+def _async_ledger() -> Union[AsyncRedis, AsyncLedger]:
+    return _loop_state().ledger
+
+
+# number of requests waiting for each job
+WAITING: Dict[str, int] = {}
+
+
+@contextmanager
+def _waiting(job_name: str):
+    WAITING[job_name] = WAITING.get(job_name, 0) + 1
+    try:
+        yield
+    finally:
+        WAITING[job_name] -= 1
+        if not WAITING[job_name]:
+            del WAITING[job_name]
+
+
+async def _run(job_name: str, func: Callable, *args, **kwargs):
+    # Blocking work on a job (file I/O and its item ledger) runs in the
+    # threadpool, one call per job at a time. Requests waiting for a busy job
+    # wait on the event loop instead of holding a thread.
+    locks = _loop_state().locks
+    lock = locks.setdefault(job_name, asyncio.Lock())
+    with _waiting(job_name):
+        await lock.acquire()
+    try:
+        return await run_in_threadpool(func, *args, **kwargs)
+    finally:
+        lock.release()
+
+
+async def _run_parallel(job_name: str, parallelism: Union[int, None],
+                        func: Callable, *args):
+    # Jobs read from partitions or written to shards serve or receive as many
+    # batches at a time as they have partitions or shards and do not wait for
+    # other work on the job; other jobs run under the job lock.
+    if parallelism is None:
+        return await _run(job_name, func, *args)
+    slots = _loop_state().slots
+    slot = slots.setdefault((job_name, func.__name__, parallelism),
+                            asyncio.Semaphore(parallelism))
+    with _waiting(job_name):
+        await slot.acquire()
+    try:
+        return await run_in_threadpool(func, *args)
+    finally:
+        slot.release()
+
+
+async def _add_token(job_name: str, ledger: AsyncRedis, token: str):
     if token is not None:
-        ledger.set(f'TOKEN:{job_name}', token)
+        await ledger.set(f'TOKEN:{job_name}', token)
 
 
-def _get_token(job_name: str, ledger: Redis) -> str:
-    token = ledger.get(f'TOKEN:{job_name}')
+async def _get_token(job_name: str, ledger: AsyncRedis) -> str:
+    token = await ledger.get(f'TOKEN:{job_name}')
     return token.decode('utf8') if token else token
 
 
-def _remove_token(job_name: str, ledger: Redis):
-    ledger.delete(f'TOKEN:{job_name}')
+async def _remove_token(job_name: str, ledger: AsyncRedis):
+    await ledger.delete(f'TOKEN:{job_name}')
 
 
-def _authenticate(job_name: str, ledger: Redis, token: str):
+async def _authenticate(job_name: str, ledger: AsyncRedis, token: str):
     # get the real token for this job
-    real_token: str = _get_token(job_name, ledger)
+    real_token: str = await _get_token(job_name, ledger)
     # is it the master token
     is_master: bool = MASTER_TOKEN is not None and token == MASTER_TOKEN
     # raise error if authentication is not successful
@@ -59,8 +204,8 @@ def _authenticate_master(token):
 
 def _make_io(reader_name, writer_name, metadata):
     try:
-        reader: Callable = getattr(io, reader_name)(metadata) \
-            if reader_name else None
+        reader: Callable = io.prefetched(getattr(io, reader_name)(metadata),
+                                         metadata) if reader_name else None
         writer: Callable = getattr(io, writer_name)(metadata) \
             if writer_name else None
     except FileNotFoundError as e:
@@ -72,28 +217,102 @@ def _make_io(reader_name, writer_name, metadata):
     return reader, writer
 
 
+def _restore_job(job_name: str, ledger) -> Union[Job, None]:
+    job_key = f'JOB:{job_name}'
+    try:
+        job = Job.restore_job(job_name, job_key, ledger)
+        if job is not None:
+            OUTPUT_REGISTRY.add(job.writer.file_path)
+        return job
+    except json.JSONDecodeError:
+        logging.error(f'Could not restore job: {job_key}')
+    except FileNotFoundError as e:
+        logging.error(f'Could not restore job: {job_key}; {e}')
+    return None
+
+
 def _load_jobs(ledger) -> Dict:
     jobs: Dict = {}
+    if OWNERSHIP is not None:
+        # jobs are restored by the instance that takes them over
+        return jobs
     for job_key in ledger.scan_iter('JOB:*'):
         job_name: str = job_key.decode('utf8').split(':', 1)[1]
-        try:
-            jobs[job_name] = Job.restore_job(job_name, job_key, ledger)
-            OUTPUT_REGISTRY.add(jobs[job_name].writer.file_path)
-        except json.JSONDecodeError:
-            logging.error(f'Could not restore job: {job_key}')
-        except FileNotFoundError as e:
-            logging.error(f'Could not restore job: {job_key}; {e}')
+        job = _restore_job(job_name, ledger)
+        if job is not None:
+            jobs[job_name] = job
     return jobs
 
 
+async def _route(request: Request, job_name: str) -> Union[Response, None]:
+    """
+    Make sure this instance owns `job_name` before handling a request for it.
+    A job without a live owner is taken over and restored from the ledger; a
+    request for a job owned by another instance is forwarded to it.
+
+    :return: the response of the owner or None if this instance owns the job
+    """
+    if OWNERSHIP is None:
+        return None
+    owner, taken = await OWNERSHIP.acquire(_async_ledger(), job_name)
+    if OWNERSHIP.owns(owner):
+        if taken:
+            # anything held from an earlier ownership may be stale
+            stale = JOB_LOG.pop(job_name, None)
+            if stale is not None:
+                await _run(job_name, stale.close)
+            job = await _run(job_name, _restore_job, job_name, LEDGER)
+            if job is not None:
+                logging.info(util.pink(f'Took over job "{job_name}"'))
+                JOB_LOG[job_name] = job
+        return None
+    if request.headers.get(FORWARDED_HEADER):
+        msg = f'Job {job_name} is owned by {owner["url"]}'
+        raise HTTPException(503, msg)
+    url = f'{owner["url"].rstrip("/")}{request.url.path}'
+    http = _loop_state().http
+    # both bodies are streamed through, so streaming endpoints keep streaming
+    forward = http.build_request(
+        request.method, url, params=request.query_params,
+        content=request.stream(),
+        headers={'Content-Type': request.headers.get(
+            'Content-Type', 'application/json'), FORWARDED_HEADER: '1'})
+    try:
+        response = await http.send(forward, stream=True)
+    except httpx.TransportError as e:
+        msg = f'Owner of job {job_name} at {owner["url"]} is unreachable: {e}'
+        logging.error(util.red(msg))
+        raise HTTPException(503, msg)
+    return StreamingResponse(response.aiter_bytes(),
+                             status_code=response.status_code,
+                             media_type=response.headers.get('Content-Type'),
+                             background=BackgroundTask(response.aclose))
+
+
+async def _renew_ownership():
+    # keeps the jobs of this instance and drops the ones taken over
+    while True:
+        await asyncio.sleep(OWNERSHIP.ttl / 3)
+        try:
+            lost = await OWNERSHIP.renew(_async_ledger(), list(JOB_LOG))
+        except RedisError as e:
+            logging.error(util.red(f'Could not renew job ownership: {e}'))
+            continue
+        for job_name in lost:
+            logging.info(util.pink(f'Lost job "{job_name}"'))
+            job = JOB_LOG.pop(job_name, None)
+            if job is not None:
+                await _run(job_name, job.close)
+
+
 try:
-    LEDGER: Redis = Redis(host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PWD)
+    LEDGER: Ledger = _make_ledger()
     JOB_LOG: Dict = _load_jobs(LEDGER)
 except ConnectionError:
     # There is no Redis connection; this fixes test imports
     # noinspection PyTypeChecker
     LEDGER = None  # type: ignore
-    JON_LOG = {}
+    JOB_LOG = {}
     logging.critical(
         util.redfill(f'Could not connect to redis at {REDIS_HOST}:{REDIS_PORT}'
                      f' using a password that was'
@@ -101,11 +320,13 @@ except ConnectionError:
 
 
 @app.post("/scramble")
-def scramble(job_name: str, metadata: Dict, reader_name: str,
-             writer_name: str, token: Union[str, None] = None,
-             clean_start: bool = False,
-             mode: str = READ_WRITE, cont: bool = False,
-             force_overwrite: bool = False):
+async def scramble(request: Request, job_name: str, metadata: Dict,
+                   reader_name: str, writer_name: str,
+                   token: Union[str, None] = None,
+                   clean_start: bool = False,
+                   mode: str = READ_WRITE, cont: bool = False,
+                   force_overwrite: bool = False,
+                   lease_ttl: Union[float, None] = None):
     """
     Start a new job.
 
@@ -118,12 +339,19 @@ def scramble(job_name: str, metadata: Dict, reader_name: str,
     :param mode: I/O mode
     :param cont: start a repair job
     :param force_overwrite: force overwrite of the
+    :param lease_ttl: number of seconds served items are leased to a worker
+       before they are served again; no leases if empty
     """
     logging.info(util.pink(
         f'SCRAMBLING: name->{job_name}; metadata->{metadata}; '
         f'reader_name->{reader_name}; writer_name->{writer_name}; '
         f'clean_start->{clean_start}'))
-    reader, writer = _make_io(reader_name, writer_name, metadata)
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    ledger = _async_ledger()
+    reader, writer = await run_in_threadpool(_make_io, reader_name,
+                                             writer_name, metadata)
 
     # checking output file validity
     if not force_overwrite and writer and writer.file_path in OUTPUT_REGISTRY:
@@ -131,7 +359,7 @@ def scramble(job_name: str, metadata: Dict, reader_name: str,
         raise HTTPException(status_code=400, detail=msg)
 
     # get job with that name from the ledger
-    existing_job = LEDGER.get(f'JOB:{job_name}')
+    existing_job = await ledger.get(f'JOB:{job_name}')
 
     # trying to re-create an existing job
     if existing_job and (not clean_start and not cont):
@@ -142,28 +370,33 @@ def scramble(job_name: str, metadata: Dict, reader_name: str,
     if existing_job and cont:
         job = JOB_LOG[job_name]
         # don't delete the output file only the records
-        job.clean(output=False)
+        await _run(job_name, job.clean, output=False)
+        await _run(job_name, job.close)
         del job
         del JOB_LOG[job_name]
-    new_job: Job = Job(job_name, reader, writer, LEDGER, mode, cont)
+    elif not existing_job:
+        # a new job has no records in older layouts to migrate
+        await _run(job_name, item_ledger(LEDGER, job_name).create)
+    new_job: Job = await _run(job_name, Job, job_name, reader, writer,
+                              LEDGER, mode, cont, lease_ttl)
 
     # clean ledger before starting
     if clean_start:
-        new_job.restart()
+        await _run(job_name, new_job.restart)
 
     # log the new job
     JOB_LOG[job_name] = new_job
     if writer:
         OUTPUT_REGISTRY.add(writer.file_path)
-    LEDGER.set(f'JOB:{job_name}', json.dumps({
+    await ledger.set(f'JOB:{job_name}', json.dumps({
         'metadata': metadata, 'reader_name': reader_name,
-        'writer_name': writer_name, 'mode': mode}))
-    _add_token(job_name, LEDGER, token)
+        'writer_name': writer_name, 'mode': mode, 'lease_ttl': lease_ttl}))
+    await _add_token(job_name, ledger, token)
 
 
 @app.post("/serve")
-def serve(job_name: str, batch_size: int = 100,
-          token: Union[str, None] = None) -> List:
+async def serve(request: Request, job_name: str, batch_size: int = 100,
+                token: Union[str, None] = None) -> List:
     """
     Serve a batch of items to the user.
 
@@ -172,24 +405,72 @@ def serve(job_name: str, batch_size: int = 100,
     :param token: authentication token; leave empty for no authentication
     :return: list of items of size `batch_size`
     """
-    _authenticate(job_name, LEDGER, token)
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    job = await _serving_job(job_name, token)
+    items = await _serve_items(job_name, job, batch_size)
+    # encoded directly instead of through the default response encoder
+    return Response(content=util.codec.dumpb(items),
+                    media_type='application/json')
+
+
+@app.post("/serve-stream")
+async def serve_stream(request: Request, job_name: str, batch_size: int = 100,
+                       token: Union[str, None] = None):
+    """
+    Serve a batch of items to the user as NDJSON, one ``[id, item]`` pair
+    per line. The batch is read and sent `STREAM_CHUNK` items at a time.
+
+    :param job_name: job name
+    :param batch_size: number of items to be served in the batch
+    :param token: authentication token; leave empty for no authentication
+    :return: stream of up to `batch_size` items
+    """
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    job = await _serving_job(job_name, token)
+
+    async def lines():
+        left = batch_size
+        while left > 0:
+            items = await _serve_items(job_name, job,
+                                       min(left, STREAM_CHUNK))
+            if not items:
+                break
+            left -= len(items)
+            yield b''.join(util.codec.dumpb(item) + b'\n' for item in items)
+
+    return StreamingResponse(lines(), media_type=NDJSON)
+
+
+async def _serving_job(job_name: str, token: Union[str, None]) -> Job:
+    ledger = _async_ledger()
+    await _authenticate(job_name, ledger, token)
     try:
         job = JOB_LOG[job_name]
     except KeyError:
-        active = LEDGER.get(job_name)
+        active = await ledger.get(job_name)
         no_active_msg = f'No active job: {job_name}'
         no_known_msg = f'No known job: {job_name}'
         msg = no_active_msg if active else no_known_msg
         raise HTTPException(status_code=400, detail=msg)
     if job.mode == WRITE_ONLY:
         raise HTTPException(400, 'Trying to read from a write-only job')
-    items = job.serve(batch_size)
-    return items
+    return job
+
+
+async def _serve_items(job_name: str, job: Job, batch_size: int) -> List:
+    return await _run_parallel(
+        job_name, getattr(job.reader, 'parallelism', None), job.serve,
+        batch_size)
 
 
 @app.post("/receive")
-def receive(job_name: str, items: List[Tuple[int, Union[Dict, List]]],
-            overwrite: bool, token: Union[str, None] = None):
+async def receive(request: Request, job_name: str,
+                  items: List[Tuple[int, Union[Dict, List]]],
+                  overwrite: bool, token: Union[str, None] = None):
     """
     Receive a batch of processed items from the user.
 
@@ -198,25 +479,119 @@ def receive(job_name: str, items: List[Tuple[int, Union[Dict, List]]],
     :param overwrite: overwrite the output file
     :param token: authentication token; default no authentication
     """
-    _authenticate(job_name, LEDGER, token)
-    size = sys.getsizeof(items)
-    if size > MAX_PACKAGE_SIZE:
-        msg = f'In-memory payload must be less than {MAX_PACKAGE_SIZE}; ' \
-              f'the current size is {size}.'
-        logging.error(util.red(msg))
-        raise HTTPException(status_code=413, detail=msg)
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    ledger = _async_ledger()
+    await _authenticate(job_name, ledger, token)
+    job = _receiving_job(job_name)
+    await _receive_items(job_name, job, items, overwrite)
+    if job.status == COMPLETE:
+        await ledger.set(f'JOB:{job_name}', COMPLETE)
+
+
+@app.post("/receive-stream")
+async def receive_stream(request: Request, job_name: str,
+                         overwrite: bool = False,
+                         token: Union[str, None] = None) -> Dict:
+    """
+    Receive processed items from the user as NDJSON, one ``[id, item]``
+    pair per line. Items are parsed as they arrive and written
+    `STREAM_CHUNK` items or `MAX_PACKAGE_SIZE` bytes at a time, so the batch
+    is never held in memory as a whole. Items before an invalid line are
+    kept; a line longer than `MAX_PACKAGE_SIZE` bytes is rejected with a 413
+    response.
+
+    :param job_name: job name
+    :param overwrite: overwrite the output file
+    :param token: authentication token; default no authentication
+    :return: number of items received
+    """
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    ledger = _async_ledger()
+    await _authenticate(job_name, ledger, token)
+    job = _receiving_job(job_name)
+    items: List = []
+    n_items = n_lines = size = 0
+    async for line in _stream_lines(request.stream()):
+        n_lines += 1
+        if line.strip():
+            items.append(_parse_item(line, n_lines))
+            size += len(line)
+        if len(items) >= STREAM_CHUNK or size >= MAX_PACKAGE_SIZE:
+            await _receive_items(job_name, job, items, overwrite)
+            n_items += len(items)
+            items = []
+            size = 0
+    if items:
+        await _receive_items(job_name, job, items, overwrite)
+        n_items += len(items)
+    if job.status == COMPLETE:
+        await ledger.set(f'JOB:{job_name}', COMPLETE)
+    return {'received': n_items}
+
+
+async def _stream_lines(stream: AsyncIterator[bytes]
+                        ) -> AsyncIterator[bytes]:
+    # Splits a streamed body into lines, looking for line breaks only in the
+    # data just received. The start of a line is kept as a list of fragments
+    # and a line longer than the payload size limit is rejected before it is
+    # read in full.
+    fragments: List[bytes] = []
+    size = 0
+    async for chunk in stream:
+        parts = chunk.split(b'\n')
+        for i, part in enumerate(parts):
+            size += len(part)
+            if size > MAX_PACKAGE_SIZE:
+                msg = f'Lines must be less than {MAX_PACKAGE_SIZE} bytes; ' \
+                      f'received {size} bytes or more.'
+                logging.error(util.red(msg))
+                raise HTTPException(413, msg)
+            fragments.append(part)
+            if i < len(parts) - 1:
+                yield b''.join(fragments)
+                fragments = []
+                size = 0
+    tail = b''.join(fragments)
+    if tail:
+        yield tail
+
+
+def _receiving_job(job_name: str) -> Job:
     job = JOB_LOG[job_name]
     if job.mode == READ_ONLY:
         raise HTTPException(400, 'Trying to send to a read-only job')
     if not job.writer:
         raise HTTPException(400, 'No valid writer initialised')
-    job.receive(items, overwrite)
-    if job.status == COMPLETE:
-        LEDGER.set(f'JOB:{job_name}', COMPLETE)
+    return job
+
+
+async def _receive_items(job_name: str, job: Job,
+                         items: List[Tuple[int, Union[Dict, List]]],
+                         overwrite: bool):
+    await _run_parallel(job_name, getattr(job.writer, 'parallelism', None),
+                        job.receive, items, overwrite)
+
+
+def _parse_item(line: bytes, n_line: int) -> Tuple[int, Union[Dict, List]]:
+    try:
+        item = util.codec.loads(line)
+    except ValueError:
+        item = None
+    if not isinstance(item, list) or len(item) != 2 or \
+            type(item[0]) is not int or not isinstance(item[1], (dict, list)):
+        msg = f'Line {n_line} is not an [id, item] pair'
+        logging.error(util.red(msg))
+        raise HTTPException(400, msg)
+    return item[0], item[1]
 
 
 @app.post("/mark-errors")
-def mark_errors(job_name: str, ids: List[int], token: Union[str, None] = None):
+async def mark_errors(request: Request, job_name: str, ids: List[int],
+                      token: Union[str, None] = None):
     """
     Mark a list of items as errors based on the IDs in `ids`.
 
@@ -224,34 +599,64 @@ def mark_errors(job_name: str, ids: List[int], token: Union[str, None] = None):
     :param ids: list of IDs
     :param token: authentication token; default no authentication
     """
-    _authenticate(job_name, LEDGER, token)
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    await _authenticate(job_name, _async_ledger(), token)
     job = JOB_LOG[job_name]
     try:
-        job.mark_errors(ids)
+        await _run(job_name, job.mark_errors, ids)
     except ValueError as e:
         raise HTTPException(400, str(e))
 
 
+@app.post("/heartbeat")
+async def heartbeat(request: Request, job_name: str, ids: List[int],
+                    token: Union[str, None] = None) -> Dict:
+    """
+    Extend the leases of served items that are still being processed.
+
+    :param job_name: job name
+    :param ids: list of IDs
+    :param token: authentication token; default no authentication
+    :return: number of leases extended
+    """
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    await _authenticate(job_name, _async_ledger(), token)
+    job = JOB_LOG[job_name]
+    extended = await _run(job_name, job.heartbeat, ids)
+    return {'extended': extended}
+
+
 @app.get('/delete')
-def delete(job_name: str, token: Union[str, None] = None):
+async def delete(request: Request, job_name: str,
+                 token: Union[str, None] = None):
     """
     Delete a job.
 
     :param job_name: job name
     :param token: authentication token; default no authentication
     """
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
     try:
-        del JOB_LOG[job_name]
+        job = JOB_LOG.pop(job_name)
+        await _run(job_name, job.close)
     except KeyError:
         logging.info(util.pink(f'Could not find a job named "{job_name}"'))
         pass
-    LEDGER.delete(f'JOB:{job_name}')
-    for record in list(LEDGER.scan_iter(f'{job_name}:*')):
-        LEDGER.delete(record)
+    await _async_ledger().delete(f'JOB:{job_name}')
+    await _run(job_name, item_ledger(LEDGER, job_name).delete)
+    if OWNERSHIP is not None:
+        await OWNERSHIP.release(_async_ledger(), job_name)
 
 
 @app.get('/clean')
-def clean(job_name: str, output: bool = True, token: Union[str, None] = None):
+async def clean(request: Request, job_name: str, output: bool = True,
+                token: Union[str, None] = None):
     """
     Remove all served but not received items from a job.
 
@@ -259,7 +664,11 @@ def clean(job_name: str, output: bool = True, token: Union[str, None] = None):
     :param output: clean output file(s) associated with the job
     :param token: authentication token; default no authentication
     """
-    _authenticate(job_name, LEDGER, token)
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
+    ledger = _async_ledger()
+    await _authenticate(job_name, ledger, token)
     try:
         job = JOB_LOG[job_name]
     except KeyError:
@@ -267,9 +676,9 @@ def clean(job_name: str, output: bool = True, token: Union[str, None] = None):
         logging.info(util.pink(msg))
         raise HTTPException(400, msg)
     try:
-        job.clean(output=output)
+        await _run(job_name, job.clean, output=output)
         OUTPUT_REGISTRY.discard(job.writer.file_path)
-        _remove_token(job_name, LEDGER)
+        await _remove_token(job_name, ledger)
     except FileNotFoundError:
         msg = f'Could not find a output file for job "{job_name}"'
         logging.info(util.pink(msg))
@@ -281,9 +690,11 @@ def clean(job_name: str, output: bool = True, token: Union[str, None] = None):
 
 
 @app.get('/purge')
-def purge(output: bool = False, token: Union[str, None] = None):
+async def purge(output: bool = False, token: Union[str, None] = None):
     """
-    Purge all jobs, items and optionally output files.
+    Purge all jobs, items and optionally output files. With several
+    instances, only the jobs of this instance and the jobs without an owner
+    are purged.
 
     :param output: purge output files if True
     :param token: authentication token; default no authentication
@@ -292,41 +703,117 @@ def purge(output: bool = False, token: Union[str, None] = None):
 
     # remove all the logged jobs
     for name, job in list(JOB_LOG.items()):
-        job.clean(output)
+        await _run(name, job.clean, output)
+        await _run(name, job.close)
         del JOB_LOG[name]
         OUTPUT_REGISTRY.discard(job.writer.file_path)
 
+    if OWNERSHIP is not None:
+        await _purge_unowned(_async_ledger())
+        return
     # nuke everything else
-    for k in LEDGER.scan_iter('*'):
-        LEDGER.delete(k)
+    await _async_ledger().flushdb()
+
+
+async def _purge_unowned(ledger: AsyncRedis):
+    # Deletes the records of the jobs this instance owns or that have no live
+    # owner; the jobs of other instances and their ownership are kept.
+    job_names = [key.decode('utf8').split(':', 1)[1]
+                 async for key in ledger.scan_iter('JOB:*')]
+    for job_name in job_names:
+        owner = await ledger.get(Ownership.key(job_name))
+        if owner and not OWNERSHIP.owns(json.loads(owner)):
+            continue
+        await ledger.delete(f'JOB:{job_name}', f'TOKEN:{job_name}',
+                            *ItemLedger.keys_of(job_name))
+        await OWNERSHIP.release(ledger, job_name)
+
+
+async def _flush_due():
+    # writers only flush when they write, so output left in their buffers
+    # once a job stops receiving is flushed here
+    while True:
+        await asyncio.sleep(FLUSH_CHECK_INTERVAL)
+        for job_name, job in list(JOB_LOG.items()):
+            if not getattr(job.writer, 'unflushed', 0):
+                continue
+            try:
+                await _run(job_name, job.flush_due)
+            except Exception as e:
+                logging.error(util.red(f'Could not flush job "{job_name}": '
+                                       f'{e}'))
+
+
+@app.on_event('startup')
+async def startup():
+    """
+    Keep flushing the output that writers keep past their flush interval and
+    renewing the ownership of the jobs of this instance.
+    """
+    asyncio.ensure_future(_flush_due())
+    if OWNERSHIP is not None:
+        asyncio.ensure_future(_renew_ownership())
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    """
+    Flush and close the output of all jobs, give them up to other instances
+    and close the ledger, which takes a last snapshot of a memory ledger.
+    """
+    for job_name, job in list(JOB_LOG.items()):
+        await _run(job_name, job.close)
+        if OWNERSHIP is not None:
+            await OWNERSHIP.release(_async_ledger(), job_name)
+    if isinstance(LEDGER, Ledger):
+        await run_in_threadpool(LEDGER.close)
 
 
 @app.get("/report")
-def report(job_name: str) -> Dict:
+async def report(request: Request, job_name: str) -> Dict:
     """
     Serve a report for a job
 
     :param job_name: job name
     :return: report
     """
+    forwarded = await _route(request, job_name)
+    if forwarded is not None:
+        return forwarded
     try:
-        return JOB_LOG[job_name].stats
+        job = JOB_LOG[job_name]
+        await _run(job_name, job.flush_due)
+        return job.stats
     except KeyError:
         logging.info(util.pink(f'Could not find a job named "{job_name}"'))
         return {}
 
 
+@app.get("/metrics")
+async def metrics() -> Response:
+    """
+    Serve the metrics of the jobs of this instance in the Prometheus text
+    format: serve and receive latency split into reader, ledger and writer
+    time, items served and received, ledger round trips, queue depths and
+    output written.
+
+    :return: metrics text
+    """
+    return Response(content=render_metrics(JOB_LOG, WAITING),
+                    media_type=PROMETHEUS)
+
+
 @app.get("/health")
-def health_check() -> Dict:
+async def health_check() -> Dict:
     """
     Service health check. Healthy if a live ledger can be reached.
 
     :return: service status
     """
     try:
-        LEDGER.ping()
+        await _async_ledger().ping()
         status = 'Online'
-    except AttributeError:
+    except (AttributeError, ConnectionError):
         logging.critical(util.redfill('REDIS IS OFFLINE'))
         status = 'Offline'
 
@@ -0,0 +1,86 @@
+"""
+Latency of the `/serve`, `/receive` and `/report` endpoints at several batch
+sizes, requested one at a time through the FastAPI test client. The service
+runs in-process, so the numbers include request parsing, JSON and the job
+but no network.
+
+    python -m benchmarks.bench_api --n-items 20000 --batch-sizes 10 100 1000
+"""
+import logging
+import os
+
+from fastapi.testclient import TestClient
+
+import app as service
+from planchet import util
+
+from .bench_load import percentile, setup_service
+from .common import make_jsonl, parser, report, timer
+
+JOB = 'bench-api'
+
+
+def run(client, input_fp, output_fp, batch_size):
+    params = {'job_name': JOB}
+    client.post('/scramble', params={
+        **params, 'reader_name': 'JsonlReader', 'writer_name': 'JsonlWriter',
+        'clean_start': True, 'force_overwrite': True},
+        json={'input_file_path': input_fp, 'output_file_path': output_fp,
+              'overwrite': True}).raise_for_status()
+    latencies = {'serve': [], 'receive': [], 'report': []}
+    n_items = 0
+    while True:
+        with timer() as t:
+            response = client.post('/serve', params={
+                **params, 'batch_size': batch_size})
+        latencies['serve'].append(t['seconds'])
+        items = util.codec.loads(response.content)
+        if not items:
+            break
+        with timer() as t:
+            client.post('/receive', params={**params, 'overwrite': False},
+                        content=util.codec.dumpb(items),
+                        headers={'Content-Type': 'application/json'})
+        latencies['receive'].append(t['seconds'])
+        with timer() as t:
+            client.get('/report', params=params)
+        latencies['report'].append(t['seconds'])
+        n_items += len(items)
+    client.get('/delete', params=params)
+    return [{
+        'endpoint': f'/{endpoint}',
+        'batch_size': batch_size,
+        'requests': len(values),
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'items_per_s': n_items / sum(values)
+        if endpoint != 'report' else 'n/a',
+    } for endpoint, values in latencies.items()]
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=20000)
+    p.add_argument('--batch-sizes', type=int, nargs='+',
+                   default=[10, 100, 1000])
+    args = p.parse_args()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    setup_service(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    output_fp = f'{input_fp}.out'
+    client = TestClient(service.app)
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            results.extend(run(client, input_fp, output_fp, batch_size))
+    finally:
+        for fp in (input_fp, output_fp):
+            if os.path.exists(fp):
+                os.remove(fp)
+        service.LEDGER.flushdb()
+    report('Endpoint latency', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Items per second of `Job.serve` and `Job.receive`, and the latency of marking
+and looking up a batch, with the item ledger in Redis, in an embedded SQLite
+file and in memory with a snapshot every 10 seconds. Redis is an in-process
+fakeredis unless `--redis-url` is given; use a live redis for a fair
+comparison, since fakeredis runs the Lua scripts of the ledger slowly and has
+no network hop.
+
+    python -m benchmarks.bench_backend --redis-url redis://localhost:6379/15
+"""
+import os
+import random
+import tempfile
+
+from planchet.ledger import SERVED, item_ledger
+from planchet.memory_ledger import MemoryLedger
+from planchet.sqlite_ledger import SqliteLedger
+
+from . import bench_job
+from .common import make_jsonl, make_ledger, parser, report, timer
+
+JOB = 'bench'
+
+
+def ledger_ops(ledger, n_items, batch_size):
+    ledger.flushdb()
+    items = item_ledger(ledger, JOB)
+    batches = [list(range(start, min(start + batch_size, n_items)))
+               for start in range(0, n_items, batch_size)]
+    with timer() as t_set:
+        for batch in batches:
+            items.set(batch, SERVED)
+    sample = random.sample(batches, min(len(batches), 100))
+    with timer() as t_get:
+        for batch in sample:
+            items.get(batch)
+    return {
+        'set_ms/batch': t_set['seconds'] * 1000 / len(batches),
+        'get_ms/batch': t_get['seconds'] * 1000 / len(sample),
+    }
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=100000)
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000])
+    p.add_argument('--tmp-dir', default=None)
+    args = p.parse_args()
+    tmp_dir = tempfile.mkdtemp(dir=args.tmp_dir)
+    ledgers = {
+        'redis' if args.redis_url else 'fakeredis':
+            make_ledger(args.redis_url),
+        'sqlite': SqliteLedger(os.path.join(tmp_dir, 'ledger.db')),
+        'memory': MemoryLedger(os.path.join(tmp_dir, 'ledger.npz')),
+    }
+    input_fp = make_jsonl(args.n_items)
+    output_fp = f'{input_fp}.out'
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            for name, ledger in ledgers.items():
+                ops = ledger_ops(ledger, args.n_items, batch_size)
+                for row in bench_job.run(ledger, input_fp, output_fp,
+                                         batch_size):
+                    results.append({
+                        'ledger': name,
+                        'call': row['call'],
+                        'batch_size': batch_size,
+                        'items_per_s': row['items_per_s'],
+                        **ops,
+                    })
+    finally:
+        for fp in (input_fp, output_fp):
+            if os.path.exists(fp):
+                os.remove(fp)
+        for ledger in ledgers.values():
+            ledger.flushdb()
+        ledgers['sqlite'].close()
+        ledgers['memory'].close()
+        for name in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, name))
+        os.rmdir(tmp_dir)
+    report('Ledger backends', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+End-to-end items per second of a JSONL job served and received through the
+service with each JSON codec. The service runs in-process against fakeredis
+unless `--redis-url` is given; the Lua scripts of the ledger are slow in
+fakeredis, so use a live redis for end-to-end numbers. The codec alone is
+measured too, reading, encoding and decoding every batch like the service and
+the client do.
+
+    python -m benchmarks.bench_codec --n-items 100000 --batch-size 1000
+"""
+import logging
+import os
+
+from fastapi.testclient import TestClient
+
+import app as service
+from planchet import util
+
+from .common import make_jsonl, make_ledger, parser, report, timer
+
+JOB = 'bench-codec'
+
+
+def run(client, input_fp, output_fp, batch_size):
+    client.post(f'/scramble?job_name={JOB}&reader_name=JsonlReader'
+                f'&writer_name=JsonlWriter&clean_start=true'
+                f'&force_overwrite=true',
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp, 'overwrite': True})
+    n_items = 0
+    headers = {'Content-Type': 'application/json'}
+    while True:
+        response = client.post(f'/serve?job_name={JOB}'
+                               f'&batch_size={batch_size}')
+        items = util.codec.loads(response.content)
+        if not items:
+            break
+        client.post(f'/receive?job_name={JOB}&overwrite=false',
+                    content=util.codec.dumpb(items), headers=headers)
+        n_items += len(items)
+    client.get(f'/delete?job_name={JOB}')
+    return n_items
+
+
+def codec_only(input_fp, batch_size):
+    with open(input_fp, 'rb') as fh:
+        lines = fh.readlines()
+    for start in range(0, len(lines), batch_size):
+        batch = [(i, util.codec.loads(line)) for i, line in
+                 enumerate(lines[start:start + batch_size], start)]
+        served = util.codec.loads(util.codec.dumpb(batch))
+        received = util.codec.loads(util.codec.dumpb(served))
+        util.codec.dumps([item for _, item in received])
+    return len(lines)
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=100000)
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--codecs', nargs='+', default=['json', 'orjson'])
+    args = p.parse_args()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    service.LEDGER = make_ledger(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    output_fp = f'{input_fp}.out'
+    client = TestClient(service.app)
+    results = []
+    try:
+        for name in args.codecs:
+            util.codec.use(name)
+            with timer() as t_codec:
+                codec_only(input_fp, args.batch_size)
+            with timer() as t:
+                n_items = run(client, input_fp, output_fp, args.batch_size)
+            results.append({
+                'codec': util.codec.name,
+                'items': n_items,
+                'seconds': t['seconds'],
+                'items_per_s': n_items / t['seconds'],
+                'codec_items_per_s': n_items / t_codec['seconds'],
+            })
+    finally:
+        os.remove(input_fp)
+        if os.path.exists(output_fp):
+            os.remove(output_fp)
+        service.LEDGER.flushdb()
+    report('End-to-end items/s by JSON codec', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
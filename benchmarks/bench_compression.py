@@ -0,0 +1,130 @@
+"""
+Bytes on the wire and end-to-end throughput of a JSONL job served and
+received without compression, with gzip and with zstd. The service runs
+in-process behind a transport that simulates a link of `--bandwidth-mbps`,
+shared by all workers: every request and response body takes its size over
+the bandwidth to cross it.
+
+    python -m benchmarks.bench_compression --bandwidth-mbps 10 100
+"""
+import asyncio
+import logging
+import os
+
+import httpx
+
+import app as service
+from planchet.async_client import AsyncPlanchetClient
+from planchet.util import encodings
+
+from .bench_load import setup_service
+from .common import make_jsonl, parser, report, timer
+
+JOB = 'bench-compression'
+
+
+class ThrottledTransport(httpx.AsyncBaseTransport):
+    """
+    Sends requests through `transport` over a simulated link of `bandwidth`
+    bytes per second and counts the bytes that cross it in both directions.
+    """
+    def __init__(self, transport, bandwidth: float, accept_encoding: str):
+        self.transport = transport
+        self.bandwidth = bandwidth
+        self.accept_encoding = accept_encoding
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._link = asyncio.Lock()
+
+    async def _cross(self, n_bytes):
+        async with self._link:
+            await asyncio.sleep(n_bytes / self.bandwidth)
+
+    async def handle_async_request(self, request):
+        request.headers['Accept-Encoding'] = self.accept_encoding
+        body = await request.aread()
+        self.bytes_sent += len(body)
+        await self._cross(len(body))
+        response = await self.transport.handle_async_request(request)
+        # the body as sent by the service, still compressed
+        raw = b''.join([part async for part in response.stream])
+        await response.aclose()
+        self.bytes_received += len(raw)
+        await self._cross(len(raw))
+        return httpx.Response(response.status_code, headers=response.headers,
+                              content=raw, request=request)
+
+
+async def worker(client, batch_size):
+    n_items = 0
+    while True:
+        items = await client.get(JOB, batch_size)
+        if not items:
+            return n_items
+        await client.send(JOB, items)
+        n_items += len(items)
+
+
+async def run(encoding, bandwidth, n_workers, input_fp, output_fp,
+              batch_size):
+    compression = None if encoding == 'identity' else encoding
+    transport = ThrottledTransport(httpx.ASGITransport(app=service.app),
+                                   bandwidth, encoding)
+    async with AsyncPlanchetClient('http://planchet', pool_size=n_workers,
+                                   transport=transport,
+                                   compression=compression) as client:
+        response = await client.start_job(
+            JOB, {'input_file_path': input_fp, 'output_file_path': output_fp,
+                  'overwrite': True},
+            'JsonlReader', 'JsonlWriter', clean_start=True)
+        response.raise_for_status()
+        transport.bytes_sent = transport.bytes_received = 0
+        with timer() as t:
+            counts = await asyncio.gather(*(
+                worker(client, batch_size) for _ in range(n_workers)))
+        await client.delete_job(JOB)
+    return sum(counts), t['seconds'], transport
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--bandwidth-mbps', type=float, nargs='+',
+                   default=[10, 100])
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--n-items', type=int, default=20000)
+    p.add_argument('--batch-size', type=int, default=500)
+    args = p.parse_args()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    setup_service(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    output_fps = []
+    results = []
+    try:
+        for mbps in args.bandwidth_mbps:
+            for encoding in ['identity', *reversed(encodings())]:
+                # a new output per run; the service does not reuse output
+                # paths
+                output_fp = f'{input_fp}.{mbps}.{encoding}.out'
+                output_fps.append(output_fp)
+                n_items, seconds, transport = asyncio.run(run(
+                    encoding, mbps * 10 ** 6 / 8, args.workers, input_fp,
+                    output_fp, args.batch_size))
+                results.append({
+                    'bandwidth_mbps': mbps,
+                    'encoding': encoding,
+                    'items': n_items,
+                    'sent_mb': transport.bytes_sent / 10 ** 6,
+                    'received_mb': transport.bytes_received / 10 ** 6,
+                    'items_per_s': n_items / seconds,
+                })
+    finally:
+        for fp in [input_fp, *output_fps]:
+            if os.path.exists(fp):
+                os.remove(fp)
+        service.LEDGER.flushdb()
+    report('Compressed transport', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
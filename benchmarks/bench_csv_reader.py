@@ -0,0 +1,86 @@
+"""
+Rows per second read by `CsvReader` with the row path taken from the frame
+values against the old one through `DataFrame.iterrows`. A CSV file of the
+given size is generated in a temporary directory.
+
+    python -m benchmarks.bench_csv_reader --size-mb 1024
+"""
+import os
+import tempfile
+from io import BytesIO
+from typing import List, Tuple
+
+import pandas as pd
+
+from planchet.io import CsvReader
+
+from .common import parser, report, timer
+
+
+class IterrowsCsvReader(CsvReader):
+    """
+    `CsvReader` building a Series per row like it used to.
+    """
+    def _rows(self, records: bytes) -> List[Tuple]:
+        df = pd.read_csv(BytesIO(self.header + records))
+        return [(*row,) for _, row in df.iterrows()]
+
+
+def make_csv(size_mb: int, directory: str = None) -> Tuple[str, int]:
+    fd, path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    limit = size_mb * 2 ** 20
+    n_rows = 0
+    with os.fdopen(fd, 'w') as fh:
+        fh.write('id,score,label,text\n')
+        size = 0
+        while size < limit:
+            lines = ''.join(
+                f'{i},{i * 0.5},label-{i % 7},"some text, number {i}"\n'
+                for i in range(n_rows, n_rows + 10000))
+            fh.write(lines)
+            size += len(lines)
+            n_rows += 10000
+    return path, n_rows
+
+
+def measure(reader_cls, file_path, n_rows, chunk_size, batch_size):
+    reader = reader_cls({'input_file_path': file_path,
+                         'chunk_size': chunk_size})
+    read = 0
+    with timer() as t:
+        while True:
+            batch = reader(batch_size)
+            if not batch:
+                break
+            read += len(batch)
+    assert read == n_rows
+    return {
+        'reader': 'iterrows' if reader_cls is IterrowsCsvReader else 'values',
+        'chunk_size': chunk_size,
+        'rows': read,
+        'seconds': t['seconds'],
+        'rows_per_s': read / t['seconds'],
+    }
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--size-mb', type=int, default=1024)
+    p.add_argument('--chunk-sizes', type=int, nargs='+', default=[100, 10000])
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--tmp-dir', default=None)
+    args = p.parse_args()
+    file_path, n_rows = make_csv(args.size_mb, args.tmp_dir)
+    results = []
+    try:
+        for chunk_size in args.chunk_sizes:
+            for reader_cls in (IterrowsCsvReader, CsvReader):
+                results.append(measure(reader_cls, file_path, n_rows,
+                                       chunk_size, args.batch_size))
+    finally:
+        os.remove(file_path)
+    report('CSV reader rows/s', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Items and megabytes per second read by each reader and written by each
+writer. The readers read a generated file of `--n-items` items in batches of
+`--batch-size`; the writers write the same items back in batches and flush
+once at the end.
+
+    python -m benchmarks.bench_io --n-items 1000000 --batch-size 1000
+"""
+import os
+
+from planchet.io import CsvReader, CsvWriter, JsonlReader, JsonlWriter
+
+from .common import make_csv, make_jsonl, parser, report, timer
+
+FORMATS = {
+    'csv': (make_csv, CsvReader, CsvWriter),
+    'jsonl': (make_jsonl, JsonlReader, JsonlWriter),
+}
+
+
+def read(reader_cls, input_fp, batch_size):
+    reader = reader_cls({'input_file_path': input_fp})
+    batches = []
+    with timer() as t:
+        while True:
+            batch = reader(batch_size)
+            if not batch:
+                break
+            batches.append(batch)
+    return batches, t['seconds']
+
+
+def write(writer_cls, output_fp, batches):
+    writer = writer_cls({'output_file_path': output_fp, 'overwrite': True})
+    # rows are written as lists, the way they are served
+    data = [[list(item) if isinstance(item, tuple) else item
+             for _, item in batch] for batch in batches]
+    with timer() as t:
+        for batch in data:
+            writer(batch)
+        writer.close()
+    return t['seconds']
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=10 ** 6)
+    p.add_argument('--batch-size', type=int, default=1000)
+    p.add_argument('--formats', nargs='+', default=list(FORMATS),
+                   choices=list(FORMATS))
+    args = p.parse_args()
+    results = []
+    for name in args.formats:
+        make_input, reader_cls, writer_cls = FORMATS[name]
+        input_fp = make_input(args.n_items)
+        output_fp = f'{input_fp}.out'
+        try:
+            batches, read_s = read(reader_cls, input_fp, args.batch_size)
+            write_s = write(writer_cls, output_fp, batches)
+            n_items = sum(len(batch) for batch in batches)
+            for cls, seconds, fp in ((reader_cls, read_s, input_fp),
+                                     (writer_cls, write_s, output_fp)):
+                results.append({
+                    'io': cls.__name__,
+                    'items': n_items,
+                    'seconds': seconds,
+                    'items_per_s': n_items / seconds,
+                    'mb_per_s': os.path.getsize(fp) / 2 ** 20 / seconds,
+                })
+        finally:
+            for fp in (input_fp, output_fp):
+                if os.path.exists(fp):
+                    os.remove(fp)
+    report('Reader and writer throughput', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
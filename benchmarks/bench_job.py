@@ -0,0 +1,68 @@
+"""
+Items per second, wall-clock and ledger round trips per batch of `Job.serve`
+and `Job.receive` at several batch sizes. A whole JSONL job is served and
+every batch is received back right away.
+
+    python -m benchmarks.bench_job --n-items 100000 --batch-sizes 10 100 1000
+"""
+import os
+
+from planchet.core import Job
+from planchet.io import JsonlReader, JsonlWriter
+
+from .common import RoundTripCounter, make_jsonl, make_ledger, parser, \
+    report, timer
+
+
+def run(ledger, input_fp, output_fp, batch_size):
+    ledger.flushdb()
+    job = Job('bench', JsonlReader({'input_file_path': input_fp}),
+              JsonlWriter({'output_file_path': output_fp,
+                           'overwrite': True}), ledger)
+    times = {'serve': 0.0, 'receive': 0.0}
+    counters = {'serve': RoundTripCounter(), 'receive': RoundTripCounter()}
+    n_items = n_batches = 0
+    while True:
+        with counters['serve'](), timer() as t:
+            items = job.serve(batch_size)
+        times['serve'] += t['seconds']
+        if not items:
+            break
+        with counters['receive'](), timer() as t:
+            job.receive(items, False)
+        times['receive'] += t['seconds']
+        n_items += len(items)
+        n_batches += 1
+    job.close()
+    return [{
+        'call': f'Job.{call}',
+        'batch_size': batch_size,
+        'items_per_s': n_items / times[call],
+        'ms/batch': times[call] * 1000 / n_batches,
+        'round_trips/batch': counters[call].count / n_batches,
+    } for call in ('serve', 'receive')]
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=100000)
+    p.add_argument('--batch-sizes', type=int, nargs='+',
+                   default=[10, 100, 1000])
+    args = p.parse_args()
+    ledger = make_ledger(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    output_fp = f'{input_fp}.out'
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            results.extend(run(ledger, input_fp, output_fp, batch_size))
+    finally:
+        for fp in (input_fp, output_fp):
+            if os.path.exists(fp):
+                os.remove(fp)
+        ledger.flushdb()
+    report('Job.serve and Job.receive', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Memory and latency of the packed item ledger against the old layout of one
+key per item. Memory is taken from `INFO memory` when running against a live
+redis; the payload size (keys and values) is reported in both cases.
+
+    python -m benchmarks.bench_ledger --redis-url redis://localhost:6379/15
+"""
+import random
+
+import numpy as np
+from redis.exceptions import ResponseError
+
+from planchet.ledger import ItemLedger, SERVED, RECEIVED, CODES
+
+from .common import make_ledger, parser, report, timer
+
+JOB = 'bench'
+LOOKUP_SIZE = 500
+
+
+def used_memory(ledger):
+    try:
+        return int(ledger.info('memory')['used_memory'])
+    except (KeyError, ResponseError):
+        # fakeredis does not report memory
+        return None
+
+
+def random_codes(n_items):
+    # mostly received, some in flight
+    choices = np.array([CODES[RECEIVED], CODES[SERVED]], dtype=np.uint8)
+    return np.random.choice(choices, n_items, p=[0.95, 0.05])
+
+
+def populate_packed(ledger, codes):
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    packed = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | \
+        quads[:, 3]
+    ledger.set(f'{JOB}:status', packed.astype(np.uint8).tobytes())
+    return len(f'{JOB}:status') + len(packed)
+
+
+def populate_keys(ledger, codes):
+    statuses = {c: s for s, c in CODES.items()}
+    size = 0
+    for start in range(0, len(codes), 10000):
+        chunk = {f'{JOB}:{i}': statuses[codes[i]]
+                 for i in range(start, min(start + 10000, len(codes)))}
+        size += sum(len(k) + len(v) for k, v in chunk.items())
+        ledger.mset(chunk)
+    return size
+
+
+def measure(layout, ledger, n_items, codes):
+    ledger.flushdb()
+    before = used_memory(ledger)
+    with timer() as t_load:
+        if layout == 'packed':
+            payload = populate_packed(ledger, codes)
+        else:
+            payload = populate_keys(ledger, codes)
+    after = used_memory(ledger)
+    ids = random.sample(range(n_items), min(LOOKUP_SIZE, n_items))
+    items = ItemLedger(ledger, JOB)
+    with timer() as t_lookup:
+        if layout == 'packed':
+            items.get(ids)
+        else:
+            ledger.mget([f'{JOB}:{i}' for i in ids])
+    with timer() as t_scan:
+        if layout == 'packed':
+            items.ids(SERVED)
+        else:
+            keys = list(ledger.scan_iter(f'{JOB}:*', count=10000))
+            for start in range(0, len(keys), 10000):
+                ledger.mget(keys[start:start + 10000])
+    return {
+        'layout': layout,
+        'n_items': n_items,
+        'used_memory_mb': (after - before) / 2 ** 20
+        if before is not None and after is not None else 'n/a',
+        'payload_mb': payload / 2 ** 20,
+        'load_s': t_load['seconds'],
+        f'lookup_{LOOKUP_SIZE}_ms': t_lookup['seconds'] * 1000,
+        'scan_s': t_scan['seconds'],
+    }
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[10 ** 6, 10 ** 7, 5 * 10 ** 7])
+    p.add_argument('--keys-max', type=int, default=10 ** 6,
+                   help='largest size measured with one key per item')
+    args = p.parse_args()
+    ledger = make_ledger(args.redis_url)
+    results = []
+    try:
+        for n_items in args.sizes:
+            codes = random_codes(n_items)
+            results.append(measure('packed', ledger, n_items, codes))
+            if n_items <= args.keys_max:
+                results.append(measure('keys', ledger, n_items, codes))
+    finally:
+        ledger.flushdb()
+    report('Item ledger layout', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Load test with N concurrent simulated workers serving and receiving a JSONL
+job through the service. Each worker requests a batch, "processes" it for
+`--work-ms` and sends it back until the job is exhausted. The service runs
+in-process in the same event loop unless `--url` points to a running
+instance (which needs access to the generated input file).
+
+    python -m benchmarks.bench_load --workers 1 10 100 --n-items 20000
+"""
+import asyncio
+import logging
+import os
+import statistics
+
+import httpx
+import redis
+import redis.asyncio
+
+import app as service
+from planchet.async_client import AsyncPlanchetClient
+
+from .common import make_jsonl, parser, report, timer
+
+JOB = 'bench-load'
+
+
+def setup_service(redis_url):
+    # points the in-process service at the benchmark ledger
+    if redis_url:
+        service.LEDGER = redis.Redis.from_url(redis_url)
+        service._make_async_ledger = \
+            lambda: redis.asyncio.Redis.from_url(redis_url)
+    else:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        service.LEDGER = fakeredis.FakeRedis(server=server)
+        service._make_async_ledger = \
+            lambda: fakeredis.FakeAsyncRedis(server=server)
+    service.LEDGER.flushdb()
+
+
+async def worker(client, batch_size, work_ms, latencies):
+    n_items = 0
+    while True:
+        with timer() as t:
+            items = await client.get(JOB, batch_size)
+        latencies['serve'].append(t['seconds'])
+        if not items:
+            return n_items
+        await asyncio.sleep(work_ms / 1000)
+        with timer() as t:
+            await client.send(JOB, items)
+        latencies['receive'].append(t['seconds'])
+        n_items += len(items)
+
+
+async def run(url, n_workers, input_fp, output_fp, batch_size, work_ms):
+    transport = None if url else httpx.ASGITransport(app=service.app)
+    async with AsyncPlanchetClient(url or 'http://planchet',
+                                   pool_size=n_workers,
+                                   transport=transport) as client:
+        response = await client.start_job(
+            JOB, {'input_file_path': input_fp, 'output_file_path': output_fp,
+                  'overwrite': True},
+            'JsonlReader', 'JsonlWriter', clean_start=True)
+        response.raise_for_status()
+        latencies = {'serve': [], 'receive': []}
+        with timer() as t:
+            counts = await asyncio.gather(*(
+                worker(client, batch_size, work_ms, latencies)
+                for _ in range(n_workers)))
+        await client.delete_job(JOB)
+    return sum(counts), t['seconds'], latencies
+
+
+def percentile(values, q):
+    return statistics.quantiles(values, n=100)[q - 1] * 1000 \
+        if len(values) > 1 else values[0] * 1000
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--url', default=None,
+                   help='benchmark a running service instead')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 10, 100])
+    p.add_argument('--n-items', type=int, default=20000)
+    p.add_argument('--batch-size', type=int, default=100)
+    p.add_argument('--work-ms', type=float, default=10)
+    args = p.parse_args()
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    if not args.url:
+        setup_service(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    output_fps = []
+    results = []
+    try:
+        for n_workers in args.workers:
+            # a new output per run; the service does not reuse output paths
+            output_fp = f'{input_fp}.{n_workers}.out'
+            output_fps.append(output_fp)
+            n_items, seconds, latencies = asyncio.run(run(
+                args.url, n_workers, input_fp, output_fp, args.batch_size,
+                args.work_ms))
+            results.append({
+                'workers': n_workers,
+                'items': n_items,
+                'items_per_s': n_items / seconds,
+                'serve_p50_ms': percentile(latencies['serve'], 50),
+                'serve_p95_ms': percentile(latencies['serve'], 95),
+                'receive_p50_ms': percentile(latencies['receive'], 50),
+                'receive_p95_ms': percentile(latencies['receive'], 95),
+            })
+    finally:
+        for fp in [input_fp, *output_fps]:
+            if os.path.exists(fp):
+                os.remove(fp)
+        if not args.url:
+            service.LEDGER.flushdb()
+    report('Concurrent workers', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
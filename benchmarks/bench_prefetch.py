@@ -0,0 +1,71 @@
+"""
+Latency of `Job.serve` with and without a prefetch buffer. Workers take some
+time to process every batch, during which the prefetcher reads and parses the
+next items in the background. The time spent reading is reported next to the
+whole call; against fakeredis the ledger takes most of the rest.
+
+    python -m benchmarks.bench_prefetch --n-items 100000 --work-ms 5
+"""
+import os
+import time
+
+from planchet.core import Job
+from planchet.io import JsonlReader, prefetched
+
+from .common import make_jsonl, make_ledger, parser, report, timer
+
+
+def run(prefetch, input_fp, ledger, batch_size, n_batches, work_ms):
+    ledger.flushdb()
+    metadata = {'input_file_path': input_fp, 'prefetch': prefetch}
+    reader = prefetched(JsonlReader(metadata), metadata)
+    job = Job('bench', reader, None, ledger)
+    seconds = {'read': 0.0, 'serve': 0.0}
+
+    def timed_read(n_items):
+        with timer() as t:
+            batch = reader(n_items)
+        seconds['read'] += t['seconds']
+        return batch
+
+    job.reader = timed_read
+    for _ in range(n_batches):
+        with timer() as t:
+            job.serve(batch_size)
+        seconds['serve'] += t['seconds']
+        time.sleep(work_ms / 1000)
+    job.reader = reader
+    job.close()
+    return {
+        'prefetch': prefetch,
+        'batch_size': batch_size,
+        'work_ms': work_ms,
+        'read_ms/batch': seconds['read'] * 1000 / n_batches,
+        'serve_ms/batch': seconds['serve'] * 1000 / n_batches,
+    }
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=100000)
+    p.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000])
+    p.add_argument('--work-ms', type=float, default=5)
+    p.add_argument('--n-batches', type=int, default=50)
+    args = p.parse_args()
+    ledger = make_ledger(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            n_batches = min(args.n_batches, args.n_items // batch_size)
+            for prefetch in (0, 2 * batch_size):
+                results.append(run(prefetch, input_fp, ledger, batch_size,
+                                   n_batches, args.work_ms))
+    finally:
+        os.remove(input_fp)
+        ledger.flushdb()
+    report('Job.serve with prefetching', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Round trips and wall-clock per batch of `Job.serve`, comparing the per-item
+ledger lookups it used to do with the batched MGET/MSET.
+
+    python -m benchmarks.bench_serve --n-items 100000
+"""
+import os
+from typing import List
+
+from planchet.core import Job, SERVED
+from planchet.io import JsonlReader
+
+from .common import RoundTripCounter, make_jsonl, make_ledger, parser, \
+    report, timer
+
+
+class PerItemJob(Job):
+    """ `Job.serve` as it was: a GET and a SET per item on one key each. """
+    def serve(self, n_items: int) -> List:
+        items: List = []
+        while len(items) < n_items:
+            buff = self.reader(n_items - len(items))
+            for id_, item in buff:
+                status = self.ledger.get(self.ledger_id(id_))
+                if not bool(status) or (
+                        self.cont and status.decode('utf8') == SERVED):
+                    items.append((id_, item))
+                    self.ledger.set(self.ledger_id(id_), SERVED)
+                    self.served.add(id_)
+            if not buff:
+                self.exhausted = True
+                break
+        return items
+
+    def ledger_id(self, id_: int) -> str:
+        return f'{self.name}:{id_}'
+
+
+def run(job_class, input_fp, ledger, batch_size, n_batches):
+    ledger.flushdb()
+    job = job_class('bench', JsonlReader({'input_file_path': input_fp}),
+                    None, ledger)
+    counter = RoundTripCounter()
+    with counter(), timer() as t:
+        for _ in range(n_batches):
+            job.serve(batch_size)
+    return {
+        'serve': job_class.__name__,
+        'batch_size': batch_size,
+        'round_trips/batch': counter.count / n_batches,
+        'ms/batch': t['seconds'] * 1000 / n_batches,
+    }
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--n-items', type=int, default=100000)
+    p.add_argument('--batch-sizes', type=int, nargs='+',
+                   default=[10, 100, 500])
+    args = p.parse_args()
+    ledger = make_ledger(args.redis_url)
+    input_fp = make_jsonl(args.n_items)
+    results = []
+    try:
+        for batch_size in args.batch_sizes:
+            n_batches = max(1, args.n_items // batch_size)
+            for job_class in (PerItemJob, Job):
+                results.append(
+                    run(job_class, input_fp, ledger, batch_size, n_batches))
+    finally:
+        os.remove(input_fp)
+        ledger.flushdb()
+    report('Job.serve', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""
+Time to restore a job on startup as the number of logged items grows. The
+restore only reads the counters; loading the served/received id sets, which
+is what restoring used to do, is reported next to it.
+
+    python -m benchmarks.bench_startup --sizes 100000 1000000 10000000
+"""
+import json
+import os
+
+from planchet.core import Job, READ_WRITE
+from planchet.ledger import ItemLedger
+
+from .bench_ledger import JOB, populate_packed, random_codes
+from .common import make_jsonl, make_ledger, parser, report, timer
+
+
+def prepare(ledger, n_items, input_fp, output_fp):
+    ledger.flushdb()
+    populate_packed(ledger, random_codes(n_items))
+    items = ItemLedger(ledger, JOB)
+    items.migrate()
+    ledger.set(f'JOB:{JOB}', json.dumps({
+        'metadata': {'input_file_path': input_fp,
+                     'output_file_path': output_fp},
+        'reader_name': 'JsonlReader', 'writer_name': 'JsonlWriter',
+        'mode': READ_WRITE}))
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--sizes', type=int, nargs='+',
+                   default=[10 ** 5, 10 ** 6, 10 ** 7])
+    args = p.parse_args()
+    ledger = make_ledger(args.redis_url)
+    input_fp = make_jsonl(10)
+    output_fp = f'{input_fp}.out'
+    results = []
+    try:
+        for n_items in args.sizes:
+            prepare(ledger, n_items, input_fp, output_fp)
+            with timer() as t_restore:
+                job = Job.restore_job(JOB, f'JOB:{JOB}', ledger)
+            stats = job.stats
+            with timer() as t_sets:
+                len(job.served), len(job.received)
+            results.append({
+                'n_items': n_items,
+                'restore_ms': t_restore['seconds'] * 1000,
+                'load_id_sets_ms': t_sets['seconds'] * 1000,
+                'served': stats['served'],
+                'received': stats['received'],
+            })
+    finally:
+        os.remove(input_fp)
+        ledger.flushdb()
+    report('Job restore', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
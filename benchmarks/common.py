@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+import redis
+from redis.connection import Connection
+
+
+class RoundTripCounter:
+    """
+    Counts network round trips made by every redis client in the process.
+    A round trip is a single packed command sent to the server, so a pipeline
+    or a multi-key command counts as one.
+    """
+    def __init__(self):
+        self.count = 0
+
+    @contextmanager
+    def __call__(self) -> Iterator['RoundTripCounter']:
+        original = Connection.send_packed_command
+        counter = self
+
+        def send_packed_command(conn, *args, **kwargs):
+            counter.count += 1
+            return original(conn, *args, **kwargs)
+
+        Connection.send_packed_command = send_packed_command
+        try:
+            yield self
+        finally:
+            Connection.send_packed_command = original
+
+
+def make_ledger(redis_url: str = None) -> redis.Redis:
+    """
+    Make a ledger for benchmarking: a local redis-server if `redis_url` is
+    given, an in-process fakeredis otherwise.
+    """
+    if redis_url:
+        ledger = redis.Redis.from_url(redis_url)
+    else:
+        import fakeredis
+        ledger = fakeredis.FakeRedis()
+    ledger.flushdb()
+    return ledger
+
+
+def make_jsonl(n_items: int, directory: str = None) -> str:
+    fd, path = tempfile.mkstemp(suffix='.jsonl', dir=directory)
+    with os.fdopen(fd, 'w') as fh:
+        for i in range(n_items):
+            fh.write(json.dumps({'id': i, 'text': f'some text number {i}'}))
+            fh.write('\n')
+    return path
+
+
+def make_csv(n_items: int, directory: str = None) -> str:
+    fd, path = tempfile.mkstemp(suffix='.csv', dir=directory)
+    with os.fdopen(fd, 'w') as fh:
+        fh.write('id,text\n')
+        for i in range(n_items):
+            fh.write(f'{i},some text number {i}\n')
+    return path
+
+
+@contextmanager
+def timer() -> Iterator[Dict]:
+    result: Dict = {}
+    start = time.perf_counter()
+    yield result
+    result['seconds'] = time.perf_counter() - start
+
+
+def parser(description: str) -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=description)
+    p.add_argument('--redis-url', default=None,
+                   help='use a live redis, e.g. redis://localhost:6379/15; '
+                        'fakeredis is used if omitted')
+    p.add_argument('--output', default=None,
+                   help='write the results as JSON to this path')
+    return p
+
+
+def report(name: str, results: List[Dict], output: str = None):
+    """
+    Print the results as a table and optionally dump them as JSON.
+    """
+    print(name)
+    if results:
+        columns = list(results[0])
+        print('  '.join(f'{c:>16}' for c in columns))
+        for row in results:
+            print('  '.join(
+                f'{row[c]:>16.4f}' if isinstance(row[c], float)
+                else f'{row[c]:>16}' for c in columns
+            ))
+    if output:
+        with open(output, 'w') as fh:
+            json.dump({'benchmark': name, 'results': results}, fh, indent=2)
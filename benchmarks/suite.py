@@ -0,0 +1,135 @@
+"""
+Run the benchmark suite and write all results to a single JSON file, along
+with the commit and the environment they were measured in. Every benchmark
+runs in its own process. Pass the JSON of an earlier run as `--baseline` to
+print how the throughput and latency columns changed since.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --output new.json --baseline results.json
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from .common import parser, timer
+
+# benchmarks of the suite and their arguments; sized to run in minutes
+SUITE = {
+    'bench_io': ['--n-items', '200000'],
+    'bench_job': ['--n-items', '20000', '--batch-sizes', '10', '100',
+                  '1000'],
+    'bench_api': ['--n-items', '10000', '--batch-sizes', '10', '100',
+                  '1000'],
+    'bench_load': ['--n-items', '10000', '--workers', '1', '10', '50',
+                   '--work-ms', '0'],
+    'bench_backend': ['--n-items', '20000'],
+}
+# columns compared with a baseline and whether higher values are better
+HIGHER_IS_BETTER = ('per_s',)
+LOWER_IS_BETTER = ('_ms', 'ms/', 'seconds')
+
+
+def environment(redis_url: str = None) -> Dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'ledger': 'redis' if redis_url else 'fakeredis',
+    }
+
+
+def run(name: str, args: List[str], redis_url: str = None) -> Dict:
+    fd, output = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    command = [sys.executable, '-m', f'benchmarks.{name}', *args,
+               '--output', output]
+    if redis_url:
+        command += ['--redis-url', redis_url]
+    try:
+        with timer() as t:
+            process = subprocess.run(command)
+        if process.returncode:
+            return {'args': args, 'error': process.returncode}
+        with open(output) as fh:
+            result = json.load(fh)
+    finally:
+        os.remove(output)
+    return {'args': args, 'seconds': t['seconds'], **result}
+
+
+def direction(column: str) -> int:
+    if any(key in column for key in HIGHER_IS_BETTER):
+        return 1
+    if any(key in column for key in LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def compare(results: Dict, baseline: Dict):
+    """
+    Print the change of every throughput and latency value against the
+    baseline, matching the rows of a benchmark by position. A positive change
+    is an improvement.
+    """
+    for name, result in results['benchmarks'].items():
+        old = baseline.get('benchmarks', {}).get(name)
+        if not old or 'results' not in old or 'results' not in result:
+            continue
+        if old['args'] != result['args']:
+            print(f'{name}: run with different arguments, not compared')
+            continue
+        commit = baseline['environment']['commit']
+        print(f'{result["benchmark"]} against {commit}')
+        for row, old_row in zip(result['results'], old['results']):
+            keys = ', '.join(f'{column}={value}'
+                             for column, value in row.items()
+                             if not direction(column))
+            changes = []
+            for column, value in row.items():
+                sign = direction(column)
+                before = old_row.get(column)
+                if not sign or not isinstance(value, (int, float)) or \
+                        not isinstance(before, (int, float)) or not before:
+                    continue
+                change = sign * (value - before) / before * 100
+                changes.append(f'{column} {change:+.1f}%')
+            print(f'  {keys}: {"; ".join(changes)}')
+
+
+def main():
+    p = parser(__doc__)
+    p.add_argument('--only', nargs='+', choices=list(SUITE), default=None,
+                   help='run only these benchmarks')
+    p.add_argument('--baseline', default=None,
+                   help='JSON of an earlier run to compare with')
+    args = p.parse_args()
+    results = {'environment': environment(args.redis_url), 'benchmarks': {}}
+    for name in args.only or SUITE:
+        results['benchmarks'][name] = run(name, SUITE[name], args.redis_url)
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fh:
+            compare(results, json.load(fh))
+    failed = [name for name, result in results['benchmarks'].items()
+              if 'error' in result]
+    if failed:
+        sys.exit(f'Failed benchmarks: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
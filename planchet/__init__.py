@@ -1 +1,2 @@
 from .client import PlanchetClient  # noqa
+from .async_client import AsyncPlanchetClient  # noqa
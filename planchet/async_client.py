@@ -0,0 +1,382 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Set, Tuple, Union
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+from .util import codec, compress, encodings
+
+_fmt = '%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=_fmt)
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+
+
+class AsyncPlanchetClient:
+    """ Asynchronous counterpart of :class:`planchet.client.PlanchetClient`
+    built on `httpx <https://www.python-httpx.org/>`_, which needs to be
+    installed separately. On top of the same methods, it can prefetch the next
+    batch while the current one is processed (:meth:`batches`) and send
+    processed batches in the background (:meth:`send_background`).
+
+    .. code-block:: python
+
+       async with AsyncPlanchetClient(url) as client:
+           async for items in client.batches(job_name, 100):
+               processed = [(id_, process(item)) for id_, item in items]
+               await client.send_background(job_name, processed)
+
+    :param url: Planchet URL, e.g. `<http://localhost:5005>`_
+    :param pool_size: number of connections kept open to the server
+    :param max_in_flight: maximum number of batches sent in the background at
+       the same time
+    :param transport: custom httpx transport, e.g. for testing
+    :param compression: content encoding of request bodies, `gzip` or `zstd`;
+       not compressed if None
+    :param compression_min_size: minimum size in bytes of a compressed
+       request body
+
+    Attributes:
+        RETRIES:    Default number of retries for requests.
+    """
+
+    RETRIES = 5
+    BACKOFF_FACTOR = 0.3
+    STATUS_FORCELIST = (500, 502, 504)
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'PUT', 'DELETE',
+                                    'OPTIONS', 'TRACE'])
+
+    def __init__(self, url: str, pool_size: int = 10,
+                 max_in_flight: int = 4, transport=None,
+                 compression: Union[str, None] = None,
+                 compression_min_size: int = 1024):
+        if httpx is None:
+            raise ImportError('AsyncPlanchetClient requires httpx: '
+                              'pip install planchet[async]')
+        if compression is not None and compression not in encodings():
+            raise ValueError(f'Unsupported compression "{compression}"; use '
+                             f'one of {", ".join(encodings())}')
+        self.compression = compression
+        self.compression_min_size = compression_min_size
+        self.url = url if url.endswith('/') else url + '/'
+        self.max_in_flight = max_in_flight
+        limits = httpx.Limits(max_connections=pool_size,
+                              max_keepalive_connections=pool_size)
+        self._client = httpx.AsyncClient(limits=limits, timeout=None,
+                                         transport=transport)
+        self._in_flight: Union[asyncio.Semaphore, None] = None
+        self._sends: Set[asyncio.Future] = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        Wait for the batches sent in the background and close all
+        connections of the client.
+        """
+        try:
+            await self.drain()
+        finally:
+            await self._client.aclose()
+
+    async def start_job(self, job_name: str, metadata: Dict,
+                        reader_name: str, writer_name: str,
+                        clean_start: bool = False,
+                        token: Union[str, None] = None,
+                        retries: int = 1, mode: str = 'read-write',
+                        cont: bool = False,
+                        lease_ttl: Union[float, None] = None
+                        ) -> 'httpx.Response':
+        """
+        Starts a job. See :meth:`planchet.client.PlanchetClient.start_job`.
+
+        :param job_name: name of the job
+        :param metadata: metadata for the reader and writer classes
+        :param reader_name: name of the reader class, e.g. `CsvReader`.
+        :param writer_name: name of the writer class, e.g. `CsvWriter`.
+        :param clean_start: cleans all items in the ledger before starting
+        :param token: authentication token; no authentication if empty
+        :param retries: number of time to retry this request
+        :param mode: io mode; `read`, `write`, or the default `read-write`
+        :param cont: makes the job a repair job
+        :param lease_ttl: number of seconds served items are leased to a
+           worker before they are served again
+        :return: the server response
+        """
+        params = {
+            'job_name': job_name,
+            'reader_name': reader_name,
+            'writer_name': writer_name,
+            'mode': mode,
+            'clean_start': clean_start,
+            'cont': cont
+        }
+        if lease_ttl is not None:
+            params['lease_ttl'] = lease_ttl
+        return await self._request('POST', 'scramble', params, token,
+                                   retries, metadata)
+
+    async def delete_job(self, job_name: str, token: Union[str, None] = None,
+                         retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Deletes all references to a job.
+
+        :param job_name: job name
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        return await self._request('GET', 'delete', {'job_name': job_name},
+                                   token, retries)
+
+    async def clean_job(self, job_name: str, token: Union[str, None] = None,
+                        retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Remove all items associated with a job
+
+        :param job_name: job name
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        return await self._request('GET', 'clean', {'job_name': job_name},
+                                   token, retries)
+
+    async def purge_server(self, master_token: str, output: bool = True,
+                           retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Remove all jobs, items and optionally delete all output files from
+        the server.
+
+        :param master_token: master authentication token for the server
+        :param output: deletes output file if true
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        return await self._request('GET', 'purge', {'output': output},
+                                   master_token, retries)
+
+    async def get_job_report(self, job_name: str, retries: int = RETRIES
+                             ) -> Union[Dict, None]:
+        """
+        Request the job report from Planchet.
+
+        :param job_name: job name
+        :param retries: number of retries for this request
+        :return: the job report
+        """
+        response = await self._request('GET', 'report',
+                                       {'job_name': job_name}, None, retries)
+        if response.status_code == 200:
+            return codec.loads(response.content)
+        return None
+
+    async def get(self, job_name: str, n_items: int,
+                  token: Union[str, None] = None,
+                  retries: int = RETRIES) -> Union[List, None]:
+        """
+        Request a batch of items from `job_name`.
+
+        :param job_name: job name
+        :param n_items: number of items in the batch
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: list of items
+        """
+        params = {'job_name': job_name, 'batch_size': n_items}
+        response = await self._request('POST', 'serve', params, token,
+                                       retries)
+        if response.status_code == 200:
+            return codec.loads(response.content)
+        return None
+
+    async def batches(self, job_name: str, n_items: int,
+                      token: Union[str, None] = None,
+                      retries: int = RETRIES) -> AsyncIterator[List]:
+        """
+        Iterate over the batches of `job_name` until it is exhausted. The
+        next batch is requested as soon as the current one is handed out, so
+        it is usually ready by the time the current one is processed. A
+        prefetched batch is served to this worker even if the iteration is
+        stopped early.
+
+        :param job_name: job name
+        :param n_items: number of items in a batch
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for a request
+        :return: async iterator of item batches
+        """
+        def fetch() -> asyncio.Future:
+            return asyncio.ensure_future(
+                self.get(job_name, n_items, token, retries))
+
+        next_batch = fetch()
+        try:
+            while True:
+                items = await next_batch
+                if not items:
+                    break
+                next_batch = fetch()
+                yield items
+        finally:
+            if not next_batch.done():
+                next_batch.cancel()
+
+    async def send(self, job_name: str,
+                   items: List[Tuple[int, Union[Dict, List]]],
+                   token: Union[str, None] = None,
+                   overwrite: bool = False,
+                   retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Send a batch of processed items from `job_name` to Planchet.
+
+        :param job_name: job name
+        :param items: processed items
+        :param token: authentication token; no authentication if empty
+        :param overwrite: overwrite the output file
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        if overwrite:
+            logging.warning('The overwrite parameter is discouraged and will '
+                            'be removed in the next major release.')
+        params = {'job_name': job_name, 'overwrite': overwrite}
+        return await self._request('POST', 'receive', params, token, retries,
+                                   items)
+
+    async def send_background(self, job_name: str,
+                              items: List[Tuple[int, Union[Dict, List]]],
+                              token: Union[str, None] = None,
+                              retries: int = RETRIES) -> asyncio.Future:
+        """
+        Send a batch like :meth:`send` without waiting for the response. At
+        most `max_in_flight` batches are sent at the same time; this waits
+        until one of them is done if there are already as many. Failed sends
+        are raised by :meth:`drain`.
+
+        :param job_name: job name
+        :param items: processed items
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: future of the server response
+        """
+        if self._in_flight is None:
+            self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        await self._in_flight.acquire()
+
+        async def send():
+            try:
+                response = await self.send(job_name, items, token,
+                                           retries=retries)
+                response.raise_for_status()
+                return response
+            finally:
+                self._in_flight.release()
+
+        future = asyncio.ensure_future(send())
+        self._sends.add(future)
+        future.add_done_callback(self._forget_send)
+        return future
+
+    def _forget_send(self, future: asyncio.Future):
+        # only failed sends are kept, for `drain` to raise
+        if future.cancelled() or future.exception() is None:
+            self._sends.discard(future)
+
+    async def drain(self) -> List['httpx.Response']:
+        """
+        Wait for all batches sent in the background and raise the first
+        failed send.
+
+        :return: the server responses of the batches that were still being
+           sent
+        """
+        sends = list(self._sends)
+        self._sends.clear()
+        return list(await asyncio.gather(*sends))
+
+    async def mark_errors(self, job_name: str, ids: List[int],
+                          token: Union[str, None] = None,
+                          retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Mark a list of item IDs as errors.
+
+        :param job_name: job name
+        :param ids: list of item IDs
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        return await self._request('POST', 'mark-errors',
+                                   {'job_name': job_name}, token, retries,
+                                   ids)
+
+    async def heartbeat(self, job_name: str, ids: List[int],
+                        token: Union[str, None] = None,
+                        retries: int = RETRIES) -> 'httpx.Response':
+        """
+        Extend the leases of items that are still being processed.
+
+        :param job_name: job name
+        :param ids: list of item IDs
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        return await self._request('POST', 'heartbeat',
+                                   {'job_name': job_name}, token, retries,
+                                   ids)
+
+    async def check(self, retries: int = RETRIES) -> Union[Dict, None]:
+        """
+        Check if Planchet is healthy.
+
+        :param retries: number of retries for this request
+        :return: the service status
+        """
+        response = await self._request('GET', 'health', {}, None, retries)
+        if response.status_code == 200:
+            return codec.loads(response.content)
+        return None
+
+    async def _request(self, method: str, endpoint: str, params: Dict,
+                       token: Union[str, None], retries: int,
+                       body=None) -> 'httpx.Response':
+        # retries failed connections with an exponential backoff like the
+        # retry policy of the synchronous client; server errors and errors
+        # after the request was sent are only retried for idempotent methods,
+        # so that e.g. a batch is never served or received twice
+        if token is not None:
+            params = {**params, 'token': token}
+        content = codec.dumpb(body) if body is not None else None
+        headers = JSON_HEADERS if body is not None else None
+        if content is not None and self.compression and \
+                len(content) >= self.compression_min_size:
+            content = compress(content, self.compression)
+            headers = {**JSON_HEADERS, 'Content-Encoding': self.compression}
+        idempotent = method in self.IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                response = await self._client.request(
+                    method, f'{self.url}{endpoint}', params=params,
+                    content=content, headers=headers)
+                if attempt == retries or not idempotent or \
+                        response.status_code not in self.STATUS_FORCELIST:
+                    return response
+            except (httpx.ConnectError, httpx.ConnectTimeout,
+                    httpx.PoolTimeout):
+                if attempt == retries:
+                    raise
+            except httpx.TransportError:
+                if attempt == retries or not idempotent:
+                    raise
+            await asyncio.sleep(self.BACKOFF_FACTOR * 2 ** attempt)
+            attempt += 1
@@ -1,22 +1,40 @@
-import json
 import logging
-from typing import Dict, List, Union, Tuple
+import threading
+from typing import Dict, Iterable, Iterator, List, Union, Tuple
 
-from requests import Response
+import urllib3
+from requests import Response, Session
 
-from .util import requests_retry_session
+from .util import (
+    Compressor, codec, compress, encodings, requests_retry_session
+)
 
 
 _fmt = '%(message)s'
 logging.basicConfig(level=logging.DEBUG, format=_fmt)
 
+JSON_HEADERS = {'Content-Type': 'application/json'}
+NDJSON_HEADERS = {'Content-Type': 'application/x-ndjson'}
+# number of bytes of a streamed body compressed at a time
+STREAM_BLOCK = 2 ** 16
+
 
 class PlanchetClient:
     """ The PlanchetClient object provides an easy connectivity to a Planchet
     instance. It is essentially a convenience wrapper around the
     `requests library <https://requests.readthedocs.io/en/master/>`_.
 
+    The client keeps its HTTP connections open between requests and can be
+    shared by several threads.
+
     :param url: Planchet URL, e.g. `<http://localhost:5005>`_
+    :param pool_size: number of connections kept open to the server
+    :param keep_alive: reuse connections between requests if True
+    :param compression: content encoding of request bodies, `gzip` or `zstd`;
+       not compressed if None. Responses are compressed in gzip, or in zstd
+       if requests can decode it, whenever the server does so.
+    :param compression_min_size: minimum size in bytes of a compressed
+       request body
 
     Attributes:
         RETRIES:    Default number of retries for requests.
@@ -24,14 +42,41 @@ class PlanchetClient:
 
     RETRIES = 5
 
-    def __init__(self, url):
+    def __init__(self, url, pool_size: int = 10, keep_alive: bool = True,
+                 compression: Union[str, None] = None,
+                 compression_min_size: int = 1024):
         self.url = url if url.endswith('/') else url + '/'
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        if compression is not None and compression not in encodings():
+            raise ValueError(f'Unsupported compression "{compression}"; use '
+                             f'one of {", ".join(encodings())}')
+        self.compression = compression
+        self.compression_min_size = compression_min_size
+        self._sessions: Dict[int, Session] = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Close all connections of the client.
+        """
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
 
     def start_job(self, job_name: str, metadata: Dict, reader_name: str,
                   writer_name: str, clean_start: bool = False,
                   token: Union[str, None] = None,
                   retries: int = 1, mode: str = 'read-write',
-                  cont: bool = False) -> Response:
+                  cont: bool = False,
+                  lease_ttl: Union[float, None] = None) -> Response:
         """
         Starts a job.
 
@@ -56,6 +101,8 @@ class PlanchetClient:
            the default `read-write`
         :param cont: makes the job a repair job resetting the reader iterator
            and cleaning all served by not received items.
+        :param lease_ttl: number of seconds served items are leased to a
+           worker; items that are not received by then are served again.
         :return: the server response
         """
         params = {
@@ -68,8 +115,10 @@ class PlanchetClient:
         }
         if token is not None:
             params['token'] = token
+        if lease_ttl is not None:
+            params['lease_ttl'] = lease_ttl
         url = self.make_param_url('scramble', params)
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         return session.post(url=url, json=metadata)
 
     def delete_job(self, job_name: str, token: Union[str, None] = None,
@@ -83,7 +132,7 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         params = {'job_name': job_name}
         if token is not None:
             params['token'] = token
@@ -100,7 +149,7 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         params = {'job_name': job_name}
         if token is not None:
             params['token'] = token
@@ -118,7 +167,7 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         params = {'token': master_token, 'output': output}
         url = self.make_param_url('purge', params)
         return session.get(url=url)
@@ -143,10 +192,10 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         response = session.get(url=f'{self.url}report?job_name={job_name}')
         if response.status_code == 200:
-            return json.loads(response.text)
+            return codec.loads(response.content)
 
     def get(self, job_name: str, n_items: int,
             token: Union[str, None] = None,
@@ -160,14 +209,14 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         params = {'job_name': job_name, 'batch_size': n_items}
         if token is not None:
             params['token'] = token
         url = self.make_param_url('serve', params)
         response = session.post(url=url)
         if response.status_code == 200:
-            return json.loads(response.text)
+            return codec.loads(response.content)
 
     def send(self, job_name: str, items: List[Tuple[int, Union[Dict, List]]],
              token: Union[str, None] = None,
@@ -182,7 +231,7 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         if overwrite:
             logging.warning('The overwrite parameter is discouraged and will '
                             'be removed in the next major release.')
@@ -190,7 +239,65 @@ class PlanchetClient:
         if token is not None:
             params['token'] = token
         url = self.make_param_url('receive', params)
-        return session.post(url=url, json=items)
+        data, headers = self._json_body(items)
+        return session.post(url=url, data=data, headers=headers)
+
+    def get_stream(self, job_name: str, n_items: int,
+                   token: Union[str, None] = None,
+                   retries: int = RETRIES
+                   ) -> Iterator[Tuple[int, Union[Dict, List]]]:
+        """
+        Request a batch of items from `job_name` as a stream, so that the
+        items are parsed one at a time as they arrive. The request is only
+        made once iteration starts.
+
+        :param job_name: job name
+        :param n_items: number of items in the batch
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: iterator of `(id, item)` tuples
+        """
+        session = self._session(retries)
+        params = {'job_name': job_name, 'batch_size': n_items}
+        if token is not None:
+            params['token'] = token
+        url = self.make_param_url('serve-stream', params)
+        with session.post(url=url, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    id_, item = codec.loads(line)
+                    yield id_, item
+
+    def send_stream(self, job_name: str,
+                    items: Iterable[Tuple[int, Union[Dict, List]]],
+                    token: Union[str, None] = None,
+                    overwrite: bool = False,
+                    retries: int = RETRIES) -> Response:
+        """
+        Send processed items from `job_name` to Planchet as a stream. The
+        items can come from any iterable and are encoded one at a time, so
+        neither side holds the whole batch in memory. A stream is not sent
+        again when the request fails.
+
+        :param job_name: job name
+        :param items: processed items
+        :param token: authentication token; no authentication if empty
+        :param overwrite: overwrite the output file
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        session = self._session(retries)
+        params = {'job_name': job_name, 'overwrite': overwrite}
+        if token is not None:
+            params['token'] = token
+        url = self.make_param_url('receive-stream', params)
+        lines = (codec.dumpb(item) + b'\n' for item in items)
+        if self.compression:
+            return session.post(url=url, data=self._compressed(lines),
+                                headers={**NDJSON_HEADERS,
+                                         'Content-Encoding': self.compression})
+        return session.post(url=url, data=lines, headers=NDJSON_HEADERS)
 
     def mark_errors(self, job_name: str, ids: List[int],
                     token: Union[str, None] = None,
@@ -204,12 +311,33 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         params = {'job_name': job_name}
         if token is not None:
             params['token'] = token
         url = self.make_param_url('mark-errors', params)
-        return session.post(url=url, json=ids)
+        data, headers = self._json_body(ids)
+        return session.post(url=url, data=data, headers=headers)
+
+    def heartbeat(self, job_name: str, ids: List[int],
+                  token: Union[str, None] = None,
+                  retries: int = RETRIES) -> Response:
+        """
+        Extend the leases of items that are still being processed.
+
+        :param job_name: job name
+        :param ids: list of item IDs
+        :param token: authentication token; no authentication if empty
+        :param retries: number of retries for this request
+        :return: the server response
+        """
+        session = self._session(retries)
+        params = {'job_name': job_name}
+        if token is not None:
+            params['token'] = token
+        url = self.make_param_url('heartbeat', params)
+        data, headers = self._json_body(ids)
+        return session.post(url=url, data=data, headers=headers)
 
     def check(self, retries: int = RETRIES) -> Response:
         """
@@ -218,10 +346,46 @@ class PlanchetClient:
         :param retries: number of retries for this request
         :return: the server response
         """
-        session = requests_retry_session(retries=retries)
+        session = self._session(retries)
         response = session.get(url=f'{self.url}health')
         if response.status_code == 200:
-            return json.loads(response.text)
+            return codec.loads(response.content)
+
+    def _session(self, retries: int) -> Session:
+        # one pooled session per retry policy, created on first use
+        with self._lock:
+            session = self._sessions.get(retries)
+            if session is None:
+                session = requests_retry_session(retries=retries,
+                                                 pool_size=self.pool_size)
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                if self.compression == 'zstd' and \
+                        getattr(urllib3.response, 'HAS_ZSTD', False):
+                    session.headers['Accept-Encoding'] = 'zstd, gzip'
+                self._sessions[retries] = session
+            return session
+
+    def _json_body(self, obj) -> Tuple[bytes, Dict]:
+        # the encoded body and its headers, compressed if large enough
+        data = codec.dumpb(obj)
+        if self.compression and len(data) >= self.compression_min_size:
+            return compress(data, self.compression), \
+                {**JSON_HEADERS, 'Content-Encoding': self.compression}
+        return data, JSON_HEADERS
+
+    def _compressed(self, parts: Iterable[bytes]) -> Iterator[bytes]:
+        # a streamed body compressed in blocks of about `STREAM_BLOCK` bytes
+        compressor = Compressor(self.compression)
+        block: List[bytes] = []
+        size = 0
+        for part in parts:
+            block.append(part)
+            size += len(part)
+            if size >= STREAM_BLOCK:
+                yield compressor.compress(b''.join(block))
+                block, size = [], 0
+        yield compressor.compress(b''.join(block), end=True)
 
     def make_param_url(self, endpoint, params):
         params_str = '&'.join(f'{k}={v}' for k, v in params.items())
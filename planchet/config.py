@@ -4,7 +4,32 @@ import os
 REDIS_HOST = os.environ.get('PLANCHET_REDIS_HOST', 'localhost')
 REDIS_PORT = os.environ.get('PLANCHET_REDIS_PORT', '6379')
 REDIS_PWD = os.environ.get('PLANCHET_REDIS_PWD')
+# path to an embedded SQLite ledger used instead of Redis
+SQLITE_PATH = os.environ.get('PLANCHET_SQLITE_PATH')
+# path to the snapshot file of a ledger kept in memory instead of Redis;
+# ':memory:' keeps no snapshots
+MEMORY_LEDGER_PATH = os.environ.get('PLANCHET_MEMORY_LEDGER_PATH')
+# seconds between snapshots of the memory ledger; 0 snapshots every batch
+SNAPSHOT_INTERVAL = float(os.environ.get('PLANCHET_SNAPSHOT_INTERVAL', 10))
 
 MAX_PACKAGE_SIZE = int(os.environ.get('PLANCHET_MAX_PACKAGE_SIZE', 10)) * 10**6
 
+# encodings of compressed responses in order of preference; none if empty
+COMPRESSION = [
+    e.strip() for e in
+    os.environ.get('PLANCHET_COMPRESSION', 'zstd,gzip').split(',')
+    if e.strip()
+]
+# responses smaller than this many bytes are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('PLANCHET_COMPRESSION_MIN_SIZE',
+                                          1024))
+
+# JSON codec of items: 'json', 'orjson' or 'auto' for orjson when installed
+JSON_CODEC = os.environ.get('PLANCHET_JSON_CODEC', 'json')
+
 MASTER_TOKEN = os.environ.get('PLANCHET_MASTER_TOKEN')
+
+# URL other instances reach this one at; enables running several instances
+INSTANCE_URL = os.environ.get('PLANCHET_INSTANCE_URL')
+# seconds an instance keeps owning a job without renewing it
+OWNER_TTL = float(os.environ.get('PLANCHET_OWNER_TTL', 30))
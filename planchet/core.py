@@ -1,18 +1,25 @@
 import json
 import logging
-from typing import Callable, List, Dict, Union, Tuple
+import threading
+import time
+from collections import deque
+from collections.abc import MutableSet
+from typing import (
+    Callable, Deque, Iterable, Iterator, List, Dict, Set, Union, Tuple
+)
 
+import numpy as np
 from redis import Redis
 
 from planchet import io
+from planchet.ledger import (  # noqa
+    ItemLedger, Ledger, SERVED, RECEIVED, ERROR, item_ledger
+)
+from planchet.metrics import JobMetrics, READER, LEDGER, WRITER
 
 _fmt = '%(message)s'
 logging.basicConfig(level=logging.DEBUG, format=_fmt)
 
-SERVED = 'SERVED'
-RECEIVED = 'RECEIVED'
-ERROR = 'ERROR'
-
 IN_PROGRESS = 'IN_PROGRESS'
 COMPLETE = 'COMPLETE'
 
@@ -20,6 +27,89 @@ READ_ONLY = 'read'
 WRITE_ONLY = 'write'
 READ_WRITE = 'read-write'
 
+# minimum number of seconds between two reading checkpoints of a job
+CHECKPOINT_INTERVAL = 1.0
+
+
+class IdSet(MutableSet):
+    """
+    Set of item IDs kept as a bitset indexed by ID, with its size counted as
+    it changes. Item IDs are dense from 0, so 50M items take ~6MB instead of
+    the gigabytes of a `set`.
+
+    :param ids: item IDs
+    """
+    def __init__(self, ids: Iterable[int] = ()):
+        self._bits = np.zeros(0, dtype=np.uint8)
+        self._size = 0
+        self.update(ids)
+
+    def __contains__(self, id_) -> bool:
+        if not isinstance(id_, (int, np.integer)) or id_ < 0:
+            return False
+        byte = int(id_) >> 3
+        return byte < len(self._bits) and \
+            bool(self._bits[byte] >> (int(id_) & 7) & 1)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[int]:
+        bits = np.unpackbits(self._bits, bitorder='little')
+        return iter(np.flatnonzero(bits).tolist())
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({len(self)} ids)'
+
+    def add(self, id_: int):
+        self.update([id_])
+
+    def discard(self, id_: int):
+        self.difference_update([id_])
+
+    def update(self, ids: Iterable[int]):
+        """
+        Add `ids` to the set.
+
+        :param ids: item IDs
+        """
+        ids_ = self._unique(ids)
+        if not ids_.size:
+            return
+        if ids_[0] < 0:
+            raise ValueError(f'Negative item ID: {ids_[0]}')
+        size = int(ids_[-1]) // 8 + 1
+        if size > len(self._bits):
+            bits = np.zeros(max(size, 2 * len(self._bits)), dtype=np.uint8)
+            bits[:len(self._bits)] = self._bits
+            self._bits = bits
+        new = ids_[~self._held(ids_)]
+        np.bitwise_or.at(self._bits, new >> 3,
+                         (1 << (new & 7)).astype(np.uint8))
+        self._size += len(new)
+
+    def difference_update(self, ids: Iterable[int]):
+        """
+        Remove `ids` from the set.
+
+        :param ids: item IDs
+        """
+        ids_ = self._unique(ids)
+        ids_ = ids_[(ids_ >= 0) & (ids_ >> 3 < len(self._bits))]
+        held = ids_[self._held(ids_)]
+        np.bitwise_and.at(self._bits, held >> 3,
+                          ~(1 << (held & 7)).astype(np.uint8))
+        self._size -= len(held)
+
+    def _held(self, ids: np.ndarray) -> np.ndarray:
+        return (self._bits[ids >> 3] >> (ids & 7)) & 1 == 1
+
+    @staticmethod
+    def _unique(ids: Iterable[int]) -> np.ndarray:
+        if not isinstance(ids, (list, tuple, np.ndarray)):
+            ids = list(ids)
+        return np.unique(np.asarray(ids, dtype=np.int64))
+
 
 class Job:
     """
@@ -28,23 +118,69 @@ class Job:
     :param name: job name
     :param reader: reader object
     :param writer: writer object
-    :param ledger: ledger object
+    :param ledger: ledger object or redis connection
     :param mode: writing mode
     :param cont: make a repair job if True
+    :param lease_ttl: number of seconds an item is leased to a worker when
+       served; items that are not received by then are served again. No
+       leases are kept if None.
     """
     def __init__(self, name: str, reader: Callable, writer: Callable,
-                 ledger: Redis, mode: str = READ_WRITE,
-                 cont: bool = False):
+                 ledger: Union[Ledger, Redis], mode: str = READ_WRITE,
+                 cont: bool = False, lease_ttl: Union[float, None] = None):
         self.name = name
         self.reader = reader
         self.writer = writer
         self.ledger = ledger
+        self.items = item_ledger(ledger, name)
         self.mode = mode
-        self.served = set()
-        self.received = set()
+        self._served: Union[IdSet, None] = None
+        self._received: Union[IdSet, None] = None
         self.exhausted = False
         self.cont = cont
+        self._origin: Union[Tuple[int, int], None] = None
+        self._checkpoint_id = 0
+        self._last_checkpoint = 0.0
+        self._pending: Deque[int] = deque()
+        self._unflushed: Set[int] = set()
+        self._writing: Set[int] = set()
+        if lease_ttl and not hasattr(reader, 'read_ids'):
+            logging.error(f'Job "{name}" cannot serve items again by ID; '
+                          f'leases are turned off')
+            lease_ttl = None
+        self.lease_ttl = lease_ttl
+        # guards the state shared by batches served and received at once
+        self._lock = threading.Lock()
+        # number of batches being served
+        self._serving = 0
+        self.metrics = JobMetrics(name)
+        self.items.migrate()
         self.restore_records(self)
+        self.restore_checkpoint()
+        if cont:
+            self.plan_repair()
+
+    @property
+    def served(self) -> IdSet:
+        """
+        IDs of the items that are served but not yet received. They are read
+        from the ledger the first time they are needed.
+        """
+        with self._lock:
+            if self._served is None:
+                self._served = IdSet(self.items.ids(SERVED))
+            return self._served
+
+    @property
+    def received(self) -> IdSet:
+        """
+        IDs of the received items. They are read from the ledger the first
+        time they are needed.
+        """
+        with self._lock:
+            if self._received is None:
+                self._received = IdSet(self.items.ids(RECEIVED))
+            return self._received
 
     def serve(self, n_items: int) -> List:
         """
@@ -53,75 +189,231 @@ class Job:
         :param n_items: number of items served
         :return: list of items of requested size
         """
-        items: List = []
+        self.flush_due()
+        with self._lock:
+            self._serving += 1
+        try:
+            with self.metrics.operation('serve'):
+                items = self._serve(n_items)
+        finally:
+            with self._lock:
+                self._serving -= 1
+        self.metrics.count('served', len(items))
+        return items
+
+    def _serve(self, n_items: int) -> List:
+        items: List = self._reclaim(n_items) if self.lease_ttl else []
         while len(items) < n_items:
             bs = n_items - len(items)
-            buff = self.reader(bs)
-            for id_, item in buff:
-                status = self.ledger.get(self.ledger_id(id_))
-                if not bool(status) or (
-                        self.cont and
-                        status and
-                        status.decode('utf8') == SERVED
-                ):
-                    items.append((id_, item))
-                    self.ledger.set(self.ledger_id(id_), SERVED)
-                    self.served.add(id_)
-            if not buff:
-                self.exhausted = True
-                break
+            with self._lock:
+                ids = [self._pending.popleft()
+                       for _ in range(min(bs, len(self._pending)))]
+            if ids:
+                with self.metrics.stage(READER):
+                    buff = self.reader.read_ids(ids)
+                self._mark_invalid()
+                if not buff:
+                    continue
+            else:
+                with self.metrics.stage(READER):
+                    buff = self.reader(bs)
+                self._mark_invalid()
+                if not buff:
+                    self.exhausted = True
+                    break
+            # one round trip to check the whole buffer and one to mark it
+            with self.metrics.stage(LEDGER):
+                statuses = self.items.get([id_ for id_, _ in buff])
+            with self._lock:
+                batch = [
+                    (id_, item)
+                    for (id_, item), status in zip(buff, statuses)
+                    if not status or (self.cont and status == SERVED
+                                      and id_ not in self._unflushed)
+                ]
+            self._mark([id_ for id_, _ in batch], SERVED)
+            if self.lease_ttl:
+                with self.metrics.stage(LEDGER):
+                    self.items.lease([id_ for id_, _ in batch],
+                                     time.time() + self.lease_ttl)
+            items.extend(batch)
+        return items
+
+    def heartbeat(self, ids: List[int]) -> int:
+        """
+        Extend the leases of served items by another `lease_ttl` seconds.
+
+        :param ids: item IDs
+        :return: number of leases extended
+        """
+        if not self.lease_ttl:
+            return 0
+        with self.metrics.stage(LEDGER):
+            return self.items.extend(ids, time.time() + self.lease_ttl)
+
+    def _reclaim(self, n_items: int) -> List:
+        # items whose lease expired before they were received are served
+        # again ahead of new ones
+        now = time.time()
+        with self.metrics.stage(LEDGER):
+            ids = self.items.reclaim(n_items, now, now + self.lease_ttl)
+        if not ids:
+            return []
+        with self.metrics.stage(LEDGER):
+            statuses = self.items.get(ids)
+        with self._lock:
+            stale = [id_ for id_, status in zip(ids, statuses)
+                     if status == SERVED and id_ not in self._unflushed]
+        with self.metrics.stage(LEDGER):
+            self.items.release(sorted(set(ids) - set(stale)))
+        with self.metrics.stage(READER):
+            items = self.reader.read_ids(stale)
+        self._mark_invalid()
+        if items:
+            logging.info(f'Serving {len(items)} items of job "{self.name}" '
+                         f'again after their lease expired')
         return items
 
     def receive(self, items: List[Tuple[int, Union[Dict, List]]],
                 overwrite: bool):
         """
         Receive a list of processed items from a job, write them to output and
-        mark them as received.
+        mark them as received. Items are only marked once the writer has
+        flushed them to the output.
 
         :param items: processed items
         :param overwrite: overwrite the output file
         """
+        with self.metrics.operation('receive'):
+            n_items = self._receive(items, overwrite)
+        self.metrics.count('received', n_items)
+
+    def _receive(self, items: List[Tuple[int, Union[Dict, List]]],
+                 overwrite: bool) -> int:
         ids = []
         data = []
-        for id_, item in items:
-            # This will skip writing data for records that have been written
-            # already based on the id's in the ledger. This does not apply to
-            # dumping jobs.
-            if self.mode == READ_WRITE and not overwrite and \
-                    self.ledger.get(
-                        self.ledger_id(id_)).decode('utf8') == RECEIVED:
-                continue
-            ids.append(id_)
-            data.append(item)
-        self.writer(data)
-        for id_ in ids:
-            self.received.add(id_)
-            self.served.discard(id_)
-            self.ledger.set(self.ledger_id(id_), RECEIVED)
+        # This will skip writing data for records that have been written
+        # already based on the id's in the ledger. This does not apply to
+        # dumping jobs.
+        skip_received = self.mode == READ_WRITE and not overwrite
+        if skip_received:
+            with self.metrics.stage(LEDGER):
+                statuses = self.items.get([id_ for id_, _ in items])
+        else:
+            statuses = [None] * len(items)
+        with self._lock:
+            for (id_, item), status in zip(items, statuses):
+                if skip_received and (status == RECEIVED or
+                                      id_ in self._unflushed or
+                                      id_ in self._writing):
+                    continue
+                ids.append(id_)
+                data.append(item)
+            # items being written by another batch are not written again
+            self._writing.update(ids)
+        try:
+            with self.metrics.stage(WRITER):
+                if getattr(self.writer, 'shards', None):
+                    self.writer(data, ids)
+                else:
+                    self.writer(data)
+            with self._lock:
+                self._unflushed.update(ids)
+        finally:
+            with self._lock:
+                self._writing.difference_update(ids)
+        if self.exhausted or not getattr(self.writer, 'unflushed', 0):
+            self.flush()
+        if self.status == COMPLETE and getattr(self.writer, 'auto_merge',
+                                               False):
+            self.merge()
+        return len(ids)
+
+    def flush(self):
+        """
+        Flush the output of the job and mark the items written since the last
+        flush as received, so that an item is never marked before its output
+        is written.
+        """
+        # only the items written before the writer is flushed are marked
+        with self._lock:
+            ids = list(self._unflushed)
+        if self.writer is not None and hasattr(self.writer, 'flush'):
+            with self.metrics.stage(WRITER):
+                self.writer.flush()
+        self._mark(ids, RECEIVED)
+        # dropped only once marked, so a repair job serving at the same time
+        # never sees them as merely served
+        with self._lock:
+            self._unflushed.difference_update(ids)
+        self.checkpoint()
+
+    def flush_due(self):
+        """
+        Flush the output of the job if the writer has kept it for as long as
+        it may. A writer only checks that when it writes, so this makes sure
+        the last items received before a pause are marked as received.
+        """
+        with self._lock:
+            pending = bool(self._unflushed)
+        if pending and getattr(self.writer, 'due', True):
+            self.flush()
+
+    def merge(self):
+        """
+        Flush the output of the job and merge the shards of a sharded writer
+        into its output file.
+        """
+        self.flush()
+        if hasattr(self.writer, 'merge'):
+            self.writer.merge()
+
+    def close(self):
+        """
+        Flush the output of the job and close the writer and the reader.
+        """
+        self.flush()
+        if self.writer is not None and hasattr(self.writer, 'close'):
+            self.writer.close()
+        if self.reader is not None and hasattr(self.reader, 'close'):
+            self.reader.close()
 
     def mark_errors(self, ids):
         """
-        Mark the items with IDs in `ids` as errors.
+        Mark the items with IDs in `ids` as errors. Nothing is marked if any
+        of the items has already been received.
 
         :param ids: IDs of items to be marked as errors
         """
-        for id_ in ids:
-            value = self.ledger.get(self.ledger_id(id_))
-            if value and value.decode('utf8') == RECEIVED:
-                logging.error(f'Attempting to mark a received item: {id_}')
-                raise ValueError(f'Item already received: {id_}')
-            self.ledger.set(self.ledger_id(id_), ERROR)
+        with self.metrics.stage(LEDGER):
+            statuses = self.items.get(ids)
+        with self._lock:
+            received = [id_ for id_, status in zip(ids, statuses)
+                        if status == RECEIVED or id_ in self._unflushed]
+        if received:
+            id_ = received[0]
+            logging.error(f'Attempting to mark a received item: {id_}')
+            raise ValueError(f'Item already received: {id_}')
+        self._mark(ids, ERROR)
+        self.checkpoint()
 
     def restart(self):
         """
         Restart the job. The ledger is wiped, all items in this object are
-        cleaned and the job is set to not exhausted.
+        cleaned and the job is set to not exhausted. The served and received
+        ids are loaded again the next time they are needed.
         """
-        for key in list(self.ledger.scan_iter(f'{self.name}:*')):
-            self.ledger.delete(key)
-        self.served = set()
-        self.received = set()
-        self.exhausted = False
+        self.flush()
+        self.items.delete()
+        self.items.create()
+        with self._lock:
+            self._served = None
+            self._received = None
+            self._pending.clear()
+            self.exhausted = False
+        if self._origin is not None:
+            self.reader.seek(*self._origin)
+            self._checkpoint_id = self._origin[0]
 
     def clean(self, output: bool = True):
         """
@@ -130,19 +422,72 @@ class Job:
 
         :param output: remove the output file for this job
         """
-        served = []
-        q_string = f'{self.name}:*'
-        for i, key in enumerate(self.ledger.scan_iter(q_string)):
-            value = self.ledger.get(key).decode('utf8')
-            if value == SERVED:
-                served.append(key)
-        for key in served:
-            self.ledger.delete(key)
-            _, id_ = key.decode('utf8').split(':', 1)
-            self.served.discard(int(id_))
+        self.flush()
+        self._mark(self.items.ids(SERVED), None)
         if output:
             self.writer.clean()
 
+    def checkpoint(self, force: bool = False):
+        """
+        Store the position of the first item that is not complete yet, so
+        that a restored job continues reading the input from there instead of
+        from the start. Runs at most every ``CHECKPOINT_INTERVAL`` seconds
+        unless forced.
+
+        :param force: store the checkpoint regardless of the interval
+        """
+        if self._origin is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if not force and \
+                    now - self._last_checkpoint < CHECKPOINT_INTERVAL:
+                return
+            self._last_checkpoint = now
+            next_id, _ = self.reader.tell()
+            with self.metrics.stage(LEDGER):
+                watermark = self.items.first_incomplete(self._checkpoint_id,
+                                                        next_id)
+            position = self.reader.offset_before(watermark)
+            if position and position[0] > self._checkpoint_id:
+                with self.metrics.stage(LEDGER):
+                    self.items.set_checkpoint(*position)
+                self._checkpoint_id = position[0]
+
+    def restore_checkpoint(self):
+        """
+        Move the reader to the checkpoint stored in the ledger, if the reader
+        supports it.
+        """
+        if not hasattr(self.reader, 'seek'):
+            return
+        self._origin = self.reader.tell()
+        checkpoint = self.items.get_checkpoint()
+        if not checkpoint:
+            return
+        try:
+            self.reader.seek(*checkpoint)
+        except ValueError as e:
+            logging.error(f'Could not restore checkpoint of job '
+                          f'"{self.name}": {e}')
+            return
+        self._checkpoint_id = checkpoint[0]
+
+    def plan_repair(self):
+        """
+        Collect the incomplete items up to the furthest logged item, so that
+        a repair job reads them directly through the index of the reader and
+        then continues reading from that item on. Readers without an index
+        are read again from the checkpoint instead.
+        """
+        if getattr(self.reader, 'index', None) is None:
+            return
+        end = self.items.end()
+        self._pending = deque(self.items.pending(self._checkpoint_id))
+        self.reader.seek_id(end)
+        logging.info(f'Repairing {len(self._pending)} items of job '
+                     f'"{self.name}"')
+
     @property
     def status(self):
         """
@@ -150,11 +495,30 @@ class Job:
 
         :return: job status
         """
-        if self.exhausted and not self.served:
+        # a batch still being served may not be marked as served yet
+        if self.exhausted and not self._serving and \
+                not self.items.counts[SERVED]:
             return COMPLETE
         else:
             return IN_PROGRESS
 
+    @property
+    def queues(self) -> Dict[str, int]:
+        """
+        Number of items waiting in the queues of this job: read ahead by a
+        prefetching reader, left to repair, written but not yet flushed, and
+        served but not yet received.
+
+        :return: queue depths by queue
+        """
+        return {
+            'prefetch': len(self.reader.buffer)
+            if isinstance(self.reader, io.Prefetcher) else 0,
+            'repair': len(self._pending),
+            'unflushed': len(self._unflushed),
+            'in_flight': self.items.counts[SERVED],
+        }
+
     @property
     def stats(self):
         """
@@ -164,27 +528,50 @@ class Job:
         :return: job report
         """
         return {
-            'served': len(self.served),
-            'received': len(self.received),
+            'served': self.items.counts[SERVED],
+            'received': self.items.counts[RECEIVED],
             'status': self.status
         }
 
-    def ledger_id(self, id_: Union[str, int]) -> str:
-        return f'{self.name}:{id_}'
+    def _mark_invalid(self):
+        # inputs that could not be parsed are logged as errors
+        invalid = getattr(self.reader, 'invalid', None)
+        if invalid:
+            with self._lock:
+                ids = invalid[:]
+                del invalid[:len(ids)]
+            self._mark(ids, ERROR)
+
+    def _mark(self, ids: List[int], status: Union[str, None]):
+        # write the new status and keep the loaded id sets in step with it;
+        # marks of batches served or received at once are written to the
+        # ledger at the same time, and the item ledger keeps the counters of
+        # the latest one
+        with self.metrics.stage(LEDGER):
+            self.items.set(ids, status)
+        if self.lease_ttl and status != SERVED:
+            with self.metrics.stage(LEDGER):
+                self.items.release(ids)
+        with self._lock:
+            for tracked, tracked_status in ((self._served, SERVED),
+                                            (self._received, RECEIVED)):
+                if tracked is None:
+                    continue
+                if status == tracked_status:
+                    tracked.update(ids)
+                else:
+                    tracked.difference_update(ids)
 
     @staticmethod
     def restore_records(job):
-        keys = job.ledger.scan_iter(f'{job.name}:*')
-        for key in keys:
-            id_ = int(key.decode('utf8').split(':', 1)[1])
-            value = job.ledger.get(key).decode('utf8')
-            if value == SERVED:
-                job.served.add(id_)
-            elif value == RECEIVED:
-                job.received.add(id_)
+        # only the counters are read; the id sets are loaded lazily
+        job.items.load_counts()
+        job._served = None
+        job._received = None
 
     @staticmethod
-    def restore_job(job_name: str, job_key: str, ledger: Redis):
+    def restore_job(job_name: str, job_key: str,
+                    ledger: Union[Ledger, Redis]):
         record = ledger.get(job_key)
         if not record:
             return
@@ -192,10 +579,12 @@ class Job:
         reader_name = record['reader_name']
         writer_name = record['writer_name']
         metadata = record['metadata']
-        reader: Callable = get_io_object(reader_name, metadata)
+        reader: Callable = io.prefetched(
+            get_io_object(reader_name, metadata), metadata)
         writer: Callable = get_io_object(writer_name, metadata)
         mode: str = record['mode']
-        job: Job = Job(job_name, reader, writer, ledger, mode)
+        job: Job = Job(job_name, reader, writer, ledger, mode,
+                       lease_ttl=record.get('lease_ttl'))
         return job
 
 
@@ -1,47 +1,392 @@
+import csv
 import json
 import logging
 import os
 import threading
-from typing import Dict, List, Iterator, Union
+import time
+from array import array
+from collections import deque
+from io import BytesIO, StringIO
+from typing import (
+    BinaryIO, Deque, Dict, Iterator, List, TextIO, Tuple, Union
+)
 
+import numpy as np
 import pandas as pd
-from pandas.io.parsers import TextFileReader
 
-from .util import red
+from .util import codec, red
 
 
-class CsvReader:
+class _Checkpoints:
+    """
+    Keeps the byte offset of the first item of every batch read since the last
+    checkpoint, so that a job can record a position to resume reading from.
+    Readers using it keep `self.id_` and `self.offset` pointing at the next
+    item to read and hold `self.lock` while reading.
+    """
+    def _init_checkpoints(self):
+        self.offsets: Dict[int, int] = {}
+
+    def tell(self) -> Tuple[int, int]:
+        """
+        Position of the next item to be read.
+
+        :return: item ID and byte offset
+        """
+        return self.id_, self.offset
+
+    def offset_before(self, id_: int) -> Union[Tuple[int, int], None]:
+        """
+        Latest known position at or before item `id_`. Earlier positions are
+        forgotten.
+
+        :param id_: item ID
+        :return: item ID and byte offset or None if none is known
+        """
+        with self.lock:
+            starts = [i for i in self.offsets if i <= id_]
+            if not starts:
+                return None
+            start = max(starts)
+            for i in starts:
+                if i < start:
+                    del self.offsets[i]
+            return start, self.offsets[start]
+
+    def _mark_offset(self):
+        self.offsets.setdefault(self.id_, self.offset)
+
+
+class SparseIndex:
+    """
+    Sidecar index of an input file, stored next to it as ``<file>.pidx``. It
+    keeps the byte offset of every `step`-th item, so a reader can jump close
+    to any item instead of reading the file from the start. The size and
+    modification time of the input are stored with the offsets; an index that
+    does not match them is stale and is not loaded.
+
+    :param file_path: path to the input file
+    :param step: number of items between two indexed offsets
+    """
+    SUFFIX = '.pidx'
+
+    def __init__(self, file_path: str, step: int = 1000):
+        self.file_path = file_path
+        self.index_path = file_path + self.SUFFIX
+        self.step = step
+        self.offsets: List[int] = []
+        self.n_items = 0
+        self.signature: Union[Dict, None] = None
+
+    def stat(self) -> Dict:
+        """
+        Size and modification time of the input file.
+
+        :return: file signature
+        """
+        stat = os.stat(self.file_path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    @property
+    def fresh(self) -> bool:
+        """
+        True if the index is loaded and matches the input file.
+        """
+        return self.signature is not None and self.signature == self.stat()
+
+    def load(self) -> bool:
+        """
+        Load the index from disk if it exists and is not stale.
+
+        :return: True if a fresh index was loaded
+        """
+        try:
+            with open(self.index_path) as fh:
+                index = json.load(fh)
+            signature = {'size': index['size'], 'mtime': index['mtime']}
+            if index['step'] != self.step or signature != self.stat():
+                return False
+            self.offsets = index['offsets']
+            self.n_items = index['n_items']
+            self.signature = signature
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def build(self, offsets: Iterator[int], signature: Dict = None):
+        """
+        Build the index from the offsets of all items and save it.
+
+        :param offsets: byte offsets of the items of the file in order
+        :param signature: file signature at the time the offsets were read;
+            the current one is used by default
+        """
+        signature = signature or self.stat()
+        self.offsets = []
+        self.n_items = 0
+        for id_, offset in enumerate(offsets):
+            if id_ % self.step == 0:
+                self.offsets.append(offset)
+            self.n_items = id_ + 1
+        self.signature = signature
+        self.save()
+
+    def save(self):
+        """
+        Write the index next to the input file. An index that cannot be
+        written is still used from memory.
+        """
+        tmp_path = f'{self.index_path}.tmp'
+        try:
+            with open(tmp_path, 'w') as fh:
+                json.dump({'step': self.step, 'n_items': self.n_items,
+                           'offsets': self.offsets, **self.signature}, fh)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logging.error(red(f'Could not write index {self.index_path}: '
+                              f'{e}'))
+
+    def position(self, id_: int) -> Union[Tuple[int, int], None]:
+        """
+        Closest indexed position at or before item `id_`.
+
+        :param id_: item ID
+        :return: item ID and byte offset or None if the index is empty
+        """
+        if not self.offsets:
+            return None
+        k = min(id_ // self.step, len(self.offsets) - 1)
+        return k * self.step, self.offsets[k]
+
+
+class _Indexed:
+    """
+    Random access to the items of a reader through a :class:`SparseIndex`,
+    enabled with the `index` metadata parameter. A missing or stale index is
+    built while the reader goes through the whole file from the start, or up
+    front the first time an item is looked up. Readers using it implement
+    `_read_raw(fh)`, returning the next record of an open file, and
+    `_parse(records)`, turning `(id, record)` pairs into items.
+    """
+    def _init_index(self, meta_data: Dict, data_offset: int):
+        self.index: Union[SparseIndex, None] = None
+        self._data_offset = data_offset
+        self._first_pass: Union[List[int], None] = None
+        if not meta_data.get('index', False):
+            return
+        step = int(meta_data.get('index_step', 1000))
+        self.index = SparseIndex(self.file_path, step)
+        if not self.index.load():
+            self._start_first_pass()
+
+    def build_index(self):
+        """
+        Build the index of the input file by reading it once without parsing
+        the items.
+        """
+        def offsets():
+            with open(self.file_path, 'rb') as fh:
+                fh.seek(self._data_offset)
+                while True:
+                    offset = fh.tell()
+                    if not self._read_raw(fh):
+                        break
+                    yield offset
+        self.index.build(offsets())
+        self._first_pass = None
+
+    def read_ids(self, ids: List[int]) -> List[Tuple[int, Union[Dict, List]]]:
+        """
+        Read the items with IDs in `ids` without moving the reader. IDs past
+        the end of the file are ignored.
+
+        :param ids: item IDs
+        :return: list of `(id, item)` tuples in ID order
+        """
+        index = self._fresh_index()
+        records: List[Tuple[int, bytes]] = []
+        with open(self.file_path, 'rb') as fh:
+            current: Union[Tuple[int, int], None] = None
+            for id_ in sorted(set(ids)):
+                current = self._walk(fh, index, id_, current)
+                if current[0] != id_:
+                    break
+                record = self._read_raw(fh)
+                records.append((id_, record))
+                current = id_ + 1, fh.tell()
+        return self._parse(records)
+
+    def locate(self, id_: int) -> Tuple[int, int]:
+        """
+        Position of item `id_` or of the end of the file if it has fewer
+        items.
+
+        :param id_: item ID
+        :return: item ID and byte offset
+        """
+        index = self._fresh_index()
+        with open(self.file_path, 'rb') as fh:
+            return self._walk(fh, index, id_, None)
+
+    def seek_id(self, id_: int):
+        """
+        Continue reading from item `id_`.
+
+        :param id_: item ID
+        """
+        self.seek(*self.locate(id_))
+
+    def _fresh_index(self) -> SparseIndex:
+        if self.index is None:
+            raise ValueError(f'No index enabled for {self.file_path}')
+        if not self.index.fresh and not self.index.load():
+            logging.info(f'Building index {self.index.index_path}')
+            self.build_index()
+        return self.index
+
+    def _walk(self, fh: BinaryIO, index: SparseIndex, id_: int,
+              current: Union[Tuple[int, int], None]) -> Tuple[int, int]:
+        # moves `fh` to item `id_` or to the end of the file, starting from
+        # `current` if it is past the closest indexed position
+        start = index.position(id_) or (0, self._data_offset)
+        if current is None or not start[0] <= current[0] <= id_:
+            current = start
+        cur, offset = current
+        fh.seek(offset)
+        while cur < id_:
+            if not self._read_raw(fh):
+                break
+            cur += 1
+        return cur, fh.tell()
+
+    def _start_first_pass(self):
+        self._first_pass = []
+        self._first_pass_signature = self.index.stat()
+
+    def _index_offset(self, id_: int, offset: int):
+        # collects offsets while the file is read from the start
+        if self._first_pass is None:
+            return
+        if id_ % self.index.step == 0:
+            if id_ // self.index.step != len(self._first_pass):
+                self._first_pass = None
+                return
+            self._first_pass.append(offset)
+
+    def _end_first_pass(self, n_items: int):
+        if not self._first_pass:
+            return
+        self.index.offsets = self._first_pass
+        self.index.n_items = n_items
+        self.index.signature = self._first_pass_signature
+        self.index.save()
+        self._first_pass = None
+
+
+def _read_csv_record(fh: BinaryIO) -> bytes:
+    # a record continues over line breaks inside quoted fields; blank lines
+    # are skipped like pandas does, so that records and rows match up
+    record = fh.readline()
+    while record and not record.strip():
+        record = fh.readline()
+    while record.count(b'"') % 2 and record.endswith(b'\n'):
+        line = fh.readline()
+        if not line:
+            break
+        record += line
+    return record
+
+
+class CsvReader(_Checkpoints, _Indexed):
     """
     CSV Reader class.
 
     :param meta_data: configuration for this reader. Requires `input_file_path`
        and optionally uses the `chunk_size` parameter to set the number of
-       lines read at a time by the CSV file iterator.
+       lines read at a time by the CSV file iterator, and the `index` and
+       `index_step` parameters to keep a :class:`SparseIndex` of the file.
     """
     def __init__(self, meta_data: Dict):
         self.file_path: str = meta_data['input_file_path']
         self.chunk_size: int = int(meta_data.get('chunk_size', 100))
-        self.file_iter: TextFileReader = \
-            pd.read_csv(self.file_path, iterator=True,
-                        chunksize=self.chunk_size)
-        self.df_iter = self._next_fp_it()
-        self.idx = 0
+        self.fh: BinaryIO = open(self.file_path, 'rb')
+        self.header: bytes = self._read_record()
+        # fails like pandas does on empty files
+        pd.read_csv(BytesIO(self.header), nrows=0)
+        self.data_offset = self.fh.tell()
+        self.id_ = 0
+        self.offset = self.chunk_end = self.data_offset
+        self.rows: Deque[Tuple[int, Tuple]] = deque()
         self.lock = threading.Lock()
+        self._init_checkpoints()
+        self._init_index(meta_data, self.data_offset)
 
-    def _next_fp_it(self):
-        return next(self.file_iter).iterrows()
+    def _read_record(self) -> bytes:
+        return _read_csv_record(self.fh)
+
+    def _read_raw(self, fh: BinaryIO) -> bytes:
+        return _read_csv_record(fh)
+
+    def _parse(self, records: List[Tuple[int, bytes]]) -> List[Tuple]:
+        if not records:
+            return []
+        rows = self._rows(b''.join(record for _, record in records))
+        return [(id_, row) for (id_, _), row in zip(records, rows)]
+
+    def _rows(self, records: bytes) -> List[Tuple]:
+        # Rows are taken from the interleaved values of the frame rather than
+        # from `iterrows`, which builds a Series per row. The values are the
+        # same: a frame of numeric columns only is cast to a common type,
+        # otherwise every value keeps the type of its column.
+        df = pd.read_csv(BytesIO(self.header + records))
+        return list(map(tuple, df.values.tolist()))
+
+    def _next_chunk(self) -> Deque[Tuple[int, Tuple]]:
+        offsets: List[int] = []
+        records: List[bytes] = []
+        for _ in range(self.chunk_size):
+            offset = self.fh.tell()
+            record = self._read_record()
+            if not record:
+                break
+            offsets.append(offset)
+            records.append(record)
+        self.chunk_end = self.fh.tell()
+        if not records:
+            return deque()
+        return deque(zip(offsets, self._rows(b''.join(records))))
 
     def _iterator(self):
         while True:
-            for _, row in self.df_iter:
-                idx = self.idx
-                self.idx += 1
-                yield idx, row
-            try:
-                self.df_iter = self._next_fp_it()
-            except StopIteration:
+            while self.rows:
+                offset, row = self.rows.popleft()
+                idx = self.id_
+                self.id_ += 1
+                self.offset = self.rows[0][0] if self.rows else self.chunk_end
+                self._index_offset(idx, offset)
+                yield idx, offset, row
+            self.rows = self._next_chunk()
+            if not self.rows:
+                self._end_first_pass(self.id_)
                 break
 
+    def seek(self, id_: int, offset: int):
+        """
+        Continue reading from item `id_` found at byte `offset`.
+
+        :param id_: item ID
+        :param offset: byte offset of the item in the file
+        """
+        if offset > os.path.getsize(self.file_path):
+            raise ValueError(f'Offset {offset} is past the end of '
+                             f'{self.file_path}')
+        with self.lock:
+            self.fh.seek(max(offset, self.data_offset))
+            self.rows = deque()
+            self.id_ = id_
+            self.offset = self.chunk_end = self.fh.tell()
+            self.offsets = {}
+
     def __call__(self, batch_size: int):
         """
         Read a batch of lines from a CSV file.
@@ -51,24 +396,72 @@ class CsvReader:
         """
         with self.lock:
             batch: List = []
-            for id_, row in self._iterator():
-                batch.append((id_, (*row,)))
+            if batch_size < 1:
+                return batch
+            for id_, offset, row in self._iterator():
+                if not batch:
+                    self.offsets.setdefault(id_, offset)
+                batch.append((id_, row))
                 if len(batch) == batch_size:
                     break
             return batch
 
 
-class JsonlReader:
+class JsonlReader(_Checkpoints, _Indexed):
     """
     Read from a JSONL file.
 
     :param meta_data: configuration for this reader. Requires
-       `input_file_path`.
+       `input_file_path` and optionally uses the `index` and `index_step`
+       parameters to keep a :class:`SparseIndex` of the file.
     """
     def __init__(self, meta_data: Dict):
+        self.file_path: str = meta_data['input_file_path']
         self.id_ = 0
-        self.iter: Iterator = open(meta_data['input_file_path'])
+        self.offset = 0
+        # byte offset to stop reading at; the end of the file if None
+        self.end: Union[int, None] = None
+        self.iter: BinaryIO = open(self.file_path, 'rb')
+        self.invalid: List[int] = []
         self.lock = threading.Lock()
+        self._init_checkpoints()
+        self._init_index(meta_data, 0)
+
+    def _read_raw(self, fh: BinaryIO) -> bytes:
+        return fh.readline()
+
+    def _read_line(self) -> bytes:
+        if self.end is not None and self.offset >= self.end:
+            return b''
+        return self.iter.readline()
+
+    def _parse(self, records: List[Tuple[int, bytes]]) -> List[Tuple]:
+        items: List = []
+        for id_, line in records:
+            try:
+                items.append((id_, codec.loads(line)))
+            except json.JSONDecodeError:
+                logging.error(red(f'Could not parse JSON: '
+                                  f'{line.decode("utf8", "replace")}'))
+                with self.lock:
+                    self.invalid.append(id_)
+        return items
+
+    def seek(self, id_: int, offset: int):
+        """
+        Continue reading from item `id_` found at byte `offset`.
+
+        :param id_: item ID
+        :param offset: byte offset of the item in the file
+        """
+        if offset > os.path.getsize(self.file_path):
+            raise ValueError(f'Offset {offset} is past the end of '
+                             f'{self.file_path}')
+        with self.lock:
+            self.iter.seek(offset)
+            self.id_ = id_
+            self.offset = offset
+            self.offsets = {}
 
     def __call__(self, batch_size: int):
         """
@@ -78,70 +471,662 @@ class JsonlReader:
         """
         with self.lock:
             batch: List = []
-            for id_, line in enumerate(self.iter, start=self.id_):
+            if batch_size < 1:
+                return batch
+            self._mark_offset()
+            for line in iter(self._read_line, b''):
+                id_ = self.id_
+                self._index_offset(id_, self.offset)
+                self.id_ += 1
+                self.offset += len(line)
                 try:
-                    jsn: Union[Dict, List] = json.loads(line)
+                    jsn: Union[Dict, List] = codec.loads(line)
                 except json.JSONDecodeError:
-                    logging.error(red(f'Could not parse JSON: {line}'))
+                    logging.error(red(f'Could not parse JSON: '
+                                      f'{line.decode("utf8", "replace")}'))
+                    self.invalid.append(id_)
                     continue
                 batch.append((id_, jsn))
-                self.id_ = id_ + 1
                 if len(batch) == batch_size:
                     break
+            else:
+                self._end_first_pass(self.id_)
             return batch
 
 
-class CsvWriter:
+def split_lines(file_path: str, n_parts: int) -> List[Tuple[int, int]]:
     """
-    Write to a CSV file
+    Split a file into `n_parts` byte ranges of about the same size that start
+    and end at line breaks.
 
-    :param metadata: configuration for this writer. Requires `output_file_path`
-       and optionally uses the `overwrite` parameter to overwrite the output
-       file.
+    :param file_path: file path
+    :param n_parts: number of ranges
+    :return: list of `(start, end)` byte offsets; ranges can be empty
     """
-    def __init__(self, metadata: Dict):
+    size = os.path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, 'rb') as fh:
+        for part in range(1, n_parts):
+            position = max(size * part // n_parts, bounds[-1])
+            if position > bounds[-1]:
+                # move to the start of the next line
+                fh.seek(position - 1)
+                fh.readline()
+                position = fh.tell()
+            bounds.append(position)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class _Partitions:
+    """
+    Reads a job from several partitions, each with its own reader, so that
+    several batches can be read at the same time. Item `i` of partition `k`
+    out of `n` gets the ID `i * n + k`, which keeps the IDs of the job unique
+    and close together in the item ledger. Every batch comes from a single
+    partition: the next one in turn that is not being read from, or the next
+    one in turn if all of them are busy.
+    """
+    def _init_partitions(self, readers: List):
+        self.partitions = readers
+        self.parallelism = len(readers)
+        self.invalid: List[int] = []
+        self.lock = threading.Lock()
+        self._next = 0
+        self._exhausted = [False] * len(readers)
+
+    def _pick(self) -> Union[int, None]:
+        with self.lock:
+            n_parts = len(self.partitions)
+            order = [(self._next + i) % n_parts for i in range(n_parts)]
+            order = [k for k in order if not self._exhausted[k]]
+            if not order:
+                return None
+            idle = [k for k in order if not self.partitions[k].lock.locked()]
+            part = (idle or order)[0]
+            self._next = (part + 1) % n_parts
+            return part
+
+    def __call__(self, batch_size: int):
+        """
+        Read a batch of items from one of the partitions.
+
+        :param batch_size: reading batch size
+        :return: batch read; empty once all partitions are read
+        """
+        n_parts = len(self.partitions)
+        while batch_size > 0:
+            part = self._pick()
+            if part is None:
+                break
+            reader = self.partitions[part]
+            batch = reader(batch_size)
+            invalid = getattr(reader, 'invalid', None)
+            if invalid:
+                with reader.lock:
+                    ids = invalid[:]
+                    del invalid[:len(ids)]
+                with self.lock:
+                    self.invalid.extend(id_ * n_parts + part for id_ in ids)
+            if batch:
+                return [(id_ * n_parts + part, item) for id_, item in batch]
+            with self.lock:
+                self._exhausted[part] = True
+        return []
+
+
+class PartitionedJsonlReader(_Partitions):
+    """
+    Read a job from several JSONL files, or from byte ranges of a single one.
+
+    :param meta_data: configuration for this reader. Requires either
+       `input_file_paths`, a list of files read as one partition each, or
+       `input_file_path` and `partitions`, the number of byte ranges the file
+       is split into.
+    """
+    def __init__(self, meta_data: Dict):
+        paths = meta_data.get('input_file_paths')
+        if paths:
+            self.file_paths: List[str] = list(paths)
+            readers = [JsonlReader({'input_file_path': fp}) for fp in paths]
+        else:
+            file_path = meta_data['input_file_path']
+            self.file_paths = [file_path]
+            readers = []
+            n_parts = int(meta_data.get('partitions', 1))
+            for start, end in split_lines(file_path, n_parts):
+                reader = JsonlReader({'input_file_path': file_path})
+                reader.seek(0, start)
+                reader.end = end
+                readers.append(reader)
+        self._init_partitions(readers)
+
+
+class PartitionedCsvReader(_Partitions):
+    """
+    Read a job from several CSV files, each with its own header.
+
+    :param meta_data: configuration for this reader. Requires
+       `input_file_paths`, a list of files read as one partition each, and
+       optionally uses the `chunk_size` parameter of :class:`CsvReader`.
+    """
+    def __init__(self, meta_data: Dict):
+        self.file_paths: List[str] = list(meta_data['input_file_paths'])
+        readers = [
+            CsvReader({'input_file_path': fp,
+                       'chunk_size': meta_data.get('chunk_size', 100)})
+            for fp in self.file_paths
+        ]
+        self._init_partitions(readers)
+
+
+class _AppendWriter:
+    """
+    Keeps a single buffered handle to the output file open between writes.
+    Written data is flushed to the file once `buffer_size` characters are
+    pending or `flush_interval` seconds have passed since the last flush;
+    the default interval of 0 flushes after every write. Writers using it
+    call `_write(text)` and keep `self.lock` while writing. `written` counts
+    the bytes written so far; the output is encoded in UTF-8.
+    """
+    def _init_handle(self, metadata: Dict):
         self.file_path: str = metadata['output_file_path']
         overwrite: bool = metadata.get('overwrite', False)
-        exists = os.path.exists(self.file_path)
         self.mode = 'w' if overwrite else 'a'
-        self.has_header = overwrite or not exists
+        self.buffer_size = int(metadata.get('buffer_size', 2 ** 20))
+        self.flush_interval = float(metadata.get('flush_interval', 0))
+        self.fh: Union[TextIO, None] = None
+        self.unflushed = 0
+        self.written = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+
+    def _open(self) -> TextIO:
+        if self.fh is None:
+            self._on_open()
+            self.fh = open(self.file_path, self.mode, newline='',
+                           encoding='utf8', buffering=self.buffer_size)
+            # an overwritten file is only truncated when first opened
+            self.mode = 'a'
+        return self.fh
+
+    def _on_open(self):
+        pass
+
+    def _write(self, text: str):
+        self._open().write(text)
+        self.unflushed += len(text)
+        self.written += len(text) if text.isascii() else \
+            len(text.encode('utf8'))
+        if self.due:
+            self.flush()
+
+    @property
+    def due(self) -> bool:
+        """
+        True if the pending output has reached the size or time threshold.
+        """
+        elapsed = time.monotonic() - self.last_flush
+        return self.unflushed >= self.buffer_size or \
+            elapsed >= self.flush_interval
+
+    def flush(self):
+        """
+        Write all pending output to the file.
+        """
+        with self.lock:
+            if self.fh is not None:
+                self.fh.flush()
+            self.unflushed = 0
+            self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Flush pending output and close the file. The file is opened again on
+        the next write.
+        """
+        with self.lock:
+            if self.fh is not None:
+                self.fh.close()
+                self.fh = None
+            self.unflushed = 0
 
     def clean(self):
-        try:
-            os.remove(self.file_path)
-        except FileNotFoundError:
-            pass
+        with self.lock:
+            self.close()
+            try:
+                os.remove(self.file_path)
+            except FileNotFoundError:
+                pass
+
+
+class Prefetcher:
+    """
+    Reads ahead of a reader in a background thread and keeps up to `size`
+    parsed items ready, so that reading a batch mostly takes items from
+    memory. Items leave the buffer only when they are read from the
+    prefetcher, so items that are buffered but never served are not lost
+    when a job is cleaned. Moving the reader drops the buffer; it can only be
+    moved with ``seek`` and ``seek_id`` if the wrapped reader has them. Every
+    other attribute is taken from the wrapped reader.
+
+    :param reader: reader object
+    :param size: maximum number of buffered items
+    """
+    def __init__(self, reader, size: int):
+        self.reader = reader
+        self.size = size
+        self.buffer: Deque[Tuple[int, Union[Dict, List, Tuple]]] = deque()
+        self.exhausted = False
+        self.closed = False
+        self.error: Union[Exception, None] = None
+        self.cond = threading.Condition()
+        # held while the wrapped reader reads or moves
+        self.read_lock = threading.Lock()
+        self.thread: Union[threading.Thread, None] = None
+
+    def __getattr__(self, name):
+        if name == 'reader':
+            raise AttributeError(name)
+        attr = getattr(self.reader, name)
+        if name in ('seek', 'seek_id'):
+            return getattr(self, f'_{name}')
+        return attr
+
+    def __call__(self, batch_size: int):
+        """
+        Take a batch of buffered items, waiting for the first one if the
+        buffer is empty. The batch can be smaller than `batch_size`.
+
+        :param batch_size: reading batch size
+        :return: batch read; empty once the reader is exhausted
+        """
+        with self.cond:
+            self._start()
+            while not (self.buffer or self.exhausted or self.closed):
+                self.cond.wait()
+            if self.error is not None and not self.buffer:
+                # the error is raised once and reading ahead goes on
+                error, self.error = self.error, None
+                self.exhausted = False
+                self.cond.notify_all()
+                raise error
+            n_items = min(max(batch_size, 0), len(self.buffer))
+            batch = [self.buffer.popleft() for _ in range(n_items)]
+            self.cond.notify_all()
+            return batch
+
+    def _seek(self, id_: int, offset: int):
+        """
+        Drop the buffered items and continue reading from item `id_` found at
+        byte `offset`.
+
+        :param id_: item ID
+        :param offset: byte offset of the item in the file
+        """
+        with self.read_lock:
+            self.reader.seek(id_, offset)
+            with self.cond:
+                self.buffer.clear()
+                self.exhausted = False
+                self.cond.notify_all()
+
+    def _seek_id(self, id_: int):
+        """
+        Drop the buffered items and continue reading from item `id_`.
+
+        :param id_: item ID
+        """
+        self._seek(*self.reader.locate(id_))
+
+    def close(self):
+        """
+        Stop reading ahead and drop the buffered items.
+        """
+        with self.cond:
+            self.closed = True
+            self.buffer.clear()
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _start(self):
+        if self.thread is None and not self.closed:
+            self.thread = threading.Thread(target=self._fill, daemon=True)
+            self.thread.start()
+
+    def _fill(self):
+        while True:
+            with self.cond:
+                while not self.closed and (
+                        self.exhausted or len(self.buffer) >= self.size):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                n_items = self.size - len(self.buffer)
+            with self.read_lock:
+                try:
+                    batch = self.reader(n_items)
+                except Exception as e:
+                    logging.error(red(f'Could not read ahead: {e}'))
+                    batch, error = [], e
+                else:
+                    error = None
+                with self.cond:
+                    self.buffer.extend(batch)
+                    self.exhausted = not batch
+                    self.error = error
+                    self.cond.notify_all()
+
+
+def prefetched(reader, meta_data: Dict):
+    """
+    Wrap `reader` in a :class:`Prefetcher` if the `prefetch` parameter of
+    `meta_data`, the number of items to read ahead, is set.
+
+    :param reader: reader object or None
+    :param meta_data: reader configuration
+    :return: the reader or its prefetcher
+    """
+    size = int(meta_data.get('prefetch') or 0)
+    if reader is None or size < 1:
+        return reader
+    return Prefetcher(reader, size)
+
+
+def _csv_row(record: Union[Dict, List], columns: List = None) -> str:
+    # the values of a dictionary record are taken in the order of `columns`
+    if isinstance(record, dict):
+        record = [record.get(c) for c in columns] if columns \
+            else list(record.values())
+    buffer = StringIO()
+    csv.writer(buffer, lineterminator='\n').writerow(record)
+    return buffer.getvalue()
+
+
+class CsvWriter(_AppendWriter):
+    """
+    Write to a CSV file. The first item written to a new or overwritten file
+    is its header; the keys are used for a dictionary item.
+
+    :param metadata: configuration for this writer. Requires `output_file_path`
+       and optionally uses the `overwrite` parameter to overwrite the output
+       file, and the `buffer_size` and `flush_interval` parameters to control
+       when the output is flushed.
+    """
+    def __init__(self, metadata: Dict):
+        self._init_handle(metadata)
+        self.has_header = self.mode == 'w' or \
+            not os.path.exists(self.file_path)
+        self.columns: Union[List, None] = None
+
+    def _on_open(self):
+        self.has_header = self.has_header or \
+            not os.path.exists(self.file_path)
 
     def __call__(self, data: List):
         if not data:
             return
-        header = data[0] if self.has_header else None
-        records = data[1:] if self.has_header else data
-        df = pd.DataFrame(records, columns=header)
-        df.to_csv(self.file_path, mode=self.mode, header=self.has_header,
-                  index=False)
+        with self.lock:
+            self._open()
+            records = data
+            text = ''
+            if self.has_header:
+                self.columns = list(data[0])
+                text = _csv_row(self.columns)
+                records = data[1:]
+                self.has_header = False
+            self._write(text + ''.join(_csv_row(record, self.columns)
+                                       for record in records))
 
 
-class JsonlWriter:
+class JsonlWriter(_AppendWriter):
     """
     Write to a JSONL file
 
     :param metadata: configuration for this writer. Requires `output_file_path`
        and optionally uses the `overwrite` parameter to overwrite the output
-       file.
+       file, and the `buffer_size` and `flush_interval` parameters to control
+       when the output is flushed.
     """
     def __init__(self, metadata: Dict):
+        self._init_handle(metadata)
+
+    def __call__(self, data: List):
+        with self.lock:
+            self._write('\n'.join([codec.dumps(jsn) for jsn in data]) + '\n')
+
+
+class _ShardFile(_AppendWriter):
+    # a single shard of a sharded writer
+    def __init__(self, metadata: Dict):
+        self._init_handle(metadata)
+
+    def __call__(self, text: str):
+        with self.lock:
+            self._write(text)
+
+
+class _Shards:
+    """
+    Writes the output of a job to several shard files next to the output file
+    (``<output_file_path>.shard-<k>``), each with its own handle and lock, so
+    that batches received at the same time are written in parallel. Every
+    batch goes to a single shard: the next one in turn that is not being
+    written to, or the next one in turn if all of them are busy. Every record
+    is stored after the ID of its item, and :meth:`merge` writes the records
+    of all shards to the output file in ID order.
+    """
+    def _init_shards(self, metadata: Dict):
         self.file_path: str = metadata['output_file_path']
         overwrite: bool = metadata.get('overwrite', False)
         self.mode = 'w' if overwrite else 'a'
+        self.auto_merge = bool(metadata.get('merge', True))
+        n_shards = int(metadata.get('shards', 1))
+        self.shards = [
+            _ShardFile({**metadata, 'output_file_path':
+                        f'{self.file_path}.shard-{k}'})
+            for k in range(n_shards)
+        ]
+        self.parallelism = n_shards
+        self.lock = threading.RLock()
+        self._next = 0
+
+    def _write(self, text_by_id: List[Tuple[int, str]]):
+        if not text_by_id:
+            return
+        text = ''.join(f'{id_} {record}' for id_, record in text_by_id)
+        with self.lock:
+            n_shards = len(self.shards)
+            order = [(self._next + i) % n_shards for i in range(n_shards)]
+            self._next = (self._next + 1) % n_shards
+        for k in order:
+            shard = self.shards[k]
+            if shard.lock.acquire(blocking=False):
+                try:
+                    return shard(text)
+                finally:
+                    shard.lock.release()
+        self.shards[order[0]](text)
+
+    @property
+    def unflushed(self) -> int:
+        """
+        Number of characters written to the shards but not yet flushed.
+        """
+        return sum(shard.unflushed for shard in self.shards)
+
+    @property
+    def written(self) -> int:
+        """
+        Number of bytes written to the shards.
+        """
+        return sum(shard.written for shard in self.shards)
+
+    @property
+    def due(self) -> bool:
+        """
+        True if the pending output of a shard has reached the size or time
+        threshold.
+        """
+        return any(shard.unflushed and shard.due for shard in self.shards)
+
+    def flush(self):
+        """
+        Write all pending output to the shard files.
+        """
+        for shard in self.shards:
+            shard.flush()
+
+    def close(self):
+        """
+        Flush pending output and close the shard files.
+        """
+        for shard in self.shards:
+            shard.close()
+
+    def clean(self):
+        with self.lock:
+            for shard in self.shards:
+                shard.clean()
+            self._clean_extra()
+            try:
+                os.remove(self.file_path)
+            except FileNotFoundError:
+                pass
+
+    def merge(self):
+        """
+        Write the records of all shards to the output file in ID order and
+        remove the shards. A record received more than once is written once.
+        The output file is overwritten or appended to like that of a single
+        writer.
+        """
+        with self.lock:
+            for shard in self.shards:
+                shard.lock.acquire()
+            try:
+                self.close()
+                self._merge()
+            finally:
+                for shard in self.shards:
+                    shard.lock.release()
+
+    def _merge(self):
+        ids, shards, offsets = array('q'), array('q'), array('q')
+        for k, shard in enumerate(self.shards):
+            if not os.path.exists(shard.file_path):
+                continue
+            with open(shard.file_path, 'rb') as fh:
+                offset = 0
+                for record in iter(lambda: self._read_record(fh), b''):
+                    ids.append(int(record[:record.index(b' ')]))
+                    shards.append(k)
+                    offsets.append(offset)
+                    offset += len(record)
+        ids_ = np.frombuffer(ids, dtype=np.int64)
+        order = np.argsort(ids_, kind='stable')
+        sorted_ids = ids_[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        handles = [open(shard.file_path, 'rb')
+                   if os.path.exists(shard.file_path) else None
+                   for shard in self.shards]
+        try:
+            with open(self.file_path, self.mode + 'b') as out:
+                self._write_header(out)
+                for i in order[first]:
+                    fh = handles[shards[i]]
+                    fh.seek(offsets[i])
+                    record = self._read_record(fh)
+                    out.write(record[record.index(b' ') + 1:])
+        finally:
+            for fh in handles:
+                if fh is not None:
+                    fh.close()
+        self.mode = 'a'
+        for shard in self.shards:
+            shard.clean()
+        self._clean_extra()
+
+    def _read_record(self, fh: BinaryIO) -> bytes:
+        return fh.readline()
+
+    def _write_header(self, out: BinaryIO):
+        pass
+
+    def _clean_extra(self):
+        pass
+
+
+class ShardedJsonlWriter(_Shards):
+    """
+    Write to JSONL shard files that are merged into the output file.
+
+    :param metadata: configuration for this writer. Requires `output_file_path`
+       and optionally uses the `shards` parameter to set the number of shard
+       files, the `merge` parameter to turn off merging them once the job is
+       complete, and the parameters of :class:`JsonlWriter`.
+    """
+    def __init__(self, metadata: Dict):
+        self._init_shards(metadata)
+
+    def __call__(self, data: List, ids: List[int]):
+        self._write([(id_, codec.dumps(jsn) + '\n')
+                     for id_, jsn in zip(ids, data)])
+
+
+class ShardedCsvWriter(_Shards):
+    """
+    Write to CSV shard files that are merged into the output file. The first
+    item written to a new or overwritten output is its header, which is kept
+    in ``<output_file_path>.shard-header`` until the shards are merged.
+
+    :param metadata: configuration for this writer. Requires `output_file_path`
+       and optionally uses the `shards` parameter to set the number of shard
+       files, the `merge` parameter to turn off merging them once the job is
+       complete, and the parameters of :class:`CsvWriter`.
+    """
+    def __init__(self, metadata: Dict):
+        self._init_shards(metadata)
+        self.header_path = f'{self.file_path}.shard-header'
+        self.columns: Union[List, None] = None
+        if os.path.exists(self.header_path) and self.mode == 'a':
+            with open(self.header_path, newline='') as fh:
+                self.columns = next(csv.reader(fh), None)
+        self.has_header = self.columns is None and (
+            self.mode == 'w' or not os.path.exists(self.file_path))
+
+    def __call__(self, data: List, ids: List[int]):
+        if not data:
+            return
+        with self.lock:
+            if self.has_header:
+                self.columns = list(data[0])
+                with open(self.header_path, 'w', newline='') as fh:
+                    fh.write(_csv_row(self.columns))
+                data, ids = data[1:], ids[1:]
+                self.has_header = False
+        self._write([(id_, _csv_row(record, self.columns))
+                     for id_, record in zip(ids, data)])
+
+    def _read_record(self, fh: BinaryIO) -> bytes:
+        return _read_csv_record(fh)
+
+    def _write_header(self, out: BinaryIO):
+        if os.path.exists(self.header_path):
+            with open(self.header_path, 'rb') as fh:
+                out.write(fh.read())
 
     def clean(self):
+        with self.lock:
+            super().clean()
+            self.has_header = True
+            self.columns = None
+
+    def _clean_extra(self):
         try:
-            os.remove(self.file_path)
+            os.remove(self.header_path)
         except FileNotFoundError:
             pass
-
-    def __call__(self, data: List):
-        with open(self.file_path, mode=self.mode) as fh:
-            fh.write('\n'.join([json.dumps(jsn) for jsn in data]))
-            fh.write('\n')
@@ -0,0 +1,694 @@
+import asyncio
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import (
+    AsyncIterator, Dict, Iterable, Iterator, List, Tuple, Union
+)
+
+import numpy as np
+from redis import Redis
+
+_fmt = '%(message)s'
+logging.basicConfig(level=logging.DEBUG, format=_fmt)
+
+SERVED = 'SERVED'
+RECEIVED = 'RECEIVED'
+ERROR = 'ERROR'
+
+# 2-bit status codes; 0 means the item has no record
+CODES = {SERVED: 1, RECEIVED: 2, ERROR: 3}
+STATUSES = (None, SERVED, RECEIVED, ERROR)
+
+LAYOUT_VERSION = '3'
+
+# maximum number of ids addressed by a single BITFIELD command
+_BITFIELD_CHUNK = 10000
+# number of bytes (4 items each) fetched at a time when scanning
+_SCAN_CHUNK = 2 ** 20
+# number of bytes first fetched when looking for incomplete items
+_WATERMARK_WINDOW = 2 ** 12
+
+# Sets the code of every id in ARGV[2:] to ARGV[1] and keeps the per-status
+# counters in KEYS[2] in step. Returns the three counters and their version,
+# which goes up with every call, followed by the previous codes of the ids.
+_SET_SCRIPT = """
+local new = tonumber(ARGV[1])
+local delta = {0, 0, 0}
+local result = {0, 0, 0, 0}
+for i = 2, #ARGV do
+    local old = redis.call(
+        'BITFIELD', KEYS[1], 'SET', 'u2', '#' .. ARGV[i], new)[1]
+    result[#result + 1] = old
+    if old ~= new then
+        if old > 0 then delta[old] = delta[old] - 1 end
+        if new > 0 then delta[new] = delta[new] + 1 end
+    end
+end
+for code = 1, 3 do
+    if delta[code] ~= 0 then
+        redis.call('HINCRBY', KEYS[2], code, delta[code])
+    end
+    result[code] = tonumber(redis.call('HGET', KEYS[2], code) or 0)
+end
+result[4] = redis.call('HINCRBY', KEYS[2], 'version', 1)
+return result
+"""
+
+
+# Takes up to ARGV[3] items in KEYS[1] whose lease expired by ARGV[1] and
+# leases them again until ARGV[2]. Returns their ids.
+_RECLAIM_SCRIPT = """
+local ids = redis.call(
+    'ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, id in ipairs(ids) do
+    redis.call('ZADD', KEYS[1], ARGV[2], id)
+end
+return ids
+"""
+
+
+class Ledger(ABC):
+    """
+    Interface of the store behind a Planchet instance. It keeps the records
+    of jobs and tokens as key-value pairs, with the commands of a Redis
+    client of the same names, and the item statuses of every job in an item
+    ledger (see :class:`BaseItemLedger`) made by :meth:`items`. A plain Redis
+    client can be used wherever a ledger is expected.
+    """
+    @abstractmethod
+    def get(self, key: str) -> Union[bytes, None]:
+        """
+        Get the value of a record.
+
+        :param key: record key
+        :return: value or None if there is no record
+        """
+
+    @abstractmethod
+    def set(self, key: str, value: Union[str, bytes]):
+        """
+        Set the value of a record.
+
+        :param key: record key
+        :param value: value
+        """
+
+    @abstractmethod
+    def delete(self, *keys: str) -> int:
+        """
+        Delete records.
+
+        :param keys: record keys
+        :return: number of records deleted
+        """
+
+    @abstractmethod
+    def scan_iter(self, match: str = '*') -> Iterator[bytes]:
+        """
+        Iterate over the keys of the records matching a glob-style pattern.
+
+        :param match: key pattern
+        :return: iterator of keys
+        """
+
+    @abstractmethod
+    def flushdb(self):
+        """
+        Delete all records and item statuses.
+        """
+
+    @abstractmethod
+    def ping(self) -> bool:
+        """
+        Check that the store can be reached.
+
+        :return: True
+        """
+
+    @abstractmethod
+    def items(self, job_name: str) -> 'BaseItemLedger':
+        """
+        Item ledger of a job.
+
+        :param job_name: job name
+        :return: item ledger
+        """
+
+    def close(self):
+        """
+        Release the resources held by the ledger.
+        """
+
+
+class AsyncLedger:
+    """
+    The record commands of a :class:`Ledger` for the event loop, run in the
+    default executor so that a busy ledger does not block the loop.
+
+    :param ledger: ledger
+    """
+    def __init__(self, ledger: Ledger):
+        self.ledger = ledger
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, func, *args)
+
+    async def get(self, key: str) -> Union[bytes, None]:
+        return await self._call(self.ledger.get, key)
+
+    async def set(self, key: str, value: Union[str, bytes]):
+        return await self._call(self.ledger.set, key, value)
+
+    async def delete(self, *keys: str) -> int:
+        return await self._call(self.ledger.delete, *keys)
+
+    async def scan_iter(self, match: str = '*') -> AsyncIterator[bytes]:
+        keys = await self._call(lambda: list(self.ledger.scan_iter(match)))
+        for key in keys:
+            yield key
+
+    async def flushdb(self):
+        return await self._call(self.ledger.flushdb)
+
+    async def ping(self) -> bool:
+        return await self._call(self.ledger.ping)
+
+
+class RedisLedger(Ledger):
+    """
+    Ledger kept in Redis. Every other attribute is taken from the client.
+
+    :param redis: redis connection
+    """
+    def __init__(self, redis: Redis):
+        self.redis = redis
+
+    def __getattr__(self, name):
+        if name == 'redis':
+            raise AttributeError(name)
+        return getattr(self.redis, name)
+
+    def get(self, key: str) -> Union[bytes, None]:
+        return self.redis.get(key)
+
+    def set(self, key: str, value: Union[str, bytes]):
+        self.redis.set(key, value)
+
+    def delete(self, *keys: str) -> int:
+        return self.redis.delete(*keys)
+
+    def scan_iter(self, match: str = '*') -> Iterator[bytes]:
+        return self.redis.scan_iter(match)
+
+    def flushdb(self):
+        self.redis.flushdb()
+
+    def ping(self) -> bool:
+        return self.redis.ping()
+
+    def items(self, job_name: str) -> 'ItemLedger':
+        return ItemLedger(self.redis, job_name)
+
+    def close(self):
+        self.redis.close()
+
+
+def item_ledger(ledger: Union[Ledger, Redis], job_name: str
+                ) -> 'BaseItemLedger':
+    """
+    Item ledger of a job in a ledger or a plain Redis client.
+
+    :param ledger: ledger or redis connection
+    :param job_name: job name
+    :return: item ledger
+    """
+    if isinstance(ledger, Ledger):
+        return ledger.items(job_name)
+    return ItemLedger(ledger, job_name)
+
+
+class BaseItemLedger(ABC):
+    """
+    Interface of the item statuses of a single job, made by
+    :meth:`Ledger.items`. An item has one of the statuses in `CODES` or no
+    record, and :attr:`counts` holds the number of items in each status as of
+    the last change. Served items can hold a lease until a given time.
+    Backends implement `_chunks(first)`, the statuses from item `first` on as
+    `(first item id, codes)` pairs, which the scans are built on.
+
+    :param job_name: job name
+    """
+    def __init__(self, job_name: str):
+        self.job_name = job_name
+        self.counts: Dict[str, int] = {s: 0 for s in CODES}
+
+    @abstractmethod
+    def get(self, ids: List[int]) -> List[Union[str, None]]:
+        """
+        Get the statuses of `ids`; `None` for items without a record.
+
+        :param ids: item IDs
+        :return: list of statuses in the order of `ids`
+        """
+
+    @abstractmethod
+    def set(self, ids: List[int], status: Union[str, None]
+            ) -> List[Union[str, None]]:
+        """
+        Set the status of `ids` and update :attr:`counts`. A batch is always
+        marked as a whole or not at all.
+
+        :param ids: item IDs
+        :param status: new status; `None` removes the record
+        :return: the previous statuses of `ids`
+        """
+
+    @abstractmethod
+    def load_counts(self) -> Dict[str, int]:
+        """
+        Read the number of items in each status from the ledger.
+
+        :return: item counts by status
+        """
+
+    def scan(self) -> Iterator[Tuple[int, str]]:
+        """
+        Iterate over all items with a record.
+
+        :return: iterator of `(id, status)` tuples in id order
+        """
+        for offset, codes in self._chunks():
+            for i in np.flatnonzero(codes):
+                yield offset + int(i), STATUSES[codes[i]]
+
+    def ids(self, status: str) -> List[int]:
+        """
+        IDs of all items with `status`.
+
+        :param status: item status
+        :return: list of item IDs
+        """
+        ids: List[int] = []
+        for offset, codes in self._chunks():
+            ids.extend((np.flatnonzero(codes == CODES[status]) + offset)
+                       .tolist())
+        return ids
+
+    @abstractmethod
+    def end(self) -> int:
+        """
+        Upper bound of the IDs of items with a record.
+
+        :return: item ID
+        """
+
+    def pending(self, start: int = 0) -> List[int]:
+        """
+        IDs from `start` up to :meth:`end` of items that have no record or
+        are served but not received.
+
+        :param start: first item ID
+        :return: list of item IDs
+        """
+        ids: List[int] = []
+        for offset, codes in self._chunks(start):
+            pending = np.flatnonzero(codes <= CODES[SERVED]) + offset
+            ids.extend(pending[pending >= start].tolist())
+        return ids
+
+    @abstractmethod
+    def first_incomplete(self, start: int, stop: int) -> int:
+        """
+        First item from `start` up to `stop` that is neither received nor
+        marked as an error.
+
+        :param start: first item ID to check
+        :param stop: item ID to stop at
+        :return: item ID or `stop` if all items are complete
+        """
+
+    @abstractmethod
+    def get_checkpoint(self) -> Union[Tuple[int, int], None]:
+        """
+        Reading checkpoint of the job: every item before it is complete.
+
+        :return: item ID and byte offset in the input, or None
+        """
+
+    @abstractmethod
+    def set_checkpoint(self, id_: int, offset: int):
+        """
+        Store the reading checkpoint of the job.
+
+        :param id_: item ID
+        :param offset: byte offset of the item in the input
+        """
+
+    @abstractmethod
+    def lease(self, ids: List[int], until: float):
+        """
+        Lease `ids` until `until`.
+
+        :param ids: item IDs
+        :param until: expiry time of the lease in seconds since the epoch
+        """
+
+    @abstractmethod
+    def extend(self, ids: List[int], until: float) -> int:
+        """
+        Extend the leases of `ids` that are still held until `until`.
+
+        :param ids: item IDs
+        :param until: expiry time of the lease in seconds since the epoch
+        :return: number of leases extended
+        """
+
+    @abstractmethod
+    def reclaim(self, n_items: int, now: float, until: float) -> List[int]:
+        """
+        Take up to `n_items` items whose lease has expired and lease them
+        again until `until`.
+
+        :param n_items: maximum number of items
+        :param now: current time in seconds since the epoch
+        :param until: expiry time of the new lease
+        :return: list of item IDs
+        """
+
+    @abstractmethod
+    def release(self, ids: List[int]):
+        """
+        Drop the leases of `ids`.
+
+        :param ids: item IDs
+        """
+
+    @abstractmethod
+    def delete(self):
+        """
+        Delete all item records of the job.
+        """
+
+    @abstractmethod
+    def recount(self) -> Dict[str, int]:
+        """
+        Rebuild the item counters from the statuses.
+
+        :return: item counts by status
+        """
+
+    def create(self):
+        """
+        Start the item records of a new or emptied job. Only backends with
+        more than one layout of item records need to mark it.
+        """
+
+    def migrate(self):
+        """
+        Move item records from older layouts into the current one. Only
+        backends with more than one layout of item records have anything to
+        migrate.
+        """
+
+    @abstractmethod
+    def _chunks(self, first: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+        # the statuses from item `first` on as `(first item id, codes)`
+        pass
+
+
+class ItemLedger(BaseItemLedger):
+    """
+    Item statuses of a single job. Every item takes two bits in a single
+    Redis string (``<job_name>:status``) addressed by item id, so a job with
+    50M items takes ~12.5MB and a single key instead of 50M keys. Reads and
+    writes of a batch are one round trip each. The number of items in each
+    status is kept in a hash (``<job_name>:counts``) that is updated in the
+    same script as the statuses, so it can be read without a scan.
+
+    Jobs logged with the old layout (one ``<job_name>:<item_id>`` key per
+    item) are converted by :meth:`migrate`.
+
+    Served items can hold a lease, kept in a sorted set
+    (``<job_name>:leases``) scored by the time it expires.
+
+    :param redis: redis connection
+    :param job_name: job name
+    """
+    def __init__(self, redis: Redis, job_name: str):
+        super().__init__(job_name)
+        self.redis = redis
+        self.key = f'{job_name}:status'
+        self.layout_key = f'{job_name}:layout'
+        self.counts_key = f'{job_name}:counts'
+        self.checkpoint_key = f'{job_name}:checkpoint'
+        self.leases_key = f'{job_name}:leases'
+        # version of the counters, so that those of a batch marked at the
+        # same time as a later one do not replace the later ones
+        self._version = 0
+        self._counts_lock = threading.Lock()
+        self._set_script = redis.register_script(_SET_SCRIPT)
+        self._reclaim_script = redis.register_script(_RECLAIM_SCRIPT)
+
+    def get(self, ids: List[int]) -> List[Union[str, None]]:
+        codes: List = []
+        for chunk in _chunks(ids, _BITFIELD_CHUNK):
+            args: List = []
+            for id_ in chunk:
+                args.extend(('GET', 'u2', f'#{id_}'))
+            codes.extend(self.redis.execute_command('BITFIELD', self.key,
+                                                    *args))
+        return [STATUSES[c] for c in codes]
+
+    def set(self, ids: List[int], status: Union[str, None]
+            ) -> List[Union[str, None]]:
+        """
+        Set the status of `ids` and update :attr:`counts`. Batches larger
+        than a single script call are written in one MULTI/EXEC transaction,
+        so a batch is always marked as a whole or not at all.
+
+        :param ids: item IDs
+        :param status: new status; `None` removes the record
+        :return: the previous statuses of `ids`
+        """
+        if not ids:
+            return []
+        code = CODES[status] if status else 0
+        keys = [self.key, self.counts_key]
+        pipe = self.redis.pipeline(transaction=True)
+        for chunk in _chunks(ids, _BITFIELD_CHUNK):
+            self._set_script(keys=keys, args=[code, *chunk], client=pipe)
+        results = pipe.execute()
+        counts, version = results[-1][:3], results[-1][3]
+        with self._counts_lock:
+            if version > self._version:
+                self.counts = dict(zip(STATUSES[1:], counts))
+                self._version = version
+        return [STATUSES[c] for result in results for c in result[4:]]
+
+    def load_counts(self) -> Dict[str, int]:
+        counts = self.redis.hgetall(self.counts_key)
+        with self._counts_lock:
+            self.counts = {
+                s: int(counts.get(str(c).encode('utf8'), 0))
+                for s, c in CODES.items()
+            }
+            self._version = int(counts.get(b'version', 0))
+        return self.counts
+
+    def end(self) -> int:
+        """
+        Upper bound of the IDs of items with a record: the statuses string
+        covers every item before it.
+
+        :return: item ID
+        """
+        return self.redis.strlen(self.key) * 4
+
+    def first_incomplete(self, start: int, stop: int) -> int:
+        """
+        First item from `start` up to `stop` that is neither received nor
+        marked as an error. The statuses are read in growing windows, so
+        finding an incomplete item close to `start` is cheap.
+
+        :param start: first item ID to check
+        :param stop: item ID to stop at
+        :return: item ID or `stop` if all items are complete
+        """
+        window = _WATERMARK_WINDOW
+        id_ = start
+        while id_ < stop:
+            first = id_ // 4
+            last = min((stop - 1) // 4, first + window - 1)
+            data = self.redis.getrange(self.key, first, last)
+            codes = unpack(data)[id_ - first * 4:stop - first * 4]
+            incomplete = np.flatnonzero(codes < CODES[RECEIVED])
+            if incomplete.size:
+                return id_ + int(incomplete[0])
+            if len(data) < last - first + 1:
+                # items past the end of the string have no record
+                return min(id_ + len(codes), stop)
+            id_ = (last + 1) * 4
+            window = min(window * 2, _SCAN_CHUNK)
+        return stop
+
+    def get_checkpoint(self) -> Union[Tuple[int, int], None]:
+        checkpoint = self.redis.get(self.checkpoint_key)
+        if not checkpoint:
+            return None
+        checkpoint = json.loads(checkpoint.decode('utf8'))
+        return checkpoint['id'], checkpoint['offset']
+
+    def set_checkpoint(self, id_: int, offset: int):
+        self.redis.set(self.checkpoint_key,
+                       json.dumps({'id': id_, 'offset': offset}))
+
+    def lease(self, ids: List[int], until: float):
+        if ids:
+            self.redis.zadd(self.leases_key, {id_: until for id_ in ids})
+
+    def extend(self, ids: List[int], until: float) -> int:
+        if not ids:
+            return 0
+        return self.redis.zadd(self.leases_key, {id_: until for id_ in ids},
+                               xx=True, ch=True)
+
+    def reclaim(self, n_items: int, now: float, until: float) -> List[int]:
+        if n_items < 1:
+            return []
+        ids = self._reclaim_script(keys=[self.leases_key],
+                                   args=[now, until, n_items])
+        return [int(id_) for id_ in ids]
+
+    def release(self, ids: List[int]):
+        for chunk in _chunks(ids, _BITFIELD_CHUNK):
+            self.redis.zrem(self.leases_key, *chunk)
+
+    def delete(self):
+        self.redis.delete(*self.keys_of(self.job_name))
+        with self._counts_lock:
+            self.counts = {s: 0 for s in CODES}
+            self._version = 0
+
+    def create(self):
+        """
+        Start the item records of a new or emptied job in the current layout,
+        so that :meth:`migrate` does not look for records in older layouts.
+        """
+        self.redis.set(self.layout_key, LAYOUT_VERSION)
+
+    @staticmethod
+    def keys_of(job_name: str) -> List[str]:
+        """
+        Redis keys holding the item records of a job.
+
+        :param job_name: job name
+        :return: list of keys
+        """
+        return [f'{job_name}:{suffix}'
+                for suffix in ('status', 'layout', 'counts', 'checkpoint',
+                               'leases')]
+
+    def _chunks(self, first: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+        # the packed statuses from item `first` on in chunks of `_SCAN_CHUNK`
+        # bytes as `(first item id, codes)`
+        start = first // 4
+        while True:
+            data = self.redis.getrange(self.key, start,
+                                       start + _SCAN_CHUNK - 1)
+            if not data:
+                break
+            yield start * 4, unpack(data)
+            if len(data) < _SCAN_CHUNK:
+                break
+            start += _SCAN_CHUNK
+
+    def recount(self) -> Dict[str, int]:
+        """
+        Rebuild the item counters from the statuses. This scans the whole
+        job, so it is only used when migrating.
+
+        :return: item counts by status
+        """
+        totals = np.zeros(4, dtype=np.int64)
+        for _, codes in self._chunks():
+            totals += np.bincount(codes, minlength=4)
+        self.redis.delete(self.counts_key)
+        self.redis.hset(self.counts_key, mapping={
+            c: int(totals[c]) for c in CODES.values()})
+        return self.load_counts()
+
+    def migrate(self):
+        """
+        Move item records from older layouts into this one: from one key per
+        item, or from a status string without counters. This is a no-op for
+        jobs that have already been migrated or were created or emptied with
+        the current layout.
+        """
+        layout = self.redis.get(self.layout_key)
+        if layout == LAYOUT_VERSION.encode('utf8'):
+            return
+        if layout is None:
+            self._migrate_keys()
+        self.recount()
+        self.redis.set(self.layout_key, LAYOUT_VERSION)
+
+    def _migrate_keys(self):
+        keys = []
+        for key in self.redis.scan_iter(f'{self.job_name}:*'):
+            suffix = key.decode('utf8').split(':', 1)[1]
+            if suffix.isdigit():
+                keys.append(key)
+        if keys:
+            logging.info(f'Migrating {len(keys)} items of job '
+                         f'"{self.job_name}" to ledger layout '
+                         f'{LAYOUT_VERSION}')
+        for chunk in _chunks(keys, _BITFIELD_CHUNK):
+            values = self.redis.mget(chunk)
+            by_status: dict = {}
+            for key, value in zip(chunk, values):
+                if not value:
+                    continue
+                # unknown values still block the item from being served
+                status = value.decode('utf8')
+                status = status if status in CODES else ERROR
+                id_ = int(key.decode('utf8').split(':', 1)[1])
+                by_status.setdefault(status, []).append(id_)
+            for status, ids in by_status.items():
+                self.set(ids, status)
+            self.redis.delete(*chunk)
+
+
+def unpack(data: bytes) -> np.ndarray:
+    """
+    Unpack a packed status string into an array of 2-bit codes, one per item.
+
+    :param data: packed statuses
+    :return: array of codes indexed by item id
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    return np.stack(
+        [(arr >> 6) & 3, (arr >> 4) & 3, (arr >> 2) & 3, arr & 3], axis=1
+    ).ravel()
+
+
+def pack(codes: np.ndarray) -> bytes:
+    """
+    Pack an array of 2-bit codes, four items to a byte; the inverse of
+    :func:`unpack`.
+
+    :param codes: array of codes indexed by item id
+    :return: packed statuses
+    """
+    padded = np.zeros(-(-len(codes) // 4) * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    return ((quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) |
+            quads[:, 3]).astype(np.uint8).tobytes()
+
+
+def _chunks(seq: List, size: int) -> Iterable[List]:
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
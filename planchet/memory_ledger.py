@@ -0,0 +1,405 @@
+import fnmatch
+import heapq
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterator, List, Set, Tuple, Union
+
+import numpy as np
+
+from .ledger import (
+    CODES, RECEIVED, STATUSES, BaseItemLedger, Ledger, pack, unpack
+)
+
+# version of the snapshot file format
+SNAPSHOT_VERSION = 1
+# number of items copied at a time when scanning
+_SCAN_ITEMS = 2 ** 22
+# initial number of items of a status array
+_MIN_CAPACITY = 2 ** 10
+
+
+class _JobState:
+    # item statuses, counters, checkpoint and leases of a job; statuses are
+    # one byte per item in an array that grows by doubling
+    def __init__(self):
+        self.codes = np.zeros(_MIN_CAPACITY, dtype=np.uint8)
+        self.size = 0
+        self.counts = np.zeros(4, dtype=np.int64)
+        self.checkpoint: Union[Tuple[int, int], None] = None
+        self.leases: Dict[int, float] = {}
+        # (until, id) of every lease given; entries whose lease was changed
+        # or dropped since are skipped when popped
+        self.expiry: List[Tuple[float, int]] = []
+
+    def reserve(self, n_items: int):
+        if n_items > len(self.codes):
+            codes = np.zeros(max(n_items, 2 * len(self.codes)),
+                             dtype=np.uint8)
+            codes[:self.size] = self.codes[:self.size]
+            self.codes = codes
+
+    def hold(self, id_: int, until: float):
+        self.leases[id_] = until
+        heapq.heappush(self.expiry, (until, id_))
+
+    def compact(self):
+        if len(self.expiry) > 2 * len(self.leases) + _MIN_CAPACITY:
+            self.expiry = [(until, id_) for id_, until in self.leases.items()]
+            heapq.heapify(self.expiry)
+
+
+class MemoryLedger(Ledger):
+    """
+    Ledger kept in the memory of the process, for throwaway and benchmark
+    jobs where a round trip per batch is pure overhead. Item statuses take a
+    byte per item in an array indexed by item id.
+
+    The whole ledger is written to a snapshot file every `interval` seconds
+    if anything changed, after every change if `interval` is 0, and when it
+    is closed. The file is replaced atomically, so it always holds a complete
+    snapshot, and it is loaded when the ledger is made. A crash loses the
+    changes since the last snapshot: items served since then are served
+    again and items received since then are written again.
+
+    :param path: path to the snapshot file; None keeps no snapshots
+    :param interval: seconds between snapshots; 0 snapshots every change
+    """
+    def __init__(self, path: Union[str, None] = None, interval: float = 10.0):
+        self.path = path
+        self.interval = interval
+        self.records: Dict[str, bytes] = {}
+        self.jobs: Dict[str, _JobState] = {}
+        self.lock = threading.RLock()
+        self._version = 0
+        self._saved = 0
+        self._snapshot_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread: Union[threading.Thread, None] = None
+        if path and os.path.exists(path):
+            self.load()
+        if path and interval > 0:
+            self._thread = threading.Thread(target=self._snapshot_loop,
+                                            daemon=True)
+            self._thread.start()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        with self.lock:
+            return self.records.get(key)
+
+    def set(self, key: str, value: Union[str, bytes]):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf8')
+        with self.lock:
+            self.records[key] = value
+        self.changed()
+
+    def delete(self, *keys: str) -> int:
+        with self.lock:
+            deleted = sum(self.records.pop(key, None) is not None
+                          for key in keys)
+        if deleted:
+            self.changed()
+        return deleted
+
+    def scan_iter(self, match: str = '*') -> Iterator[bytes]:
+        with self.lock:
+            keys = [key for key in self.records
+                    if fnmatch.fnmatchcase(key, match)]
+        return (key.encode('utf8') for key in keys)
+
+    def flushdb(self):
+        with self.lock:
+            self.records.clear()
+            self.jobs.clear()
+        self.changed()
+
+    def ping(self) -> bool:
+        return True
+
+    def items(self, job_name: str) -> 'MemoryItemLedger':
+        return MemoryItemLedger(self, job_name)
+
+    def close(self):
+        """
+        Stop taking periodic snapshots and take a last one.
+        """
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.path and self._version != self._saved:
+            self.snapshot()
+
+    def state(self, job_name: str) -> _JobState:
+        """
+        Item records of a job, made empty if it has none.
+
+        :param job_name: job name
+        :return: job state
+        """
+        with self.lock:
+            state = self.jobs.get(job_name)
+            if state is None:
+                state = self.jobs[job_name] = _JobState()
+            return state
+
+    def changed(self):
+        """
+        Note a change of the ledger; it is snapshot right away if the
+        interval is 0.
+        """
+        with self.lock:
+            self._version += 1
+        if self.path and self.interval <= 0:
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Write the ledger to the snapshot file. The ledger is copied while it
+        is locked and written after, so it is only blocked for the copy.
+        """
+        with self._snapshot_lock:
+            with self.lock:
+                version = self._version
+                records = dict(self.records)
+                jobs = {job_name: (state.codes[:state.size].copy(),
+                                   state.size, state.checkpoint,
+                                   dict(state.leases))
+                        for job_name, state in self.jobs.items()
+                        if state.size or state.checkpoint or state.leases}
+            if version == self._saved:
+                return
+            meta: Dict = {
+                'version': SNAPSHOT_VERSION,
+                # latin-1 maps every byte to a character and back
+                'records': {key: value.decode('latin-1')
+                            for key, value in records.items()},
+                'jobs': [],
+            }
+            arrays: Dict[str, np.ndarray] = {}
+            for i, (job_name, (codes, size, checkpoint, leases)) in \
+                    enumerate(jobs.items()):
+                meta['jobs'].append({'name': job_name, 'size': size,
+                                     'checkpoint': checkpoint})
+                arrays[f'codes_{i}'] = np.frombuffer(pack(codes),
+                                                     dtype=np.uint8)
+                arrays[f'lease_ids_{i}'] = np.fromiter(
+                    leases.keys(), dtype=np.int64, count=len(leases))
+                arrays[f'lease_until_{i}'] = np.fromiter(
+                    leases.values(), dtype=np.float64, count=len(leases))
+            arrays['meta'] = np.frombuffer(
+                json.dumps(meta).encode('utf8'), dtype=np.uint8)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'wb') as fh:
+                np.savez(fh, **arrays)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp_path, self.path)
+            self._saved = version
+
+    def load(self):
+        """
+        Replace the contents of the ledger with the snapshot file.
+        """
+        with np.load(self.path, allow_pickle=False) as data:
+            meta = json.loads(data['meta'].tobytes().decode('utf8'))
+            if meta['version'] != SNAPSHOT_VERSION:
+                raise ValueError(f'Unknown snapshot version {meta["version"]} '
+                                 f'in {self.path}')
+            jobs = {}
+            for i, job in enumerate(meta['jobs']):
+                state = _JobState()
+                state.reserve(job['size'])
+                state.size = job['size']
+                codes = unpack(data[f'codes_{i}'].tobytes())[:state.size]
+                state.codes[:state.size] = codes
+                state.counts = np.bincount(codes, minlength=4) \
+                    .astype(np.int64)
+                if job['checkpoint'] is not None:
+                    state.checkpoint = tuple(job['checkpoint'])
+                for id_, until in zip(data[f'lease_ids_{i}'].tolist(),
+                                      data[f'lease_until_{i}'].tolist()):
+                    state.hold(id_, until)
+                jobs[job['name']] = state
+        with self.lock:
+            self.records = {key: value.encode('latin-1')
+                            for key, value in meta['records'].items()}
+            self.jobs = jobs
+            self._version = self._saved = 0
+        logging.info(f'Loaded {len(jobs)} jobs from ledger snapshot '
+                     f'{self.path}')
+
+    def _snapshot_loop(self):
+        while not self._closed.wait(self.interval):
+            try:
+                self.snapshot()
+            except OSError as e:
+                logging.error(f'Could not snapshot the ledger to '
+                              f'{self.path}: {e}')
+
+
+class MemoryItemLedger(BaseItemLedger):
+    """
+    Item statuses of a single job in a :class:`MemoryLedger`. The number of
+    items in each status is kept up to date with every change, and leases are
+    kept in a heap by expiry time.
+
+    :param ledger: memory ledger
+    :param job_name: job name
+    """
+    def __init__(self, ledger: MemoryLedger, job_name: str):
+        super().__init__(job_name)
+        self.ledger = ledger
+
+    @property
+    def _state(self) -> _JobState:
+        return self.ledger.state(self.job_name)
+
+    def get(self, ids: List[int]) -> List[Union[str, None]]:
+        if not ids:
+            return []
+        ids_ = np.asarray(ids, dtype=np.int64)
+        codes = np.zeros(len(ids_), dtype=np.uint8)
+        with self.ledger.lock:
+            state = self._state
+            within = ids_ < state.size
+            codes[within] = state.codes[ids_[within]]
+        return [STATUSES[c] for c in codes]
+
+    def set(self, ids: List[int], status: Union[str, None]
+            ) -> List[Union[str, None]]:
+        if not ids:
+            return []
+        code = CODES[status] if status else 0
+        ids_ = np.asarray(ids, dtype=np.int64)
+        # like a packed status string, records cover whole groups of 4 items
+        size = -(-(int(ids_.max()) + 1) // 4) * 4
+        with self.ledger.lock:
+            state = self._state
+            state.reserve(size)
+            state.size = max(state.size, size)
+            previous = state.codes[ids_]
+            unique = np.unique(ids_)
+            state.counts -= np.bincount(state.codes[unique], minlength=4)
+            state.counts[code] += len(unique)
+            state.codes[ids_] = code
+            self._load(state)
+        self.ledger.changed()
+        return [STATUSES[c] for c in previous]
+
+    def load_counts(self) -> Dict[str, int]:
+        with self.ledger.lock:
+            return self._load(self._state)
+
+    def end(self) -> int:
+        """
+        Upper bound of the IDs of items with a record: the status array
+        covers every item before it.
+
+        :return: item ID
+        """
+        with self.ledger.lock:
+            return self._state.size
+
+    def first_incomplete(self, start: int, stop: int) -> int:
+        with self.ledger.lock:
+            state = self._state
+            codes = state.codes[start:min(stop, state.size)]
+            incomplete = np.flatnonzero(codes < CODES[RECEIVED])
+            if incomplete.size:
+                return start + int(incomplete[0])
+            # items past the end have no record
+            return min(max(state.size, start), stop)
+
+    def get_checkpoint(self) -> Union[Tuple[int, int], None]:
+        with self.ledger.lock:
+            return self._state.checkpoint
+
+    def set_checkpoint(self, id_: int, offset: int):
+        with self.ledger.lock:
+            self._state.checkpoint = (id_, offset)
+        self.ledger.changed()
+
+    def lease(self, ids: List[int], until: float):
+        if not ids:
+            return
+        with self.ledger.lock:
+            state = self._state
+            for id_ in ids:
+                state.hold(id_, until)
+            state.compact()
+        self.ledger.changed()
+
+    def extend(self, ids: List[int], until: float) -> int:
+        extended = 0
+        with self.ledger.lock:
+            state = self._state
+            for id_ in ids:
+                held = state.leases.get(id_)
+                if held is not None and held != until:
+                    state.hold(id_, until)
+                    extended += 1
+            state.compact()
+        if extended:
+            self.ledger.changed()
+        return extended
+
+    def reclaim(self, n_items: int, now: float, until: float) -> List[int]:
+        ids: List[int] = []
+        taken: Set[int] = set()
+        with self.ledger.lock:
+            state = self._state
+            while state.expiry and state.expiry[0][0] <= now and \
+                    len(ids) < n_items:
+                expiry, id_ = heapq.heappop(state.expiry)
+                if state.leases.get(id_) != expiry or id_ in taken:
+                    continue
+                ids.append(id_)
+                taken.add(id_)
+            for id_ in ids:
+                state.hold(id_, until)
+        if ids:
+            self.ledger.changed()
+        return ids
+
+    def release(self, ids: List[int]):
+        if not ids:
+            return
+        with self.ledger.lock:
+            state = self._state
+            for id_ in ids:
+                state.leases.pop(id_, None)
+            state.compact()
+        self.ledger.changed()
+
+    def delete(self):
+        with self.ledger.lock:
+            self.ledger.jobs.pop(self.job_name, None)
+        self.counts = {s: 0 for s in CODES}
+        self.ledger.changed()
+
+    def recount(self) -> Dict[str, int]:
+        with self.ledger.lock:
+            state = self._state
+            state.counts = np.bincount(state.codes[:state.size],
+                                       minlength=4).astype(np.int64)
+            return self._load(state)
+
+    def _load(self, state: _JobState) -> Dict[str, int]:
+        self.counts = {s: int(state.counts[c]) for s, c in CODES.items()}
+        return self.counts
+
+    def _chunks(self, first: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+        # copies of the statuses from item `first` up to :meth:`end` in
+        # chunks of `_SCAN_ITEMS` items as `(first item id, codes)`
+        offset = first
+        while True:
+            with self.ledger.lock:
+                state = self._state
+                codes = state.codes[offset:min(offset + _SCAN_ITEMS,
+                                               state.size)].copy()
+            if not codes.size:
+                break
+            yield offset, codes
+            offset += len(codes)
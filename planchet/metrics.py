@@ -0,0 +1,216 @@
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterator, List, Mapping, Tuple
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+# number of seconds the item rates are averaged over
+RATE_WINDOW = 60.0
+
+READER = 'reader'
+LEDGER = 'ledger'
+WRITER = 'writer'
+TOTAL = 'total'
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets.
+
+    :param buckets: upper bounds of the buckets in seconds
+    """
+    def __init__(self, buckets: Tuple[float, ...] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        """
+        Count a value in its bucket.
+
+        :param value: value in seconds
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Cumulative counts of the buckets by upper bound, ``+Inf`` last.
+
+        :return: list of (upper bound, count) tuples
+        """
+        total = 0
+        result = []
+        for bound, count in zip((*map(repr, self.buckets), '+Inf'),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class JobMetrics:
+    """
+    Timings and counters of a job. Serving and receiving a batch are timed
+    as operations, split into the stages spent in the reader, the ledger and
+    the writer. Operations run in several threads at once are timed
+    separately.
+
+    :param job_name: job name
+    """
+    def __init__(self, job_name: str):
+        self.job_name = job_name
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.items: Dict[str, int] = {'served': 0, 'received': 0}
+        self.ledger_calls = 0
+        self._recent: Deque[Tuple[float, str, int]] = deque()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def operation(self, name: str) -> Iterator[None]:
+        """
+        Time an operation and the stages run within it.
+
+        :param name: operation name, e.g. ``serve``
+        """
+        stages: Dict[str, float] = {}
+        self._local.stages = stages
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages[TOTAL] = time.perf_counter() - start
+            self._local.stages = None
+            with self._lock:
+                for stage, seconds in stages.items():
+                    key = (name, stage)
+                    if key not in self.latency:
+                        self.latency[key] = Histogram()
+                    self.latency[key].observe(seconds)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time a stage of the current operation. A ledger stage is a single
+        call to the ledger.
+
+        :param name: ``reader``, ``ledger`` or ``writer``
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stages = getattr(self._local, 'stages', None)
+            if stages is not None:
+                stages[name] = stages.get(name, 0.0) + seconds
+            if name == LEDGER:
+                with self._lock:
+                    self.ledger_calls += 1
+
+    def count(self, direction: str, n_items: int):
+        """
+        Count items served or received.
+
+        :param direction: ``served`` or ``received``
+        :param n_items: number of items
+        """
+        if not n_items:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self.items[direction] += n_items
+            self._recent.append((now, direction, n_items))
+            self._expire(now)
+
+    def rates(self) -> Dict[str, float]:
+        """
+        Items served and received per second over the last `RATE_WINDOW`
+        seconds.
+
+        :return: rates by direction
+        """
+        rates = {direction: 0.0 for direction in self.items}
+        with self._lock:
+            self._expire(time.monotonic())
+            for _, direction, n_items in self._recent:
+                rates[direction] += n_items / RATE_WINDOW
+        return rates
+
+    def _expire(self, now: float):
+        while self._recent and self._recent[0][0] < now - RATE_WINDOW:
+            self._recent.popleft()
+
+
+def render(jobs: Mapping, waiting: Mapping[str, int] = None) -> str:
+    """
+    Render the metrics of `jobs` in the Prometheus text format.
+
+    :param jobs: jobs by name
+    :param waiting: number of requests waiting for each job
+    :return: metrics text
+    """
+    waiting = waiting or {}
+    families: Dict[str, Tuple[str, str, List[str]]] = {}
+
+    def sample(name, kind, doc, labels, value, suffix=''):
+        if name not in families:
+            families[name] = (kind, doc, [])
+        label_text = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+        families[name][2].append(f'{name}{suffix}{{{label_text}}} {value}')
+
+    for job_name, job in sorted(jobs.items()):
+        metrics: JobMetrics = job.metrics
+        job_label = ('job', job_name)
+        with metrics._lock:
+            latency = sorted(metrics.latency.items())
+            items = dict(metrics.items)
+            ledger_calls = metrics.ledger_calls
+        for (operation, stage), histogram in latency:
+            name = f'planchet_{operation}_seconds'
+            doc = f'Time taken to {operation} a batch, in total and by stage.'
+            labels = [job_label, ('stage', stage)]
+            for bound, count in histogram.cumulative():
+                sample(name, 'histogram', doc, labels + [('le', bound)],
+                       count, '_bucket')
+            sample(name, 'histogram', doc, labels, histogram.sum, '_sum')
+            sample(name, 'histogram', doc, labels, histogram.count, '_count')
+        for direction, n_items in items.items():
+            sample('planchet_items_total', 'counter',
+                   'Items served or received.',
+                   [job_label, ('direction', direction)], n_items)
+        for direction, rate in metrics.rates().items():
+            sample('planchet_items_per_second', 'gauge',
+                   f'Items served or received per second over the last '
+                   f'{RATE_WINDOW:g} seconds.',
+                   [job_label, ('direction', direction)], rate)
+        sample('planchet_ledger_round_trips_total', 'counter',
+               'Calls to the ledger; each is a single round trip unless a '
+               'batch spans several chunks.', [job_label], ledger_calls)
+        queues = {**job.queues, 'waiting': waiting.get(job_name, 0)}
+        for queue, depth in queues.items():
+            sample('planchet_queue_depth', 'gauge',
+                   'Items or requests queued in a job.',
+                   [job_label, ('queue', queue)], depth)
+        sample('planchet_written_bytes_total', 'counter',
+               'Bytes written to the output of a job.', [job_label],
+               getattr(job.writer, 'written', 0))
+    lines = []
+    for name, (kind, doc, samples) in families.items():
+        lines.append(f'# HELP {name} {doc}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
@@ -0,0 +1,186 @@
+import logging
+from typing import Callable, Iterable, List, Union
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+from .util import Compressor, Decompressor, encodings, red
+
+
+class BodySizeLimit:
+    """
+    ASGI middleware that rejects requests with a body larger than `max_size`
+    bytes with a 413 response. A request that declares a larger
+    ``Content-Length`` is rejected before its body is read; the bytes of any
+    other body are counted as they are received, so a body sent in chunks is
+    stopped as soon as it goes over the limit. Either way, nothing is parsed.
+
+    :param app: ASGI application
+    :param max_size: maximum body size in bytes
+    :param exclude: paths without a limit, e.g. of endpoints that read their
+       body as a stream
+    """
+    def __init__(self, app: Callable, max_size: int,
+                 exclude: Iterable[str] = ()):
+        self.app = app
+        self.max_size = max_size
+        self.exclude = set(exclude)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.exclude:
+            return await self.app(scope, receive, send)
+        headers = dict(scope['headers'])
+        length = headers.get(b'content-length')
+        if length is not None and length.isdigit() and \
+                int(length) > self.max_size:
+            response = JSONResponse({'detail': self._message(int(length))},
+                                    status_code=413)
+            return await response(scope, receive, send)
+        size = 0
+
+        async def limited_receive():
+            nonlocal size
+            message = await receive()
+            if message['type'] == 'http.request':
+                size += len(message.get('body', b''))
+                if size > self.max_size:
+                    raise HTTPException(413, self._message(size))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+    def _message(self, size: int) -> str:
+        msg = f'Payload must be less than {self.max_size} bytes; ' \
+              f'received {size} bytes or more.'
+        logging.error(red(msg))
+        return msg
+
+
+class Compression:
+    """
+    ASGI middleware for compressed request and response bodies. A request
+    body with a ``Content-Encoding`` of `gzip` or `zstd` is decompressed as it
+    is received, in parts of at most `CHUNK_SIZE` bytes. A response is
+    compressed in the first of `preferred` that the client accepts in
+    ``Accept-Encoding`` if its body is at least `min_size` bytes; a streamed
+    response is compressed part by part, so every part can be read as soon as
+    it arrives.
+
+    :param app: ASGI application
+    :param min_size: minimum size in bytes of a compressed response body
+    :param preferred: response encodings in order of preference; all
+       supported ones if None, none if empty
+    """
+    CHUNK_SIZE = 2**16
+
+    def __init__(self, app: Callable, min_size: int = 1024,
+                 preferred: Union[List[str], None] = None):
+        self.app = app
+        self.min_size = min_size
+        supported = encodings()
+        self.encodings = supported if preferred is None else \
+            [e for e in preferred if e in supported]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        encoding = headers.get('content-encoding', 'identity').lower()
+        if encoding != 'identity':
+            if encoding not in encodings():
+                response = JSONResponse(
+                    {'detail': f'Unsupported content encoding: {encoding}'},
+                    status_code=415)
+                return await response(scope, receive, send)
+            scope, receive = self._decompressed(scope, receive, encoding)
+        accepted = self._accepted(headers.get('accept-encoding', ''))
+        if accepted is not None:
+            send = _CompressedSend(send, accepted, self.min_size)
+        await self.app(scope, receive, send)
+
+    def _decompressed(self, scope, receive, encoding: str):
+        # the body is passed on decompressed and without its original length,
+        # in parts of at most `CHUNK_SIZE` bytes, so that a size limit further
+        # in stops a compressed body as soon as it has decompressed too much
+        decompressor = Decompressor(encoding)
+        scope = dict(scope)
+        scope['headers'] = [
+            (k, v) for k, v in scope['headers']
+            if k not in (b'content-encoding', b'content-length')
+        ]
+        more_body = True
+
+        async def decompressed_receive():
+            nonlocal more_body
+            data = b''
+            while True:
+                if not decompressor.pending and more_body:
+                    message = await receive()
+                    if message['type'] != 'http.request':
+                        return message
+                    data = message.get('body', b'')
+                    more_body = message.get('more_body', False)
+                try:
+                    body = decompressor.decompress(data, self.CHUNK_SIZE)
+                except ValueError as e:
+                    raise HTTPException(400, str(e))
+                data = b''
+                if body or not more_body and not decompressor.pending:
+                    return {'type': 'http.request', 'body': body,
+                            'more_body': more_body or decompressor.pending}
+
+        return scope, decompressed_receive
+
+    def _accepted(self, accept_encoding: str) -> Union[str, None]:
+        accepted = set()
+        for token in accept_encoding.lower().split(','):
+            name, _, params = token.strip().partition(';')
+            if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00',
+                                               'q=0.000'):
+                accepted.add(name.strip())
+        for encoding in self.encodings:
+            if encoding in accepted:
+                return encoding
+        return None
+
+
+class _CompressedSend:
+    # holds the start of a response until the first part of its body shows
+    # whether it is compressed
+    def __init__(self, send: Callable, encoding: str, min_size: int):
+        self.send = send
+        self.encoding = encoding
+        self.min_size = min_size
+        self.start: Union[dict, None] = None
+        self.compressor: Union[Compressor, None] = None
+
+    async def __call__(self, message):
+        if message['type'] == 'http.response.start':
+            self.start = message
+            return
+        if message['type'] != 'http.response.body':
+            return await self.send(message)
+        body = message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if self.start is not None:
+            start, self.start = self.start, None
+            headers = MutableHeaders(scope=start)
+            if 'content-encoding' in headers or \
+                    (not more_body and len(body) < self.min_size):
+                await self.send(start)
+                return await self.send(message)
+            self.compressor = Compressor(self.encoding)
+            headers['content-encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            body = self.compressor.compress(body, end=not more_body)
+            if more_body:
+                del headers['content-length']
+            else:
+                headers['content-length'] = str(len(body))
+            await self.send(start)
+            return await self.send({**message, 'body': body})
+        if self.compressor is not None:
+            body = self.compressor.compress(body, end=not more_body)
+            message = {**message, 'body': body}
+        await self.send(message)
@@ -0,0 +1,114 @@
+import json
+import uuid
+from typing import Dict, List, Tuple
+
+from redis.asyncio import Redis as AsyncRedis
+
+# Makes the caller the owner of KEYS[1] if it has no owner or renews it if the
+# caller already owns it. Returns the owner record and 1 if it was just
+# taken, 0 otherwise.
+_ACQUIRE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if not owner then
+    redis.call('SET', KEYS[1], ARGV[2], 'PX', ARGV[3])
+    return {ARGV[2], 1}
+end
+if cjson.decode(owner)['id'] == ARGV[1] then
+    redis.call('PEXPIRE', KEYS[1], ARGV[3])
+end
+return {owner, 0}
+"""
+
+# Renews every key in KEYS owned by the caller and returns the ones that are
+# not.
+_RENEW_SCRIPT = """
+local lost = {}
+for _, key in ipairs(KEYS) do
+    local owner = redis.call('GET', key)
+    if owner and cjson.decode(owner)['id'] == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+    else
+        lost[#lost + 1] = key
+    end
+end
+return lost
+"""
+
+# Deletes KEYS[1] if the caller owns it.
+_RELEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and cjson.decode(owner)['id'] == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class Ownership:
+    """
+    Ownership of jobs by service instances sharing a ledger. A job is owned by
+    a single instance at a time through an expiring ``OWNER:<job_name>`` key
+    holding the id and URL of the owner. The owner renews it while it runs;
+    once an instance dies its jobs can be taken over by another instance
+    after `ttl` seconds.
+
+    :param url: URL other instances can reach this instance at
+    :param ttl: seconds the ownership of a job lasts without renewal
+    """
+    def __init__(self, url: str, ttl: float = 30):
+        self.id = uuid.uuid4().hex
+        self.url = url
+        self.ttl = ttl
+        self.record = json.dumps({'id': self.id, 'url': url})
+
+    @staticmethod
+    def key(job_name: str) -> str:
+        return f'OWNER:{job_name}'
+
+    async def acquire(self, ledger: AsyncRedis, job_name: str
+                      ) -> Tuple[Dict, bool]:
+        """
+        Take or renew the ownership of a job unless another instance owns it.
+
+        :param ledger: async redis connection
+        :param job_name: job name
+        :return: the owner record and whether the ownership was just taken
+            by this instance
+        """
+        owner, taken = await ledger.eval(
+            _ACQUIRE_SCRIPT, 1, self.key(job_name), self.id, self.record,
+            int(self.ttl * 1000))
+        return json.loads(owner), bool(taken)
+
+    def owns(self, owner: Dict) -> bool:
+        """
+        True if `owner` is this instance.
+
+        :param owner: owner record
+        """
+        return owner['id'] == self.id
+
+    async def renew(self, ledger: AsyncRedis, job_names: List[str]
+                    ) -> List[str]:
+        """
+        Renew the ownership of jobs.
+
+        :param ledger: async redis connection
+        :param job_names: names of the jobs owned by this instance
+        :return: names of the jobs this instance does not own any more
+        """
+        if not job_names:
+            return []
+        keys = [self.key(name) for name in job_names]
+        lost = await ledger.eval(_RENEW_SCRIPT, len(keys), *keys, self.id,
+                                 int(self.ttl * 1000))
+        return [key.decode('utf8').split(':', 1)[1] for key in lost]
+
+    async def release(self, ledger: AsyncRedis, job_name: str):
+        """
+        Give up the ownership of a job if this instance owns it.
+
+        :param ledger: async redis connection
+        :param job_name: job name
+        """
+        await ledger.eval(_RELEASE_SCRIPT, 1, self.key(job_name), self.id)
@@ -0,0 +1,362 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import (
+    Dict, Iterator, List, Tuple, Union
+)
+
+import numpy as np
+
+from .ledger import (
+    CODES, RECEIVED, STATUSES, BaseItemLedger, Ledger, pack, unpack
+)
+
+# number of items in a page of packed statuses (4 per byte)
+PAGE_ITEMS = 2 ** 14
+# maximum number of parameters of a single statement
+_PARAMS_CHUNK = 500
+# number of pages fetched at a time when scanning
+_SCAN_PAGES = 64
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY, value BLOB NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pages (
+    job TEXT NOT NULL, page INTEGER NOT NULL, data BLOB NOT NULL,
+    PRIMARY KEY (job, page)
+);
+CREATE TABLE IF NOT EXISTS counts (
+    job TEXT NOT NULL, code INTEGER NOT NULL, n INTEGER NOT NULL,
+    PRIMARY KEY (job, code)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job TEXT PRIMARY KEY, id INTEGER NOT NULL, position INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS leases (
+    job TEXT NOT NULL, id INTEGER NOT NULL, until REAL NOT NULL,
+    PRIMARY KEY (job, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS leases_until ON leases (job, until, id);
+"""
+
+
+class SqliteLedger(Ledger):
+    """
+    Ledger embedded in a single SQLite file, for running Planchet on a single
+    node without a Redis service. Every ledger operation is a local call
+    instead of a network round trip. The file is used in WAL mode, so a
+    crash loses at most the last transactions but never corrupts the ledger.
+    A single connection is shared by all threads, one operation at a time.
+
+    :param path: path to the database file; ``:memory:`` keeps it in memory
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False,
+                                    isolation_level=None)
+        self.lock = threading.RLock()
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.conn.executescript(_SCHEMA)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """
+        Run the statements of the block in a single transaction that is
+        rolled back if the block raises.
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+
+    def query(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        """
+        Run a query and fetch all its rows.
+
+        :param sql: query
+        :param params: query parameters
+        :return: list of rows
+        """
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        rows = self.query('SELECT value FROM records WHERE key = ?', (key,))
+        return bytes(rows[0][0]) if rows else None
+
+    def set(self, key: str, value: Union[str, bytes]):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf8')
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO records (key, value) VALUES (?, ?)',
+                (key, value))
+
+    def delete(self, *keys: str) -> int:
+        deleted = 0
+        with self.transaction() as conn:
+            for chunk in _chunks(list(keys), _PARAMS_CHUNK):
+                deleted += conn.execute(
+                    f'DELETE FROM records WHERE key IN ({_marks(chunk)})',
+                    chunk).rowcount
+        return deleted
+
+    def scan_iter(self, match: str = '*') -> Iterator[bytes]:
+        # GLOB takes the same patterns as the Redis SCAN command
+        rows = self.query('SELECT key FROM records WHERE key GLOB ?',
+                          (match,))
+        return (key.encode('utf8') for key, in rows)
+
+    def flushdb(self):
+        with self.transaction() as conn:
+            for table in ('records', 'pages', 'counts', 'checkpoints',
+                          'leases'):
+                conn.execute(f'DELETE FROM {table}')
+
+    def ping(self) -> bool:
+        self.query('SELECT 1')
+        return True
+
+    def items(self, job_name: str) -> 'SqliteItemLedger':
+        return SqliteItemLedger(self, job_name)
+
+    def close(self):
+        """
+        Close the database file.
+        """
+        with self.lock:
+            self.conn.close()
+
+
+class SqliteItemLedger(BaseItemLedger):
+    """
+    Item statuses of a single job in a :class:`SqliteLedger`. Statuses are
+    packed two bits to an item like in Redis, in pages of `PAGE_ITEMS` items
+    that are read and written whole, and the number of items in each status
+    is kept in the same transaction as the statuses.
+
+    :param ledger: SQLite ledger
+    :param job_name: job name
+    """
+    def __init__(self, ledger: SqliteLedger, job_name: str):
+        super().__init__(job_name)
+        self.ledger = ledger
+
+    def get(self, ids: List[int]) -> List[Union[str, None]]:
+        if not ids:
+            return []
+        ids_ = np.asarray(ids, dtype=np.int64)
+        codes = np.zeros(len(ids_), dtype=np.uint8)
+        with self.ledger.lock:
+            pages = self._read(ids_ // PAGE_ITEMS)
+        for page, page_codes in pages.items():
+            mask = ids_ // PAGE_ITEMS == page
+            local = ids_[mask] - page * PAGE_ITEMS
+            found = local < len(page_codes)
+            codes[np.flatnonzero(mask)[found]] = page_codes[local[found]]
+        return [STATUSES[c] for c in codes]
+
+    def set(self, ids: List[int], status: Union[str, None]
+            ) -> List[Union[str, None]]:
+        """
+        Set the status of `ids` and update :attr:`counts`. A batch is always
+        marked as a whole or not at all.
+
+        :param ids: item IDs
+        :param status: new status; `None` removes the record
+        :return: the previous statuses of `ids`
+        """
+        if not ids:
+            return []
+        code = CODES[status] if status else 0
+        ids_ = np.asarray(ids, dtype=np.int64)
+        previous = np.zeros(len(ids_), dtype=np.uint8)
+        delta = np.zeros(4, dtype=np.int64)
+        with self.ledger.transaction() as conn:
+            pages = self._read(ids_ // PAGE_ITEMS)
+            rows = []
+            for page in np.unique(ids_ // PAGE_ITEMS).tolist():
+                mask = ids_ // PAGE_ITEMS == page
+                local = ids_[mask] - page * PAGE_ITEMS
+                codes = pages.get(page, np.zeros(0, dtype=np.uint8))
+                size = -(-(int(local.max()) + 1) // 4) * 4
+                if size > len(codes):
+                    codes = np.concatenate(
+                        [codes, np.zeros(size - len(codes), dtype=np.uint8)])
+                previous[mask] = codes[local]
+                unique = np.unique(local)
+                delta -= np.bincount(codes[unique], minlength=4)
+                delta[code] += len(unique)
+                codes[local] = code
+                rows.append((self.job_name, page, pack(codes)))
+            conn.executemany(
+                'INSERT OR REPLACE INTO pages (job, page, data) '
+                'VALUES (?, ?, ?)', rows)
+            conn.executemany(
+                'INSERT INTO counts (job, code, n) VALUES (?, ?, ?) '
+                'ON CONFLICT (job, code) DO UPDATE SET n = n + excluded.n',
+                [(self.job_name, c, int(delta[c])) for c in CODES.values()
+                 if delta[c]])
+            self.load_counts()
+        return [STATUSES[c] for c in previous]
+
+    def load_counts(self) -> Dict[str, int]:
+        counts = dict(self.ledger.query(
+            'SELECT code, n FROM counts WHERE job = ?', (self.job_name,)))
+        self.counts = {s: int(counts.get(c, 0)) for s, c in CODES.items()}
+        return self.counts
+
+    def end(self) -> int:
+        """
+        Upper bound of the IDs of items with a record: the stored pages cover
+        every item before it.
+
+        :return: item ID
+        """
+        rows = self.ledger.query(
+            'SELECT page, length(data) FROM pages WHERE job = ? '
+            'ORDER BY page DESC LIMIT 1', (self.job_name,))
+        if not rows:
+            return 0
+        page, size = rows[0]
+        return page * PAGE_ITEMS + size * 4
+
+    def first_incomplete(self, start: int, stop: int) -> int:
+        end = start
+        for offset, codes in self._chunks(start):
+            if offset >= stop:
+                return stop
+            first = max(start - offset, 0)
+            last = min(stop - offset, len(codes))
+            incomplete = np.flatnonzero(codes[first:last] < CODES[RECEIVED])
+            if incomplete.size:
+                return offset + first + int(incomplete[0])
+            end = offset + len(codes)
+        # items past the last page have no record
+        return min(max(end, start), stop)
+
+    def get_checkpoint(self) -> Union[Tuple[int, int], None]:
+        rows = self.ledger.query(
+            'SELECT id, position FROM checkpoints WHERE job = ?',
+            (self.job_name,))
+        return tuple(rows[0]) if rows else None
+
+    def set_checkpoint(self, id_: int, offset: int):
+        with self.ledger.transaction() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO checkpoints (job, id, position) '
+                'VALUES (?, ?, ?)', (self.job_name, id_, offset))
+
+    def lease(self, ids: List[int], until: float):
+        if not ids:
+            return
+        with self.ledger.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO leases (job, id, until) '
+                'VALUES (?, ?, ?)',
+                [(self.job_name, id_, until) for id_ in ids])
+
+    def extend(self, ids: List[int], until: float) -> int:
+        if not ids:
+            return 0
+        with self.ledger.transaction() as conn:
+            return conn.executemany(
+                'UPDATE leases SET until = ? '
+                'WHERE job = ? AND id = ? AND until != ?',
+                [(until, self.job_name, id_, until) for id_ in ids]).rowcount
+
+    def reclaim(self, n_items: int, now: float, until: float) -> List[int]:
+        if n_items < 1:
+            return []
+        with self.ledger.transaction() as conn:
+            ids = [id_ for id_, in conn.execute(
+                'SELECT id FROM leases WHERE job = ? AND until <= ? '
+                'ORDER BY until, id LIMIT ?', (self.job_name, now, n_items))]
+            conn.executemany(
+                'UPDATE leases SET until = ? WHERE job = ? AND id = ?',
+                [(until, self.job_name, id_) for id_ in ids])
+        return ids
+
+    def release(self, ids: List[int]):
+        if not ids:
+            return
+        with self.ledger.transaction() as conn:
+            conn.executemany('DELETE FROM leases WHERE job = ? AND id = ?',
+                             [(self.job_name, id_) for id_ in ids])
+
+    def delete(self):
+        with self.ledger.transaction() as conn:
+            for table in ('pages', 'counts', 'checkpoints', 'leases'):
+                conn.execute(f'DELETE FROM {table} WHERE job = ?',
+                             (self.job_name,))
+        self.counts = {s: 0 for s in CODES}
+
+    def recount(self) -> Dict[str, int]:
+        """
+        Rebuild the item counters from the statuses. This scans the whole
+        job.
+
+        :return: item counts by status
+        """
+        totals = np.zeros(4, dtype=np.int64)
+        for _, codes in self._chunks():
+            totals += np.bincount(codes, minlength=4)
+        with self.ledger.transaction() as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO counts (job, code, n) '
+                'VALUES (?, ?, ?)',
+                [(self.job_name, c, int(totals[c])) for c in CODES.values()])
+        return self.load_counts()
+
+    def _read(self, pages: np.ndarray) -> Dict[int, np.ndarray]:
+        # the unpacked statuses of the stored pages among `pages`
+        result: Dict[int, np.ndarray] = {}
+        for chunk in _chunks(np.unique(pages).tolist(), _PARAMS_CHUNK):
+            rows = self.ledger.conn.execute(
+                f'SELECT page, data FROM pages WHERE job = ? '
+                f'AND page IN ({_marks(chunk)})', (self.job_name, *chunk))
+            for page, data in rows:
+                result[page] = unpack(data).copy()
+        return result
+
+    def _chunks(self, first: int = 0) -> Iterator[Tuple[int, np.ndarray]]:
+        # the statuses from the page of item `first` on as `(first item id,
+        # codes)`, a page at a time, up to :meth:`end`: pages before the last
+        # one are padded to full pages, and pages without a record are zeros
+        next_page = first // PAGE_ITEMS
+        held: Union[Tuple[int, np.ndarray], None] = None
+        while True:
+            rows = self.ledger.query(
+                'SELECT page, data FROM pages WHERE job = ? AND page >= ? '
+                'ORDER BY page LIMIT ?',
+                (self.job_name, next_page, _SCAN_PAGES))
+            for page, data in rows:
+                if held is not None:
+                    codes = np.zeros(PAGE_ITEMS, dtype=np.uint8)
+                    codes[:len(held[1])] = held[1]
+                    yield held[0] * PAGE_ITEMS, codes
+                for missing in range(next_page, page):
+                    yield missing * PAGE_ITEMS, \
+                        np.zeros(PAGE_ITEMS, dtype=np.uint8)
+                held = (page, unpack(data))
+                next_page = page + 1
+            if len(rows) < _SCAN_PAGES:
+                break
+        if held is not None:
+            yield held[0] * PAGE_ITEMS, held[1]
+
+
+def _marks(seq: List) -> str:
+    return ', '.join('?' * len(seq))
+
+
+def _chunks(seq: List, size: int) -> Iterator[List]:
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
@@ -1,15 +1,20 @@
-from typing import Tuple, Union
+import json
+import zlib
+from typing import Any, List, Tuple, Union
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 
+from planchet.config import JSON_CODEC
+
 
 def requests_retry_session(
     retries: int = 3,
     backoff_factor: float = 0.3,
     status_forcelist: Tuple = (500, 502, 504),
     session: Union[requests.Session, None] = None,
+    pool_size: int = 10,
 ) -> requests.Session:
     session: requests.Session = session or requests.Session()
     retry: Retry = Retry(
@@ -19,12 +24,211 @@ def requests_retry_session(
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter: HTTPAdapter = HTTPAdapter(max_retries=retry)
+    adapter: HTTPAdapter = HTTPAdapter(max_retries=retry,
+                                       pool_maxsize=pool_size)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
 
+class JsonCodec:
+    """
+    JSON encoder and decoder shared by the readers, writers, the service and
+    the client. The `orjson` codec is much faster than the standard library
+    but writes compact JSON; `auto` uses it when it is installed.
+
+    :param name: `json`, `orjson` or `auto`
+    """
+    NAMES = ('json', 'orjson', 'auto')
+
+    def __init__(self, name: str = 'json'):
+        self.use(name)
+
+    def use(self, name: str):
+        """
+        Switch to another codec.
+
+        :param name: `json`, `orjson` or `auto`
+        """
+        if name not in self.NAMES:
+            raise ValueError(f'Unknown JSON codec "{name}"; use one of '
+                             f'{", ".join(self.NAMES)}')
+        orjson = None
+        if name != 'json':
+            try:
+                import orjson  # type: ignore
+            except ImportError:
+                if name == 'orjson':
+                    raise
+        self.name = 'orjson' if orjson else 'json'
+        self._orjson = orjson
+
+    def dumps(self, obj: Any) -> str:
+        """
+        Encode `obj` as a JSON string.
+        """
+        if self._orjson:
+            return self._orjson.dumps(obj).decode('utf8')
+        return json.dumps(obj)
+
+    def dumpb(self, obj: Any) -> bytes:
+        """
+        Encode `obj` as UTF-8 JSON bytes.
+        """
+        if self._orjson:
+            return self._orjson.dumps(obj)
+        return json.dumps(obj).encode('utf8')
+
+    def loads(self, data: Union[str, bytes]) -> Any:
+        """
+        Decode a JSON string or bytes. Invalid JSON raises
+        `json.JSONDecodeError` with either codec.
+        """
+        if self._orjson:
+            return self._orjson.loads(data)
+        return json.loads(data)
+
+
+codec = JsonCodec(JSON_CODEC)
+
+
+def encodings() -> List[str]:
+    """
+    Content encodings supported for request and response bodies, in order of
+    preference. `zstd` needs the `zstandard` package.
+
+    :return: list of encoding names
+    """
+    return ['zstd', 'gzip'] if _zstandard() else ['gzip']
+
+
+def _zstandard():
+    try:
+        import zstandard  # type: ignore
+    except ImportError:
+        return None
+    return zstandard
+
+
+class Compressor:
+    """
+    Incremental compressor of a body in a content encoding.
+
+    :param encoding: `gzip` or `zstd`
+    """
+    def __init__(self, encoding: str):
+        if encoding not in encodings():
+            raise ValueError(f'Unsupported content encoding "{encoding}"')
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._obj = zlib.compressobj(wbits=31)
+        else:
+            self._obj = _zstandard().ZstdCompressor().compressobj()
+
+    def compress(self, data: bytes, end: bool = False) -> bytes:
+        """
+        Compress the next part of the body. Every part can be decompressed as
+        soon as it arrives.
+
+        :param data: part of the body
+        :param end: True for the last part
+        :return: compressed part
+        """
+        if self.encoding == 'gzip':
+            mode = zlib.Z_FINISH if end else zlib.Z_SYNC_FLUSH
+        else:
+            zstandard = _zstandard()
+            mode = zstandard.COMPRESSOBJ_FLUSH_FINISH if end \
+                else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self._obj.compress(data) + self._obj.flush(mode)
+
+
+class Decompressor:
+    """
+    Incremental decompressor of a body in a content encoding. Invalid data
+    raises `ValueError`. The output of a call can be limited, so a small body
+    that decompresses to a huge one never has to be held in memory.
+
+    :param encoding: `gzip` or `zstd`
+    """
+    # zstd has no output limit of its own, so its input is fed a slice at a
+    # time; a slice decompresses to 512 KB at the very most
+    ZSTD_SLICE = 16
+
+    def __init__(self, encoding: str):
+        if encoding not in encodings():
+            raise ValueError(f'Unsupported content encoding "{encoding}"')
+        self.encoding = encoding
+        if encoding == 'gzip':
+            self._obj = zlib.decompressobj(wbits=31)
+        else:
+            self._obj = _zstandard().ZstdDecompressor().decompressobj()
+        self._tail = b''
+        self._out = b''
+        self._full = False
+
+    @property
+    def pending(self) -> bool:
+        """
+        Whether data given before may not be fully decompressed yet.
+        """
+        return bool(self._tail or self._out or self._full)
+
+    def decompress(self, data: bytes, max_length: int = 0) -> bytes:
+        """
+        Decompress the next part of the body. If `max_length` is set, the
+        rest of the output is kept for the next calls, which need no more
+        data while `pending` is True.
+
+        :param data: compressed part
+        :param max_length: maximum size in bytes of the output; none if 0
+        :return: decompressed part
+        """
+        data = self._tail + data if self._tail else data
+        self._tail = b''
+        try:
+            if self.encoding == 'gzip':
+                if not data and not self._full:
+                    return b''
+                out = self._obj.decompress(data, max_length)
+                self._tail = self._obj.unconsumed_tail
+                self._full = bool(max_length) and len(out) == max_length
+                return out
+            return self._decompress_zstd(data, max_length)
+        except Exception as e:
+            raise ValueError(f'Invalid {self.encoding} data: {e}') from e
+
+    def _decompress_zstd(self, data: bytes, max_length: int) -> bytes:
+        # zstd refuses any input once its frame has ended, so empty data is
+        # never passed on
+        if not max_length:
+            return self._obj.decompress(data) if data else b''
+        parts = [self._out]
+        size = len(self._out)
+        view = memoryview(data)
+        start = 0
+        while start < len(view) and size < max_length:
+            part = self._obj.decompress(view[start:start + self.ZSTD_SLICE])
+            start += self.ZSTD_SLICE
+            parts.append(part)
+            size += len(part)
+        self._tail = bytes(view[start:])
+        out = b''.join(parts)
+        self._out = out[max_length:]
+        return out[:max_length]
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """
+    Compress a whole body.
+
+    :param data: body
+    :param encoding: `gzip` or `zstd`
+    :return: compressed body
+    """
+    return Compressor(encoding).compress(data, end=True)
+
+
 # COLORS
 
 def red(s):  # pragma: no cover
@@ -9,7 +9,8 @@ os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 setup(
     name='planchet',
     version='0.4.0',
-    py_modules=['planchet.client', 'planchet.util'],
+    py_modules=['planchet.client', 'planchet.async_client',
+                'planchet.util', 'planchet.config'],
     zip_safe=True,
     include_package_data=False,
     description='Large Data Processing Assistant',
@@ -20,6 +21,8 @@ setup(
     ),
     long_description_content_type='text/markdown',
     install_requires=['requests==2.23.0'],
+    extras_require={'async': ['httpx>=0.23'],
+                    'zstd': ['zstandard>=0.18']},
     classifiers=[
         'Intended Audience :: Developers',
         'Operating System :: OS Independent',
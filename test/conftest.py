@@ -1,5 +1,8 @@
+import glob
+import json
 import os
 import random
+import weakref
 
 from fastapi.testclient import TestClient
 import pytest
@@ -12,6 +15,7 @@ from planchet.config import REDIS_HOST, REDIS_PORT, REDIS_PWD, MASTER_TOKEN
 from .const import (
     TEST_JOB_NAME, TOKEN_TEST_JOB_NAME, PLANCHET_HOST, PLANCHET_PORT
 )
+import app as service
 from app import app, LEDGER
 
 
@@ -68,10 +72,12 @@ def input_fp_client(data):
 def output_fp():
     fp = f'output_file.{str(random.randint(0, 1000))}.csv'
     yield fp
-    try:
-        os.remove(fp)
-    except FileNotFoundError:
-        pass
+    # sharded writers leave their shards next to the output file
+    for path in [fp] + glob.glob(f'{fp}.shard-*'):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 
 @pytest.fixture()
@@ -175,3 +181,29 @@ def reading_job(reader, ledger):
 def writing_job(writer, ledger):
     job_name = 'writing-job'
     yield Job(job_name, None, writer, ledger, WRITE_ONLY)
+
+
+@pytest.fixture()
+def service_ledger(monkeypatch):
+    server = fakeredis.FakeServer()
+    ledger = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(service, 'LEDGER', ledger)
+    monkeypatch.setattr(service, '_make_async_ledger',
+                        lambda: fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(service, '_LOOP_STATES', weakref.WeakKeyDictionary())
+    monkeypatch.setattr(service, 'JOB_LOG', {})
+    monkeypatch.setattr(service, 'OUTPUT_REGISTRY', set())
+    yield ledger
+    ledger.flushdb()
+
+
+@pytest.fixture()
+def jsonl_paths():
+    input_fp = 'async_input.jsonl'
+    output_fp = 'async_output.jsonl'
+    with open(input_fp, 'w') as fh:
+        fh.write('\n'.join(json.dumps({'k': i}) for i in range(25)))
+    yield input_fp, output_fp
+    for fp in (input_fp, output_fp):
+        if os.path.exists(fp):
+            os.remove(fp)
@@ -1,9 +1,13 @@
+import asyncio
 import glob
 import json
 import os
 
+import httpx
 import pytest
 
+import app as service
+
 from planchet.core import WRITE_ONLY, READ_ONLY
 from .const import TEST_JOB_NAME
 
@@ -390,3 +394,145 @@ def test_spurious_authentication_token(client, job_params, metadata):
                     f'batch_size=10').text
     )
     assert items
+
+
+def test_stream(service_ledger, jsonl_paths, monkeypatch):
+    input_fp, output_fp = jsonl_paths
+    monkeypatch.setattr(service, 'STREAM_CHUNK', 4)
+    params = {'job_name': 'stream-job'}
+
+    async def lines(items):
+        for item in items:
+            yield json.dumps(item).encode('utf8') + b'\n'
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.post('/scramble', params={
+                **params, 'reader_name': 'JsonlReader',
+                'writer_name': 'JsonlWriter'},
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp})
+            response = await client.post('/serve-stream', params={
+                **params, 'batch_size': 10})
+            assert response.headers['content-type'] == service.NDJSON
+            items = [json.loads(line) for line in response.text.splitlines()]
+            received = await client.post(
+                '/receive-stream', params=params, content=lines(items[:9]))
+            invalid = await client.post(
+                '/receive-stream', params=params,
+                content=lines([items[9], [1, 2, 3]]))
+            report = await client.get('/report', params=params)
+            return items, received.json(), invalid, report.json()
+
+    items, received, invalid, report = asyncio.run(run())
+    assert items == [[i, {'k': i}] for i in range(10)]
+    assert received == {'received': 9}
+    assert invalid.status_code == 400
+    assert report['received'] == 9
+    with open(output_fp) as fh:
+        assert [json.loads(line) for line in fh] == [{'k': i}
+                                                     for i in range(9)]
+
+
+def test_stream_lines():
+    async def chunks():
+        for chunk in [b'[0, {"k"', b': 0}]\n[1, {}]\n\n[2', b', []]']:
+            yield chunk
+
+    async def run():
+        return [line async for line in service._stream_lines(chunks())]
+
+    assert asyncio.run(run()) == [b'[0, {"k": 0}]', b'[1, {}]', b'',
+                                  b'[2, []]']
+
+
+def test_stream_long_line(service_ledger, jsonl_paths, monkeypatch):
+    input_fp, output_fp = jsonl_paths
+    monkeypatch.setattr(service, 'MAX_PACKAGE_SIZE', 1000)
+    params = {'job_name': 'stream-job'}
+    sent = []
+
+    async def line_without_end():
+        # an endless line is stopped once it is over the limit
+        for _ in range(100):
+            sent.append(100)
+            yield b'x' * 100
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.post('/scramble', params={
+                **params, 'reader_name': 'JsonlReader',
+                'writer_name': 'JsonlWriter'},
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp})
+            return await client.post('/receive-stream', params=params,
+                                     content=line_without_end())
+
+    response = asyncio.run(run())
+    assert response.status_code == 413
+    assert len(sent) < 100
+
+
+def test_stream_batch_size(service_ledger, jsonl_paths, monkeypatch):
+    input_fp, output_fp = jsonl_paths
+    monkeypatch.setattr(service, 'MAX_PACKAGE_SIZE', 50)
+    batches = []
+    receive_items = service._receive_items
+
+    async def counted(job_name, job, items, overwrite):
+        batches.append(len(items))
+        await receive_items(job_name, job, items, overwrite)
+
+    monkeypatch.setattr(service, '_receive_items', counted)
+    params = {'job_name': 'stream-job'}
+    body = b''.join(json.dumps([i, {'k': i}]).encode('utf8') + b'\n'
+                    for i in range(10))
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.post('/scramble', params={
+                **params, 'reader_name': 'JsonlReader',
+                'writer_name': 'JsonlWriter'},
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp})
+            await client.post('/serve', params={**params, 'batch_size': 10})
+            return await client.post('/receive-stream', params=params,
+                                     content=body)
+
+    response = asyncio.run(run())
+    # a stream larger than the size limit is written in batches under it
+    assert response.json() == {'received': 10}
+    assert batches == [4, 4, 2]
+
+
+def test_metrics(service_ledger, jsonl_paths):
+    input_fp, output_fp = jsonl_paths
+    params = {'job_name': 'metrics-job'}
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.post('/scramble', params={
+                **params, 'reader_name': 'JsonlReader',
+                'writer_name': 'JsonlWriter'},
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp})
+            items = (await client.post('/serve', params={
+                **params, 'batch_size': 10})).json()
+            await client.post('/receive', params={
+                **params, 'overwrite': False}, json=items)
+            return await client.get('/metrics')
+
+    response = asyncio.run(run())
+    assert response.headers['content-type'].startswith('text/plain')
+    assert 'planchet_items_total{job="metrics-job",direction="served"} 10' \
+        in response.text
+    assert 'planchet_receive_seconds_count{job="metrics-job",' \
+        'stage="writer"} 1' in response.text
@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import app as service
+from planchet.async_client import AsyncPlanchetClient
+
+JOB_NAME = 'async-test-job'
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip'])
+def test_batches(service_ledger, jsonl_paths, compression):
+    input_fp, output_fp = jsonl_paths
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with AsyncPlanchetClient('http://planchet', max_in_flight=2,
+                                       transport=transport,
+                                       compression=compression,
+                                       compression_min_size=0) as client:
+            response = await client.start_job(
+                JOB_NAME, {'input_file_path': input_fp,
+                           'output_file_path': output_fp},
+                'JsonlReader', 'JsonlWriter', clean_start=True)
+            assert response.status_code == 200, response.text
+            sizes = []
+            async for items in client.batches(JOB_NAME, 10):
+                sizes.append(len(items))
+                await client.send_background(JOB_NAME, items)
+            await client.drain()
+            return sizes, await client.get_job_report(JOB_NAME)
+
+    sizes, report = asyncio.run(run())
+    assert sizes == [10, 10, 5]
+    assert report == {'served': 0, 'received': 25, 'status': 'COMPLETE'}
+    with open(output_fp) as fh:
+        assert len(fh.readlines()) == 25
+
+
+def test_send_bounded():
+    in_flight = []
+    peak = []
+
+    async def handler(request):
+        in_flight.append(request)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return httpx.Response(200)
+
+    async def run():
+        transport = httpx.MockTransport(handler)
+        async with AsyncPlanchetClient('http://planchet', max_in_flight=3,
+                                       transport=transport) as client:
+            for i in range(10):
+                await client.send_background(JOB_NAME, [(i, {'k': i})])
+
+    asyncio.run(run())
+    assert len(peak) == 10
+    assert max(peak) == 3
+
+
+def test_retries():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(502 if len(calls) < 3 else 200, json=[])
+
+    async def run():
+        client = AsyncPlanchetClient('http://planchet',
+                                     transport=httpx.MockTransport(handler))
+        client.BACKOFF_FACTOR = 0
+        report = await client.get_job_report(JOB_NAME, retries=2)
+        # a served batch is not served again
+        calls.clear()
+        items = await client.get(JOB_NAME, 10, retries=2)
+        await client.close()
+        return report, items
+
+    assert asyncio.run(run()) == ([], None)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('error,n_calls', [
+    (httpx.ConnectError, 3), (httpx.ReadError, 1)
+])
+def test_retries_post(error, n_calls):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) < 3:
+            raise error('failed', request=request)
+        return httpx.Response(200, json=[])
+
+    async def run():
+        client = AsyncPlanchetClient('http://planchet',
+                                     transport=httpx.MockTransport(handler))
+        client.BACKOFF_FACTOR = 0
+        try:
+            return await client.send(JOB_NAME, [(0, {'k': 0})], retries=2)
+        finally:
+            await client.close()
+
+    # a request that may have reached the server is not sent again
+    if n_calls == 1:
+        with pytest.raises(error):
+            asyncio.run(run())
+    else:
+        assert asyncio.run(run()).status_code == 200
+    assert len(calls) == n_calls
+
+
+def test_send_background_failed():
+    def handler(request):
+        ids = [id_ for id_, _ in json.loads(request.content)]
+        return httpx.Response(400 if ids == [3] else 200)
+
+    async def run():
+        client = AsyncPlanchetClient('http://planchet',
+                                     transport=httpx.MockTransport(handler))
+        for i in range(5):
+            await client.send_background(JOB_NAME, [(i, {'k': i})])
+        await asyncio.sleep(0.01)
+        # completed sends are not kept, apart from the failed one
+        n_kept = len(client._sends)
+        with pytest.raises(httpx.HTTPStatusError):
+            await client.drain()
+        await client.close()
+        return n_kept
+
+    assert asyncio.run(run()) == 1
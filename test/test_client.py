@@ -2,6 +2,8 @@ import json
 
 import pytest
 
+from planchet.client import PlanchetClient
+from planchet.ledger import ItemLedger
 from .const import TOKEN_TEST_JOB_NAME
 
 TOKEN = 'test-random-token'
@@ -71,7 +73,7 @@ def test_send(planchet_client, live_ledger, metadata_client):
                                 token=TOKEN)
     assert len(items) == n_items, items
     planchet_client.send(job_name=TOKEN_TEST_JOB_NAME, items=items, token=TOKEN)
-    scanned_items = list(live_ledger.scan_iter(f'{TOKEN_TEST_JOB_NAME}:*'))
+    scanned_items = list(ItemLedger(live_ledger, TOKEN_TEST_JOB_NAME).scan())
     assert len(scanned_items) == n_items, scanned_items
 
 
@@ -106,3 +108,16 @@ def test_mark_errors_received(planchet_client, live_ledger, metadata_client):
     response = planchet_client.mark_errors(job_name=TOKEN_TEST_JOB_NAME,
                                            ids=ids, token=TOKEN)
     assert response.status_code == 400
+
+
+def test_session_pool():
+    client = PlanchetClient('http://localhost:5005', pool_size=3)
+    session = client._session(retries=2)
+    assert client._session(retries=2) is session
+    assert client._session(retries=4) is not session
+    adapter = session.get_adapter('http://localhost:5005/serve')
+    assert adapter.max_retries.total == 2
+    assert adapter._pool_maxsize == 3
+    with PlanchetClient('http://localhost:5005', keep_alive=False) as other:
+        assert other._session(1).headers['Connection'] == 'close'
+    assert not other._sessions
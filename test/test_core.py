@@ -1,16 +1,22 @@
+import itertools
 import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from pydantic.typing import NoneType
 
-from planchet.io import CsvReader, CsvWriter
+from planchet.io import (
+    CsvReader, CsvWriter, PartitionedCsvReader, Prefetcher, ShardedCsvWriter
+)
 from .const import CSV_SIZE
 
 from typing import Dict
 import pytest
 
-from planchet.core import Job, COMPLETE, IN_PROGRESS, RECEIVED, SERVED, \
-    READ_WRITE
+from planchet.core import Job, IdSet, COMPLETE, IN_PROGRESS, RECEIVED, \
+    SERVED, ERROR, READ_WRITE
 
 
 @pytest.mark.parametrize('batch_size', [1, 2, 5, 10, 13, 30, 32])
@@ -24,13 +30,24 @@ def test_serve_batch(reader, writer, ledger, batch_size):
 @pytest.mark.parametrize('pre_served_size', [1, 2, 5, 10, 13, 30])
 def test_serve_continuation(reader, writer, ledger, pre_served_size):
     job = Job('somejob', reader, writer, ledger)
-    for i in range(pre_served_size):
-        ledger.set(job.ledger_id(i), 'fake value')
+    job.items.set(list(range(pre_served_size)), SERVED)
     items = job.serve(50)
     n_items = CSV_SIZE - pre_served_size
     assert len(items) == n_items
 
 
+def test_serve_cont_served(reader, writer, ledger):
+    n_served = 5
+    job = Job('somejob', reader, writer, ledger)
+    job.serve(n_served)
+    job.receive(job.serve(n_served), False)
+    reader = CsvReader({'input_file_path': reader.file_path})
+    cont_job = Job('somejob', reader, writer, ledger, cont=True)
+    items = cont_job.serve(CSV_SIZE)
+    assert [id_ for id_, _ in items[:n_served]] == list(range(n_served))
+    assert len(items) == CSV_SIZE - n_served
+
+
 def test_status(reader, writer, ledger):
     job = Job('somejob', reader, writer, ledger)
     assert job.status == IN_PROGRESS
@@ -79,6 +96,44 @@ def test_restore_job(reader, writer, ledger):
     assert len(records) == CSV_SIZE - n_skips
 
 
+def test_restore_counts(reader, writer, ledger):
+    job = Job('somejob', reader, writer, ledger)
+    job.receive(job.serve(10)[:4], False)
+    restored = Job('somejob', reader, writer, ledger)
+    assert restored._served is None and restored._received is None
+    assert restored.stats == job.stats
+    assert restored.served == set(range(4, 10))
+
+
+def test_id_set():
+    ids = IdSet([3, 9, 9, 1000])
+    assert len(ids) == 3 and list(ids) == [3, 9, 1000]
+    assert 9 in ids and 10 not in ids and 10 ** 6 not in ids and -1 not in ids
+    ids.update(range(5, 12))
+    ids.difference_update([3, 3, 4, 10 ** 6])
+    ids.discard(1000)
+    ids.add(20)
+    assert ids == set(range(5, 12)) | {20}
+    assert len(ids) == 8
+    with pytest.raises(ValueError):
+        ids.add(-1)
+
+
+def test_checkpoint(reader, writer, ledger):
+    job = Job('somejob', reader, writer, ledger)
+    items = job.serve(5) + job.serve(5)
+    job.receive(items[:7], False)
+    job.checkpoint(force=True)
+    assert job.items.get_checkpoint()[0] == 5
+    restored = Job('somejob', CsvReader({'input_file_path': reader.file_path}),
+                   writer, ledger)
+    assert restored.reader.tell() == job.items.get_checkpoint()
+    assert [id_ for id_, _ in restored.serve(3)] == [10, 11, 12]
+    restored.restart()
+    assert restored.items.get_checkpoint() is None
+    assert restored.serve(1)[0][0] == 0
+
+
 def test_restore_unknown_job(ledger):
     job_name: str = 'testjob'
     job_key: str = 'JOB:testjob'
@@ -93,28 +148,28 @@ def test_restart(reader, writer, ledger):
         ledger.set(f'{jobname}:{i}', RECEIVED)
     assert len(list(ledger.scan_iter(f'{jobname}*'))) == n_skips
     job = Job(jobname, reader, writer, ledger)
+    job.serve(5)
     job.restart()
-    assert not len(list(ledger.scan_iter(f'{jobname}*')))
+    # only the layout of the emptied job is kept, so it is not migrated again
+    assert list(ledger.scan_iter(f'{jobname}*')) == [b'somejob:layout']
+    # the ids are loaded again only when they are needed
+    assert job._served is None and job._received is None
     assert not job.served
     assert not job.received
 
 
 def test_receive(job):
-    jobname = job.name
-    ledger = job.ledger
     items = job.serve(CSV_SIZE)
     n_processed = 10
     job.receive(items[:n_processed], False)
-    received = [x for x in ledger.scan_iter(f'{jobname}*')
-                if ledger.get(x).decode('utf8') == RECEIVED]
-    served = [x for x in ledger.scan_iter(f'{jobname}*')
-              if ledger.get(x).decode('utf8') == SERVED]
+    received = job.items.ids(RECEIVED)
+    served = job.items.ids(SERVED)
     active = job.served - job.received
 
     assert len(received) == n_processed
     assert len(received) == len(job.received)
     assert len(served) == CSV_SIZE - n_processed
-    assert set(int(x.decode('utf8').rsplit(':')[1]) for x in served) == active
+    assert set(served) == active
 
 
 def test_receive_cont(job):
@@ -134,10 +189,8 @@ def test_receive_cont(job):
     items = cont_job.serve(n_served - n_received)
     cont_job.receive(items, False)
     # counting in the ledger
-    received = [x for x in ledger.scan_iter(f'{job_name}*')
-                if ledger.get(x).decode('utf8') == RECEIVED]
-    served = [x for x in ledger.scan_iter(f'{job_name}*')
-              if ledger.get(x).decode('utf8') == SERVED]
+    received = cont_job.items.ids(RECEIVED)
+    served = cont_job.items.ids(SERVED)
     assert len(received) == n_served
     assert len(cont_job.received) == n_served
     assert len(served) == 0
@@ -163,8 +216,7 @@ def test_writing_job(writing_job, output_fp, ledger, csv_items):
             assert len(line.split(',')) == 2
     n_items = len(csv_items)
     assert i == n_items
-    keys = ledger.scan_iter(f'{writing_job.name}:*')
-    assert len(list([k for k in keys])) == n_items
+    assert len(list(writing_job.items.scan())) == n_items
 
 
 def test_reading_job(reading_job):
@@ -176,9 +228,7 @@ def test_reading_job(reading_job):
 def test_mark_errors(job, ledger):
     ids = [1, 2, 3, 4]
     job.mark_errors(ids)
-    records = ledger.scan_iter(f'{job.name}:*')
-    items = [int(itm.decode('utf8')[-1]) for itm in records]
-    assert items == ids
+    assert job.items.ids(ERROR) == ids
 
 
 def test_mark_errors_received(job, ledger):
@@ -188,23 +238,252 @@ def test_mark_errors_received(job, ledger):
     job.receive(items, False)
     with pytest.raises(ValueError):
         job.mark_errors(ids)
-    keys = ledger.scan_iter(f'{job.name}:*')
-    assert all([ledger.get(k).decode('utf8') == RECEIVED for k in keys])
+    assert all([status == RECEIVED for _, status in job.items.scan()])
 
 
 def test_clean(job):
-    job_name = job.name
-    ledger = job.ledger
-    for key in list(ledger.scan_iter(f'{job_name}:*')):
-        ledger.delete(key)
     items = job.serve(CSV_SIZE)
     n_processed = 10
     job.receive(items[:n_processed], False)
     job.clean()
-    received = [x for x in ledger.scan_iter(f'{job_name}*')
-                if ledger.get(x).decode('utf8') == RECEIVED]
-    served = [x for x in ledger.scan_iter(f'{job_name}*')
-              if ledger.get(x).decode('utf8') == SERVED]
+    received = job.items.ids(RECEIVED)
+    served = job.items.ids(SERVED)
 
     assert len(received) == len(job.received) == n_processed
     assert len(served) == len(job.served) == 0
+
+
+def test_mark_errors_atomic(job, ledger):
+    items = job.serve(2)
+    job.receive(items[1:], False)
+    with pytest.raises(ValueError):
+        job.mark_errors([0, 1, 5])
+    assert job.items.get([0, 5]) == [SERVED, None]
+
+
+def test_receive_unserved(job, ledger):
+    job.receive([(3, ['val31', 'val32'])], False)
+    assert job.items.get([3]) == [RECEIVED]
+    assert job.stats['received'] == 1
+
+
+def test_serve_cont_index(input_fp, writer, ledger):
+    metadata = {'input_file_path': input_fp, 'index': True, 'index_step': 4}
+    job = Job('somejob', CsvReader(metadata), writer, ledger)
+    items = job.serve(20)
+    job.receive(items[:3] + items[5:], False)
+    job.mark_errors([3])
+    # items 20+ were never served and item 4 is left incomplete
+    cont_job = Job('somejob', CsvReader(metadata), writer, ledger, cont=True)
+    assert list(cont_job._pending) == [4]
+    items = cont_job.serve(CSV_SIZE)
+    assert [id_ for id_, _ in items] == [4] + list(range(20, CSV_SIZE))
+    os.remove(input_fp + '.pidx')
+
+
+def test_receive_deferred(reader, output_fp, ledger):
+    writer = CsvWriter({'output_file_path': output_fp,
+                        'flush_interval': 60})
+    job = Job('somejob', reader, writer, ledger)
+    items = job.serve(10)
+    job.receive(items[:5], False)
+    # nothing is marked before the output is flushed
+    assert job.items.ids(RECEIVED) == []
+    unflushed = writer.unflushed
+    job.receive(items[:5], False)
+    assert writer.unflushed == unflushed
+    with pytest.raises(ValueError):
+        job.mark_errors([0])
+    job.flush()
+    assert job.items.ids(RECEIVED) == list(range(5))
+    assert not writer.unflushed
+    job.receive(items[5:] + job.serve(CSV_SIZE), False)
+    # the last items are flushed once the input is exhausted
+    assert job.stats['received'] == CSV_SIZE
+    job.close()
+    assert writer.fh is None
+
+
+def test_flush_due(reader, output_fp, ledger):
+    writer = CsvWriter({'output_file_path': output_fp,
+                        'flush_interval': 0.05})
+    job = Job('somejob', reader, writer, ledger)
+    job.receive(job.serve(10), False)
+    job.flush_due()
+    assert job.stats['received'] == 0
+    # the output of the last batch is flushed once it is due, without waiting
+    # for another batch to be received
+    time.sleep(0.1)
+    job.flush_due()
+    assert job.stats['received'] == 10
+    job.receive(job.serve(10), False)
+    time.sleep(0.1)
+    job.serve(0)
+    assert job.stats['received'] == 20
+    job.close()
+
+
+def test_serve_partitions(input_fp, writer, ledger):
+    reader = PartitionedCsvReader({'input_file_paths': [input_fp] * 3,
+                                   'chunk_size': 4})
+    job = Job('somejob', reader, writer, ledger)
+    with ThreadPoolExecutor(3) as pool:
+        batches = list(pool.map(job.serve, [7] * 15))
+    ids = [id_ for batch in batches for id_, _ in batch]
+    assert sorted(ids) == list(range(3 * CSV_SIZE))
+    assert job.serve(5) == [] and job.exhausted
+    assert job.stats['served'] == 3 * CSV_SIZE
+
+
+def test_serve_receive_concurrently(input_fp, output_fp, ledger):
+    reader = PartitionedCsvReader({'input_file_paths': [input_fp] * 3,
+                                   'chunk_size': 4})
+    writer = ShardedCsvWriter({'output_file_path': output_fp, 'shards': 3})
+    job = Job('somejob', reader, writer, ledger)
+    pipeline = ledger.pipeline
+    delays = itertools.cycle([0.01, 0])
+
+    def slow_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def slow_execute():
+            # every other response arrives late, after later marks are done
+            results = execute()
+            time.sleep(next(delays))
+            return results
+
+        pipe.execute = slow_execute
+        return pipe
+
+    ledger.pipeline = slow_pipeline
+    mark = job.items.set
+    received = []
+    lock = threading.Lock()
+
+    def counted_mark(ids, status):
+        previous = mark(ids, status)
+        with lock:
+            received.append(job.items.counts[RECEIVED])
+        return previous
+
+    job.items.set = counted_mark
+
+    def work(_):
+        while True:
+            items = job.serve(5)
+            if not items:
+                return
+            job.receive(items, False)
+
+    with ThreadPoolExecutor(6) as pool:
+        list(pool.map(work, range(6)))
+    # the counters never go back to those of an earlier mark
+    assert received == sorted(received)
+    assert job.stats == {'served': 0, 'received': 3 * CSV_SIZE,
+                         'status': COMPLETE}
+    # the counters kept by the job are the ones in the ledger
+    assert job.items.load_counts() == job.items.recount()
+
+
+def test_mark_concurrently(job):
+    mark = job.items.set
+    barrier = threading.Barrier(2, timeout=1)
+
+    def waiting_mark(ids, status):
+        # both marks have to reach the ledger at the same time
+        barrier.wait()
+        return mark(ids, status)
+
+    job.items.set = waiting_mark
+    with ThreadPoolExecutor(2) as pool:
+        list(pool.map(lambda ids: job._mark(ids, SERVED), [[0, 1], [2]]))
+    assert job.stats['served'] == 3
+    assert job.served == IdSet([0, 1, 2])
+
+
+def test_serve_prefetched_partitions(input_fp, writer, ledger):
+    reader = Prefetcher(PartitionedCsvReader(
+        {'input_file_paths': [input_fp] * 2, 'chunk_size': 4}), 8)
+    # partitions cannot be moved, so neither can their prefetcher
+    assert not hasattr(reader, 'seek') and not hasattr(reader, 'seek_id')
+    job = Job('somejob', reader, writer, ledger)
+    ids = [id_ for id_, _ in job.serve(2 * CSV_SIZE)]
+    assert sorted(ids) == list(range(2 * CSV_SIZE))
+    job.close()
+
+
+def test_receive_shards(reader, output_fp, ledger, data):
+    writer = ShardedCsvWriter({'output_file_path': output_fp, 'shards': 4})
+    job = Job('somejob', reader, writer, ledger)
+    items = job.serve(CSV_SIZE)
+    job.serve(1)
+    # the first item written to a new output is its header
+    job.receive([(0, ['head1', 'head2'])], False)
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda i: job.receive(items[i::4], False), range(4)))
+    # the shards are merged in input order once the job is complete
+    assert job.status == COMPLETE
+    lines = data.split('\n')
+    with open(output_fp) as fh:
+        assert fh.read().split('\n') == lines[:1] + lines[2:] + ['']
+
+
+def test_receive_concurrently(reader, output_fp, ledger, data):
+    writer = ShardedCsvWriter({'output_file_path': output_fp, 'shards': 4})
+    job = Job('somejob', reader, writer, ledger)
+    items = job.serve(CSV_SIZE)
+    job.serve(1)
+    job.receive([(0, ['head1', 'head2'])], False)
+    lookup = job.items.get
+    barrier = threading.Barrier(4)
+
+    def slow_lookup(ids):
+        # every batch has looked up the statuses before any is written
+        statuses = lookup(ids)
+        barrier.wait(timeout=5)
+        return statuses
+
+    job.items.get = slow_lookup
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: job.receive(items, False), range(4)))
+    # items received by several batches at once are written once
+    assert job.metrics.items['received'] == CSV_SIZE
+    assert job.status == COMPLETE
+    assert job.stats['received'] == CSV_SIZE
+    lines = data.split('\n')
+    with open(output_fp) as fh:
+        assert fh.read().split('\n') == lines[:1] + lines[2:] + ['']
+
+
+def test_serve_leases(input_fp, writer, ledger):
+    reader = CsvReader({'input_file_path': input_fp, 'index': True})
+    job = Job('somejob', reader, writer, ledger, lease_ttl=0.05)
+    items = job.serve(10)
+    job.receive(items[:5], False)
+    assert job.heartbeat([5, 6, 7]) == 3
+    assert job.serve(5) == reader.read_ids(list(range(10, 15)))
+    time.sleep(0.1)
+    job.heartbeat([5])
+    # items not received or kept alive in time are served again first
+    items = job.serve(8)
+    assert [id_ for id_, _ in items] == [6, 7, 8, 9, 10, 11, 12, 13]
+    assert items[0] == reader.read_ids([6])[0]
+    job.receive(items, False)
+    assert sorted(job.items.reclaim(20, time.time() + 1, 0)) == [5, 14]
+    os.remove(input_fp + '.pidx')
+
+
+def test_serve_prefetch(input_fp, writer, ledger):
+    job = Job('somejob', Prefetcher(CsvReader({'input_file_path': input_fp}),
+                                    8), writer, ledger)
+    expected = CsvReader({'input_file_path': input_fp})(CSV_SIZE)
+    items = job.serve(10)
+    # buffered items are only marked once they are served
+    assert job.items.ids(SERVED) == list(range(10))
+    job.clean()
+    assert job.serve(CSV_SIZE) == expected[10:]
+    assert job.serve(1) == [] and job.exhausted
+    job.restart()
+    assert job.serve(10) == items
+    job.close()
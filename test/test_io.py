@@ -4,7 +4,10 @@ import os
 import pandas as pd
 import pytest
 
-from planchet.io import CsvReader, JsonlReader, CsvWriter, JsonlWriter
+from planchet.io import (
+    CsvReader, JsonlReader, CsvWriter, JsonlWriter, PartitionedCsvReader,
+    PartitionedJsonlReader, Prefetcher, prefetched, ShardedCsvWriter, ShardedJsonlWriter, split_lines
+)
 
 
 @pytest.mark.parametrize(
@@ -320,3 +323,306 @@ def test_csv_clean():
     writer(data)
     writer.clean()
     assert not os.path.isfile(file_path), 'CSV clean not working'
+
+
+def test_jsonl_seek():
+    file_path = 'temp.jsnl'
+    with open(file_path, 'w') as fh:
+        fh.write('\n'.join(json.dumps({'k': i}) for i in range(6)))
+    reader = JsonlReader({'input_file_path': file_path})
+    reader(2)
+    position = reader.tell()
+    assert reader(1) == [(2, {'k': 2})]
+    resumed = JsonlReader({'input_file_path': file_path})
+    resumed.seek(*position)
+    assert resumed(10) == [(i, {'k': i}) for i in range(2, 6)]
+    with pytest.raises(ValueError):
+        resumed.seek(0, 10 ** 6)
+    os.remove(file_path)
+
+
+def test_csv_seek():
+    file_path = 'temp.csv'
+    with open(file_path, 'w') as fh:
+        fh.write('head1,head2\nval1,val2\n"multi\nline",val4\nval5,val6\n')
+    reader = CsvReader({'input_file_path': file_path, 'chunk_size': 2})
+    reader(1)
+    position = reader.tell()
+    assert reader(1) == [(1, ('multi\nline', 'val4'))]
+    resumed = CsvReader({'input_file_path': file_path})
+    resumed.seek(*position)
+    assert resumed(10) == [(1, ('multi\nline', 'val4')), (2, ('val5', 'val6'))]
+    os.remove(file_path)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 100])
+def test_csv_blank_lines(chunk_size):
+    file_path = 'temp.csv'
+    with open(file_path, 'w') as fh:
+        fh.write('a,b\n1,x\n\n2,y\n\n\n3,z\n\n')
+    reader = CsvReader({'input_file_path': file_path,
+                        'chunk_size': chunk_size})
+    # blank lines are no items, even when a whole chunk is made of them
+    assert reader(10) == [(0, (1, 'x')), (1, (2, 'y')), (2, (3, 'z'))]
+    resumed = CsvReader({'input_file_path': file_path})
+    resumed.seek(*reader.offset_before(0))
+    assert resumed(1) == [(0, (1, 'x'))]
+    os.remove(file_path)
+
+
+def test_offset_before(reader):
+    reader(5)
+    reader(5)
+    first, second = sorted(reader.offsets.items())
+    assert reader.offset_before(4) == first
+    assert reader.offset_before(7) == second
+    # earlier positions are forgotten
+    assert list(reader.offsets) == [second[0]]
+    assert reader.offset_before(4) is None
+
+
+@pytest.mark.parametrize('step', [1, 2, 4])
+def test_jsonl_index(step):
+    file_path = 'temp.jsnl'
+    with open(file_path, 'w') as fh:
+        fh.write('\n'.join(json.dumps({'k': i}) for i in range(9)))
+    metadata = {'input_file_path': file_path, 'index': True,
+                'index_step': step}
+    reader = JsonlReader(metadata)
+    assert reader.read_ids([7, 2, 2, 3, 20]) == \
+        [(2, {'k': 2}), (3, {'k': 3}), (7, {'k': 7})]
+    assert reader(1) == [(0, {'k': 0})]
+    assert os.path.exists(file_path + '.pidx')
+    reloaded = JsonlReader(metadata)
+    assert reloaded.index.fresh
+    reloaded.seek_id(6)
+    assert reloaded(10) == [(i, {'k': i}) for i in range(6, 9)]
+    os.remove(file_path)
+    os.remove(file_path + '.pidx')
+
+
+def test_csv_index():
+    file_path = 'temp.csv'
+    with open(file_path, 'w') as fh:
+        fh.write('head1,head2\nval1,val2\n"multi\nline",val4\nval5,val6\n')
+    metadata = {'input_file_path': file_path, 'index': True,
+                'index_step': 2}
+    reader = CsvReader(metadata)
+    # the first pass through the file builds the index
+    reader(10)
+    assert reader.index.offsets == [12, 40]
+    assert CsvReader(metadata).index.fresh
+    assert reader.read_ids([2, 1]) == [(1, ('multi\nline', 'val4')),
+                                       (2, ('val5', 'val6'))]
+    assert reader.locate(5) == (3, os.path.getsize(file_path))
+    os.remove(file_path)
+    os.remove(file_path + '.pidx')
+
+
+def test_csv_index_blank_lines():
+    file_path = 'temp.csv'
+    with open(file_path, 'w') as fh:
+        fh.write('a,b\n1,x\n\n2,y\n\n\n3,z\n4,w\n')
+    metadata = {'input_file_path': file_path, 'index': True,
+                'index_step': 1, 'chunk_size': 1}
+    expected = CsvReader({'input_file_path': file_path})(10)
+    # an index built up front and one built while reading agree with
+    # reading the file from the start
+    assert CsvReader(metadata).read_ids([3, 2, 1, 0]) == expected
+    os.remove(file_path + '.pidx')
+    reader = CsvReader(metadata)
+    assert reader(10) == expected
+    assert reader.read_ids([3, 2, 1, 0]) == expected
+    reader.seek_id(2)
+    assert reader(10) == expected[2:]
+    os.remove(file_path)
+    os.remove(file_path + '.pidx')
+
+
+def test_index_stale():
+    file_path = 'temp.jsnl'
+    with open(file_path, 'w') as fh:
+        fh.write('{"k": 0}\n{"k": 1}\n')
+    metadata = {'input_file_path': file_path, 'index': True,
+                'index_step': 1}
+    JsonlReader(metadata).build_index()
+    with open(file_path, 'a') as fh:
+        fh.write('{"k": 2}\n')
+    reader = JsonlReader(metadata)
+    assert not reader.index.fresh
+    assert reader.read_ids([2]) == [(2, {'k': 2})]
+    assert reader.index.n_items == 3
+    os.remove(file_path)
+    os.remove(file_path + '.pidx')
+
+
+@pytest.mark.parametrize('csv_text', [
+    'a,b,c\n1,2.5,x\n3,4,y\n',
+    'a,b\n1,2.5\n3,4\n',
+    'a,b\n1,2\n3,4\n',
+    'a,b\nTrue,1\nFalse,2\n',
+])
+def test_csv_row_types(csv_text):
+    file_path = 'temp.csv'
+    with open(file_path, 'w') as fh:
+        fh.write(csv_text)
+    rows = [row for _, row in CsvReader({'input_file_path': file_path})(10)]
+    # same values and types as rows taken from `DataFrame.iterrows`
+    expected = [(*row,) for _, row in pd.read_csv(file_path).iterrows()]
+    assert rows == expected
+    assert [[type(v).__name__ for v in row] for row in rows] == \
+        [[type(getattr(v, 'item', lambda: v)()).__name__ for v in row]
+         for row in expected]
+    os.remove(file_path)
+
+
+def test_writer_buffer():
+    file_path = 'temp.jsnl'
+    writer = JsonlWriter({'output_file_path': file_path, 'overwrite': True,
+                          'flush_interval': 60, 'buffer_size': 30})
+    writer([{'k': 1}])
+    assert writer.unflushed and not os.path.getsize(file_path)
+    handle = writer.fh
+    # the size threshold is reached
+    writer([{'k': 2}, {'k': 3}, {'k': 4}])
+    assert not writer.unflushed and writer.fh is handle
+    with open(file_path) as fh:
+        assert [json.loads(line)['k'] for line in fh] == [1, 2, 3, 4]
+    writer.close()
+    assert writer.fh is None
+    writer.clean()
+    assert not os.path.exists(file_path)
+
+
+def test_writer_written():
+    file_path = 'temp.csv'
+    writer = CsvWriter({'output_file_path': file_path, 'overwrite': True})
+    writer([['välue', 'ß']])
+    writer([['value', 'x']])
+    writer.close()
+    # bytes are counted, not characters
+    assert writer.written == os.path.getsize(file_path)
+    writer.clean()
+
+
+def test_csv_writer_header():
+    file_path = 'temp.csv'
+    writer = CsvWriter({'output_file_path': file_path, 'overwrite': True})
+    writer([['head1', 'head2'], ['val1', 'val,2']])
+    writer([['val3', 'val4']])
+    writer.close()
+    with open(file_path) as fh:
+        assert fh.read() == 'head1,head2\nval1,"val,2"\nval3,val4\n'
+    writer = CsvWriter({'output_file_path': file_path})
+    writer([{'head1': 'val5', 'head2': 'val6'}])
+    writer.clean()
+    writer([['head3', 'head4'], ['val7', 'val8']])
+    writer.close()
+    with open(file_path) as fh:
+        assert fh.read() == 'head3,head4\nval7,val8\n'
+    os.remove(file_path)
+
+
+@pytest.mark.parametrize('n_parts', [1, 3, 12])
+def test_jsonl_partitions(n_parts):
+    file_path = 'temp.jsnl'
+    lines = [json.dumps({'k': i}) + '\n' for i in range(10)]
+    with open(file_path, 'w') as fh:
+        fh.write(''.join(lines))
+    # item `i` of partition `k` gets the id `i * n_parts + k`
+    expected = {}
+    offset = 0
+    ranges = split_lines(file_path, n_parts)
+    for part, (start, end) in enumerate(ranges):
+        n_items = 0
+        while offset < end:
+            expected[n_items * n_parts + part] = {'k': len(expected)}
+            offset += len(lines[len(expected) - 1])
+            n_items += 1
+    assert offset == os.path.getsize(file_path)
+    reader = PartitionedJsonlReader({'input_file_path': file_path,
+                                     'partitions': n_parts})
+    items = []
+    for batch in iter(lambda: reader(3), []):
+        items.extend(batch)
+    assert dict(items) == expected and len(items) == 10
+    os.remove(file_path)
+
+
+def test_csv_partitions():
+    paths = ['temp0.csv', 'temp1.csv']
+    for i, file_path in enumerate(paths):
+        with open(file_path, 'w') as fh:
+            fh.write('head1,head2\n' +
+                     ''.join(f'v{i}{j},x\n' for j in range(3)))
+    reader = PartitionedCsvReader({'input_file_paths': paths})
+    assert reader.parallelism == 2
+    # batches are drawn from the partitions in turn
+    assert reader(2) == [(0, ('v00', 'x')), (2, ('v01', 'x'))]
+    assert reader(5) == [(1, ('v10', 'x')), (3, ('v11', 'x')),
+                         (5, ('v12', 'x'))]
+    assert reader(5) == [(4, ('v02', 'x'))]
+    assert reader(5) == []
+    for file_path in paths:
+        os.remove(file_path)
+
+
+def test_jsonl_shards():
+    file_path = 'temp.jsnl'
+    writer = ShardedJsonlWriter({'output_file_path': file_path,
+                                 'overwrite': True, 'shards': 3})
+    writer([{'k': 5}, {'k': 1}], [5, 1])
+    writer([{'k': 4}, {'k': 0}], [4, 0])
+    writer([{'k': 3}, {'k': 5}, {'k': 2}], [3, 5, 2])
+    writer.flush()
+    assert all(os.path.getsize(shard.file_path) for shard in writer.shards)
+    writer.merge()
+    with open(file_path) as fh:
+        assert [json.loads(line)['k'] for line in fh] == list(range(6))
+    assert not any(os.path.exists(shard.file_path)
+                   for shard in writer.shards)
+    # merging again appends the newly written records
+    writer([{'k': 6}], [6])
+    writer.merge()
+    with open(file_path) as fh:
+        assert [json.loads(line)['k'] for line in fh] == list(range(7))
+    writer.clean()
+    assert not os.path.exists(file_path)
+
+
+def test_csv_shards():
+    file_path = 'temp.csv'
+    writer = ShardedCsvWriter({'output_file_path': file_path,
+                               'overwrite': True, 'shards': 2})
+    writer([['head1', 'head2'], ['val1', 'multi\nline']], [0, 1])
+    writer([{'head2': 'val4', 'head1': 'val3'}], [2])
+    writer([['val0', 'val00']], [0])
+    writer.merge()
+    with open(file_path, newline='') as fh:
+        assert fh.read() == \
+            'head1,head2\nval0,val00\nval1,"multi\nline"\nval3,val4\n'
+    assert not os.path.exists(writer.header_path)
+    writer.clean()
+
+
+def test_prefetcher():
+    file_path = 'temp.jsnl'
+    with open(file_path, 'w') as fh:
+        fh.write('\n'.join(json.dumps({'k': i}) for i in range(10)))
+    metadata = {'input_file_path': file_path, 'prefetch': 4}
+    reader = prefetched(JsonlReader(metadata), metadata)
+    assert isinstance(reader, Prefetcher)
+    items = []
+    for batch in iter(lambda: reader(3), []):
+        assert 0 < len(batch) <= 3
+        items.extend(batch)
+    assert items == [(i, {'k': i}) for i in range(10)]
+    # moving the reader drops the buffer
+    reader.seek(0, 0)
+    assert reader(1) == [(0, {'k': 0})]
+    assert reader.tell()[0] > 1
+    reader.close()
+    assert reader(1) == [] and reader.thread is None
+    assert prefetched(JsonlReader({'input_file_path': file_path}),
+                      {'prefetch': 0}).__class__ is JsonlReader
+    os.remove(file_path)
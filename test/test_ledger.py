@@ -0,0 +1,138 @@
+import pytest
+
+from planchet.ledger import (
+    BaseItemLedger, ItemLedger, Ledger, SERVED, RECEIVED, ERROR
+)
+from planchet.memory_ledger import MemoryItemLedger
+from planchet.sqlite_ledger import SqliteItemLedger
+
+
+@pytest.fixture()
+def items(ledger):
+    return ItemLedger(ledger, 'somejob')
+
+
+def test_interfaces():
+    # a backend has to implement the whole interface
+    with pytest.raises(TypeError):
+        Ledger()
+
+    class PartialItemLedger(BaseItemLedger):
+        def get(self, ids):
+            return [None] * len(ids)
+
+    with pytest.raises(TypeError):
+        PartialItemLedger('somejob')
+    for backend in (ItemLedger, SqliteItemLedger, MemoryItemLedger):
+        assert issubclass(backend, BaseItemLedger)
+        assert not backend.__abstractmethods__
+
+
+def test_get_set(items):
+    ids = [0, 1, 5, 1000, 70001]
+    assert items.get(ids) == [None] * len(ids)
+    items.set(ids[:2], SERVED)
+    items.set(ids[2:4], RECEIVED)
+    items.set(ids[4:], ERROR)
+    assert items.get(ids) == [SERVED, SERVED, RECEIVED, RECEIVED, ERROR]
+    items.set([1000], None)
+    assert items.get([1000, 1001]) == [None, None]
+
+
+def test_set_large_batch(items, monkeypatch):
+    monkeypatch.setattr('planchet.ledger._BITFIELD_CHUNK', 7)
+    ids = list(range(0, 100, 3))
+    items.set(ids, SERVED)
+    assert items.get(ids) == [SERVED] * len(ids)
+    assert items.ids(SERVED) == ids
+
+
+def test_scan(items, monkeypatch):
+    monkeypatch.setattr('planchet.ledger._SCAN_CHUNK', 2)
+    items.set([3, 17], RECEIVED)
+    items.set([8], SERVED)
+    assert list(items.scan()) == [(3, RECEIVED), (8, SERVED), (17, RECEIVED)]
+    assert items.ids(RECEIVED) == [3, 17]
+
+
+def test_delete(items, ledger):
+    items.set([1, 2], SERVED)
+    items.delete()
+    assert not list(items.scan())
+    assert not list(ledger.scan_iter('somejob:*'))
+
+
+def test_migrate(items, ledger):
+    ledger.set('somejob:0', RECEIVED)
+    ledger.set('somejob:7', SERVED)
+    ledger.set('somejob:9', ERROR)
+    ledger.set('somejob:11', 'fake value')
+    ledger.set('otherjob:3', SERVED)
+    items.migrate()
+    assert list(items.scan()) == [
+        (0, RECEIVED), (7, SERVED), (9, ERROR), (11, ERROR)
+    ]
+    assert not ledger.get('somejob:0')
+    assert ledger.get('otherjob:3')
+    # a migrated job is not scanned again
+    ledger.set('somejob:1', RECEIVED)
+    items.migrate()
+    assert items.get([1]) == [None]
+
+
+def test_layout_marker(items, ledger, monkeypatch):
+    items.create()
+
+    def scan_iter(*args, **kwargs):
+        raise AssertionError('the job is scanned for old records')
+
+    monkeypatch.setattr(ledger, 'scan_iter', scan_iter)
+    # new and emptied jobs are not migrated
+    items.migrate()
+    items.set([1, 2], SERVED)
+    items.delete()
+    items.create()
+    ItemLedger(ledger, 'somejob').migrate()
+    assert items.load_counts() == {SERVED: 0, RECEIVED: 0, ERROR: 0}
+
+
+def test_counts(items, ledger):
+    assert items.set([1, 2, 3], SERVED) == [None] * 3
+    assert items.set([2, 3, 4], RECEIVED) == [SERVED, SERVED, None]
+    assert items.counts == {SERVED: 1, RECEIVED: 3, ERROR: 0}
+    items.set([1], None)
+    assert items.counts == {SERVED: 0, RECEIVED: 3, ERROR: 0}
+    restored = ItemLedger(ledger, 'somejob')
+    assert restored.load_counts() == items.counts
+
+
+def test_migrate_counts(items, ledger):
+    items.set([1, 2], SERVED)
+    ledger.delete(items.counts_key)
+    ledger.set(items.layout_key, '2')
+    items.migrate()
+    assert items.load_counts() == {SERVED: 2, RECEIVED: 0, ERROR: 0}
+
+
+def test_first_incomplete(items, monkeypatch):
+    monkeypatch.setattr('planchet.ledger._WATERMARK_WINDOW', 1)
+    items.set(list(range(10)), RECEIVED)
+    items.set([10], SERVED)
+    items.set([11, 12], ERROR)
+    assert items.first_incomplete(0, 20) == 10
+    assert items.first_incomplete(0, 8) == 8
+    assert items.first_incomplete(11, 13) == 13
+    assert items.first_incomplete(11, 20) == 13
+    assert items.first_incomplete(30, 40) == 30
+
+
+def test_leases(items, ledger):
+    items.lease([1, 2, 3], 10)
+    items.lease([4], 30)
+    assert items.extend([3, 5], 20) == 1
+    assert items.reclaim(5, 15, 40) == [1, 2]
+    # reclaimed items are leased again
+    assert items.reclaim(5, 15, 40) == []
+    items.release([3])
+    assert items.reclaim(1, 35, 50) == [4]
+    assert ledger.zcard(items.leases_key) == 3
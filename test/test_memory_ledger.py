@@ -0,0 +1,144 @@
+import time
+
+import pytest
+
+from planchet.core import Job, COMPLETE
+from planchet.io import CsvReader, CsvWriter
+from planchet.ledger import SERVED, RECEIVED, ERROR
+from planchet.memory_ledger import MemoryItemLedger, MemoryLedger
+from .const import CSV_SIZE
+
+
+@pytest.fixture()
+def memory_ledger():
+    ledger = MemoryLedger()
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture()
+def items(memory_ledger):
+    return memory_ledger.items('somejob')
+
+
+def test_records(memory_ledger):
+    memory_ledger.set('JOB:a', '{"k": 1}')
+    memory_ledger.set('JOB:b', b'x')
+    memory_ledger.set('TOKEN:a', 'secret')
+    assert memory_ledger.get('JOB:a') == b'{"k": 1}'
+    assert memory_ledger.get('JOB:c') is None
+    assert sorted(memory_ledger.scan_iter('JOB:*')) == [b'JOB:a', b'JOB:b']
+    assert memory_ledger.delete('JOB:a', 'JOB:c') == 1
+    assert memory_ledger.ping()
+    memory_ledger.flushdb()
+    assert list(memory_ledger.scan_iter()) == []
+
+
+def test_get_set(items, memory_ledger):
+    ids = [0, 1, 5, 1000, 5000, 100003]
+    assert items.get(ids) == [None] * len(ids)
+    assert items.set(ids[:2], SERVED) == [None, None]
+    items.set(ids[2:4], RECEIVED)
+    items.set(ids[4:], ERROR)
+    assert items.get(ids) == [SERVED, SERVED, RECEIVED, RECEIVED, ERROR,
+                              ERROR]
+    assert items.set([1, 1000, 1000], None) == [SERVED, RECEIVED, RECEIVED]
+    assert items.get([1, 1000, 1001]) == [None, None, None]
+    assert items.counts == {SERVED: 1, RECEIVED: 1, ERROR: 2}
+    assert MemoryItemLedger(memory_ledger, 'somejob').load_counts() == \
+        items.counts
+    assert memory_ledger.items('otherjob').get(ids) == [None] * len(ids)
+
+
+def test_scan(items):
+    items.set([3, 5001], RECEIVED)
+    items.set([8], SERVED)
+    assert list(items.scan()) == [(3, RECEIVED), (8, SERVED),
+                                  (5001, RECEIVED)]
+    assert items.ids(RECEIVED) == [3, 5001]
+    assert items.end() == 5004
+    assert len(items.pending(4)) == items.end() - 4 - 1
+    assert items.recount() == {SERVED: 1, RECEIVED: 2, ERROR: 0}
+
+
+def test_first_incomplete(items):
+    items.set(list(range(10)), RECEIVED)
+    items.set([10], SERVED)
+    items.set([11, 12], ERROR)
+    assert items.first_incomplete(0, 20) == 10
+    assert items.first_incomplete(0, 8) == 8
+    assert items.first_incomplete(11, 13) == 13
+    assert items.first_incomplete(11, 20) == 13
+    assert items.first_incomplete(30, 40) == 30
+
+
+def test_checkpoint_and_leases(items):
+    assert items.get_checkpoint() is None
+    items.set_checkpoint(10, 200)
+    assert items.get_checkpoint() == (10, 200)
+    items.lease([1, 2, 3], 10)
+    items.lease([4], 30)
+    assert items.extend([3, 5], 20) == 1
+    assert items.reclaim(5, 15, 40) == [1, 2]
+    assert items.reclaim(5, 15, 40) == []
+    items.release([3])
+    assert items.reclaim(1, 35, 50) == [4]
+    items.delete()
+    assert items.get_checkpoint() is None
+    assert items.reclaim(5, 100, 200) == []
+
+
+def test_snapshot(tmp_path):
+    path = str(tmp_path / 'ledger.npz')
+    ledger = MemoryLedger(path, interval=0)
+    ledger.set('JOB:a', b'\xff\x00')
+    items = ledger.items('a')
+    items.set([0, 7, 20000], RECEIVED)
+    items.set([3], SERVED)
+    items.set_checkpoint(1, 10)
+    items.lease([3], 100)
+    # every change is written right away
+    restored = MemoryLedger(path)
+    restored_items = restored.items('a')
+    assert restored.get('JOB:a') == b'\xff\x00'
+    assert list(restored_items.scan()) == [(0, RECEIVED), (3, SERVED),
+                                           (7, RECEIVED), (20000, RECEIVED)]
+    assert restored_items.load_counts() == {SERVED: 1, RECEIVED: 3, ERROR: 0}
+    assert restored_items.end() == items.end()
+    assert restored_items.get_checkpoint() == (1, 10)
+    assert restored_items.reclaim(5, 200, 300) == [3]
+    restored.close()
+
+
+def test_snapshot_interval(tmp_path):
+    path = tmp_path / 'ledger.npz'
+    ledger = MemoryLedger(str(path), interval=0.05)
+    ledger.items('a').set([1], RECEIVED)
+    assert not path.exists()
+    for _ in range(100):
+        if path.exists():
+            break
+        time.sleep(0.01)
+    assert MemoryLedger(str(path)).items('a').get([1]) == [RECEIVED]
+    ledger.items('a').set([2], ERROR)
+    ledger.close()
+    # closing takes a last snapshot
+    assert MemoryLedger(str(path)).items('a').get([2]) == [ERROR]
+
+
+def test_job(tmp_path, input_fp, output_fp):
+    path = str(tmp_path / 'ledger.npz')
+    metadata = {'input_file_path': input_fp, 'output_file_path': output_fp}
+    ledger = MemoryLedger(path, interval=60)
+    job = Job('somejob', CsvReader(metadata), CsvWriter(metadata), ledger)
+    assert isinstance(job.items, MemoryItemLedger)
+    items = job.serve(10)
+    job.receive(items, False)
+    job.close()
+    ledger.close()
+    restored = Job('somejob', CsvReader(metadata), CsvWriter(metadata),
+                   MemoryLedger(path))
+    assert restored.stats['received'] == 10
+    restored.receive(restored.serve(100), False)
+    assert restored.status == COMPLETE
+    assert restored.stats['received'] == CSV_SIZE
@@ -0,0 +1,60 @@
+import os
+import re
+
+from planchet.core import Job
+from planchet.metrics import Histogram, JobMetrics, render
+
+
+def test_histogram():
+    histogram = Histogram((0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [('0.1', 2), ('1.0', 3), ('+Inf', 4)]
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+
+
+def test_job_metrics():
+    metrics = JobMetrics('somejob')
+    with metrics.operation('serve'):
+        with metrics.stage('reader'):
+            pass
+        with metrics.stage('ledger'):
+            pass
+        with metrics.stage('ledger'):
+            pass
+    # stages outside an operation are only counted
+    with metrics.stage('ledger'):
+        pass
+    metrics.count('served', 10)
+    assert sorted(metrics.latency) == [('serve', 'ledger'),
+                                       ('serve', 'reader'),
+                                       ('serve', 'total')]
+    assert all(h.count == 1 for h in metrics.latency.values())
+    assert metrics.ledger_calls == 3
+    assert metrics.items == {'served': 10, 'received': 0}
+    assert metrics.rates()['served'] > 0
+
+
+def test_render(reader, writer, ledger):
+    job = Job('some"job', reader, writer, ledger)
+    items = job.serve(10)
+    job.receive(items, False)
+    text = render({job.name: job}, {job.name: 2})
+    assert '# TYPE planchet_serve_seconds histogram' in text
+    for stage in ('total', 'reader', 'ledger'):
+        assert f'planchet_serve_seconds_count{{job="some\\"job",' \
+               f'stage="{stage}"}} 1' in text
+    for stage in ('total', 'ledger', 'writer'):
+        assert f'planchet_receive_seconds_count{{job="some\\"job",' \
+               f'stage="{stage}"}} 1' in text
+    assert 'planchet_items_total{job="some\\"job",direction="received"} 10' \
+        in text
+    assert 'planchet_queue_depth{job="some\\"job",queue="waiting"} 2' in text
+    assert 'planchet_queue_depth{job="some\\"job",queue="in_flight"} 0' \
+        in text
+    written = re.search(r'planchet_written_bytes_total\{[^}]*\} (\d+)', text)
+    assert int(written.group(1)) == os.path.getsize(writer.file_path)
+    calls = re.search(r'planchet_ledger_round_trips_total\{[^}]*\} (\d+)',
+                      text)
+    assert int(calls.group(1)) >= 4
@@ -0,0 +1,172 @@
+import asyncio
+import gzip
+import json
+import tracemalloc
+from typing import Dict
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from planchet.middleware import BodySizeLimit, Compression
+from planchet.util import compress
+
+
+def _make_app():
+    app = FastAPI()
+    app.add_middleware(BodySizeLimit, max_size=10, exclude=['/free'])
+    parsed = []
+
+    @app.post('/limited')
+    async def limited(body: Dict):
+        parsed.append(body)
+
+    @app.post('/free')
+    async def free(body: Dict):
+        parsed.append(body)
+
+    return app, parsed
+
+
+def test_body_size_limit():
+    app, parsed = _make_app()
+
+    async def chunks():
+        for _ in range(4):
+            yield b'{"k": 1}  '
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            return [
+                await client.post('/limited', json={'k': 1}),
+                await client.post('/limited', json={'k': 'x' * 10}),
+                await client.post('/limited', content=chunks(),
+                                  headers={'Content-Type':
+                                           'application/json'}),
+                await client.post('/free', json={'k': 'x' * 10}),
+            ]
+
+    statuses = [r.status_code for r in asyncio.run(run())]
+    assert statuses == [200, 413, 413, 200]
+    # rejected bodies are never parsed
+    assert parsed == [{'k': 1}, {'k': 'x' * 10}]
+
+
+def _make_compressed_app():
+    app = FastAPI()
+    app.add_middleware(Compression, min_size=100)
+
+    @app.post('/echo')
+    async def echo(body: Dict):
+        return body
+
+    @app.get('/stream')
+    async def stream():
+        async def lines():
+            for i in range(3):
+                yield json.dumps({'k': 'x' * 100, 'i': i}).encode() + b'\n'
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    return app
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_compression(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    app = _make_compressed_app()
+    large = {'k': 'x' * 1000}
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            headers = {'Accept-Encoding': encoding,
+                       'Content-Type': 'application/json',
+                       'Content-Encoding': encoding}
+            return [
+                await client.post('/echo', content=compress(
+                    json.dumps(large).encode(), encoding), headers=headers),
+                await client.post('/echo', json={'k': 1},
+                                  headers={'Accept-Encoding': encoding}),
+                await client.get('/stream',
+                                 headers={'Accept-Encoding': encoding}),
+                await client.post('/echo', json=large,
+                                  headers={'Accept-Encoding': 'identity'}),
+                await client.post('/echo', content=b'{}', headers={
+                    'Content-Encoding': 'br'}),
+                await client.post('/echo', content=b'not gzip', headers={
+                    'Content-Encoding': encoding,
+                    'Content-Type': 'application/json'}),
+            ]
+
+    large_echo, small, stream, plain, unknown, invalid = asyncio.run(run())
+    assert large_echo.headers['content-encoding'] == encoding
+    assert int(large_echo.headers['content-length']) < 100
+    assert large_echo.json() == large
+    assert 'content-encoding' not in small.headers
+    assert stream.headers['content-encoding'] == encoding
+    assert [json.loads(line)['i'] for line in stream.text.splitlines()] == \
+        [0, 1, 2]
+    assert 'content-encoding' not in plain.headers
+    assert unknown.status_code == 415
+    assert invalid.status_code == 400
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_compression_bomb(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    app = FastAPI()
+    app.add_middleware(BodySizeLimit, max_size=10**6)
+    app.add_middleware(Compression)
+    received = []
+
+    @app.post('/echo')
+    async def echo(body: Dict):
+        received.append(body)
+
+    body = compress(b'[' + b' ' * 10**8 + b']', encoding)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            return await client.post('/echo', content=body, headers={
+                'Content-Encoding': encoding,
+                'Content-Type': 'application/json'})
+
+    tracemalloc.start()
+    response = asyncio.run(run())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    # the body is rejected long before it is decompressed in full
+    assert response.status_code == 413
+    assert peak < 10**7
+    assert received == []
+
+
+def test_compression_parts():
+    # every part of a streamed response can be decompressed on arrival
+    sent = []
+
+    async def app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': []})
+        for i in range(3):
+            await send({'type': 'http.response.body',
+                        'body': b'x' * 200, 'more_body': i < 2})
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'headers': [(b'accept-encoding', b'gzip')]}
+    asyncio.run(Compression(app, min_size=100)(scope, None, send))
+    decompressor = __import__('zlib').decompressobj(wbits=31)
+    assert [len(decompressor.decompress(m['body'])) for m in sent[1:]] == \
+        [200, 200, 200]
+    assert gzip.decompress(b''.join(m['body'] for m in sent[1:])) == \
+        b'x' * 600
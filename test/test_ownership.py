@@ -0,0 +1,201 @@
+import asyncio
+import json
+import os
+import weakref
+
+import fakeredis
+import httpx
+import pytest
+import redis
+
+import app as service
+from planchet.ownership import Ownership
+
+JOB_NAME = 'owned-job'
+
+
+@pytest.fixture()
+def server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture()
+def instance(server, monkeypatch):
+    ownership = Ownership('http://instance-a:5005', ttl=30)
+    monkeypatch.setattr(service, 'OWNERSHIP', ownership)
+    monkeypatch.setattr(service, 'LEDGER', fakeredis.FakeRedis(server=server))
+    monkeypatch.setattr(service, '_make_async_ledger',
+                        lambda: fakeredis.FakeAsyncRedis(server=server))
+    monkeypatch.setattr(service, '_LOOP_STATES', weakref.WeakKeyDictionary())
+    monkeypatch.setattr(service, 'JOB_LOG', {})
+    yield ownership
+    service.LEDGER.flushdb()
+
+
+def test_acquire(server):
+    first = Ownership('http://a')
+    second = Ownership('http://b', ttl=0.05)
+
+    async def run():
+        ledger = fakeredis.FakeAsyncRedis(server=server)
+        owner, taken = await first.acquire(ledger, JOB_NAME)
+        assert first.owns(owner) and taken
+        owner, taken = await first.acquire(ledger, JOB_NAME)
+        assert first.owns(owner) and not taken
+        owner, taken = await second.acquire(ledger, JOB_NAME)
+        assert owner['url'] == 'http://a' and not taken
+        assert await second.renew(ledger, [JOB_NAME]) == [JOB_NAME]
+        assert await first.renew(ledger, [JOB_NAME]) == []
+        await second.release(ledger, JOB_NAME)
+        assert await ledger.exists(first.key(JOB_NAME))
+        await first.release(ledger, JOB_NAME)
+        # the job is free for the other instance now
+        owner, taken = await second.acquire(ledger, JOB_NAME)
+        assert second.owns(owner) and taken
+        await asyncio.sleep(0.1)
+        # and free again once its ownership expires
+        owner, taken = await first.acquire(ledger, JOB_NAME)
+        assert first.owns(owner) and taken
+
+    asyncio.run(run())
+
+
+def test_forward(instance, server, monkeypatch):
+    forwarded = []
+
+    def handler(request):
+        forwarded.append(request)
+        return httpx.Response(200, json=[[0, {'k': 0}]])
+
+    monkeypatch.setattr(
+        service, '_make_http_client',
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    other = Ownership('http://instance-b:5005')
+
+    async def run():
+        ledger = fakeredis.FakeAsyncRedis(server=server)
+        await other.acquire(ledger, JOB_NAME)
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            response = await client.post(
+                f'/serve?job_name={JOB_NAME}&batch_size=1')
+            assert response.json() == [[0, {'k': 0}]]
+            # a forwarded request is not forwarded again
+            response = await client.post(
+                f'/serve?job_name={JOB_NAME}&batch_size=1',
+                headers={service.FORWARDED_HEADER: '1'})
+            assert response.status_code == 503
+
+    asyncio.run(run())
+    assert len(forwarded) == 1
+    assert str(forwarded[0].url) == \
+        f'http://instance-b:5005/serve?job_name={JOB_NAME}&batch_size=1'
+    assert forwarded[0].headers[service.FORWARDED_HEADER] == '1'
+
+
+def test_take_over(instance, server):
+    input_fp = 'owned_input.jsonl'
+    with open(input_fp, 'w') as fh:
+        fh.write('\n'.join(json.dumps({'k': i}) for i in range(5)))
+    service.LEDGER.set(f'JOB:{JOB_NAME}', json.dumps({
+        'metadata': {'input_file_path': input_fp,
+                     'output_file_path': 'owned_output.jsonl'},
+        'reader_name': 'JsonlReader', 'writer_name': 'JsonlWriter',
+        'mode': 'read-write'}))
+    # the previous owner is gone and its ownership has expired
+    service.LEDGER.set(Ownership.key(JOB_NAME), json.dumps(
+        {'id': 'dead', 'url': 'http://instance-b:5005'}), px=1)
+
+    async def run():
+        await asyncio.sleep(0.01)
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            response = await client.post(
+                f'/serve?job_name={JOB_NAME}&batch_size=2')
+            return response.json()
+
+    try:
+        assert asyncio.run(run()) == [[0, {'k': 0}], [1, {'k': 1}]]
+        assert JOB_NAME in service.JOB_LOG
+        owner = json.loads(service.LEDGER.get(Ownership.key(JOB_NAME)))
+        assert owner['id'] == instance.id
+    finally:
+        os.remove(input_fp)
+
+
+def test_renew_errors(instance, monkeypatch):
+    calls = []
+
+    async def renew(ledger, job_names):
+        calls.append(job_names)
+        if len(calls) < 3:
+            raise [redis.TimeoutError, redis.ResponseError][len(calls) - 1]()
+        return []
+
+    monkeypatch.setattr(instance, 'renew', renew)
+    monkeypatch.setattr(instance, 'ttl', 0.03)
+
+    async def run():
+        task = asyncio.ensure_future(service._renew_ownership())
+        await asyncio.sleep(0.1)
+        # errors of the ledger are logged and the ownership is still renewed
+        assert not task.done()
+        task.cancel()
+
+    asyncio.run(run())
+    assert len(calls) >= 3
+
+
+def test_forward_stream(instance, server, monkeypatch):
+    forwarded = []
+
+    def handler(request):
+        forwarded.append(request)
+        return httpx.Response(200, content=request.content,
+                              headers={'Content-Type': service.NDJSON})
+
+    monkeypatch.setattr(
+        service, '_make_http_client',
+        lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    other = Ownership('http://instance-b:5005')
+    body = b''.join(json.dumps([i, {'k': i}]).encode('utf8') + b'\n'
+                    for i in range(100))
+
+    async def run():
+        ledger = fakeredis.FakeAsyncRedis(server=server)
+        await other.acquire(ledger, JOB_NAME)
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            return await client.post(
+                f'/receive-stream?job_name={JOB_NAME}', content=body,
+                headers={'Content-Type': service.NDJSON})
+
+    response = asyncio.run(run())
+    assert response.content == body
+    # the body is sent on as it arrives instead of read in full first
+    assert 'content-length' not in forwarded[0].headers
+    assert forwarded[0].headers['transfer-encoding'] == 'chunked'
+
+
+def test_purge(instance, server):
+    other = Ownership('http://instance-b:5005')
+
+    async def run():
+        ledger = fakeredis.FakeAsyncRedis(server=server)
+        for job_name in ('mine', 'theirs', 'unowned'):
+            await ledger.set(f'JOB:{job_name}', '{}')
+            await ledger.set(f'{job_name}:status', 'x')
+        await instance.acquire(ledger, 'mine')
+        await other.acquire(ledger, 'theirs')
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.get('/purge')
+        return sorted(await ledger.keys())
+
+    # only the job of the other instance is left
+    assert asyncio.run(run()) == [b'JOB:theirs', b'OWNER:theirs',
+                                  b'theirs:status']
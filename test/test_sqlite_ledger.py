@@ -0,0 +1,151 @@
+import asyncio
+import weakref
+
+import httpx
+import pytest
+
+import app as service
+
+from planchet.core import Job, COMPLETE
+from planchet.io import CsvReader, CsvWriter
+from planchet.ledger import AsyncLedger, SERVED, RECEIVED, ERROR
+from planchet.sqlite_ledger import SqliteItemLedger, SqliteLedger, PAGE_ITEMS
+from .const import CSV_SIZE
+
+
+@pytest.fixture()
+def sqlite_ledger(tmp_path):
+    ledger = SqliteLedger(str(tmp_path / 'ledger.db'))
+    yield ledger
+    ledger.close()
+
+
+@pytest.fixture()
+def items(sqlite_ledger):
+    return sqlite_ledger.items('somejob')
+
+
+def test_records(sqlite_ledger):
+    sqlite_ledger.set('JOB:a', '{"k": 1}')
+    sqlite_ledger.set('JOB:b', b'x')
+    sqlite_ledger.set('TOKEN:a', 'secret')
+    assert sqlite_ledger.get('JOB:a') == b'{"k": 1}'
+    assert sqlite_ledger.get('JOB:c') is None
+    assert sorted(sqlite_ledger.scan_iter('JOB:*')) == [b'JOB:a', b'JOB:b']
+    assert sqlite_ledger.delete('JOB:a', 'JOB:c') == 1
+    assert sqlite_ledger.ping()
+
+    async def run():
+        async_ledger = AsyncLedger(sqlite_ledger)
+        await async_ledger.set('JOB:d', 'y')
+        keys = [k async for k in async_ledger.scan_iter('JOB:*')]
+        await async_ledger.flushdb()
+        return keys, await async_ledger.get('JOB:d')
+
+    keys, value = asyncio.run(run())
+    assert sorted(keys) == [b'JOB:b', b'JOB:d']
+    assert value is None
+
+
+def test_get_set(items, sqlite_ledger):
+    ids = [0, 1, 5, 1000, PAGE_ITEMS + 1, 3 * PAGE_ITEMS + 7]
+    assert items.get(ids) == [None] * len(ids)
+    assert items.set(ids[:2], SERVED) == [None, None]
+    items.set(ids[2:4], RECEIVED)
+    items.set(ids[4:], ERROR)
+    assert items.get(ids) == [SERVED, SERVED, RECEIVED, RECEIVED, ERROR,
+                              ERROR]
+    assert items.set([1, 1000], None) == [SERVED, RECEIVED]
+    assert items.get([1, 1000, 1001]) == [None, None, None]
+    assert items.counts == {SERVED: 1, RECEIVED: 1, ERROR: 2}
+    assert SqliteItemLedger(sqlite_ledger, 'somejob').load_counts() == \
+        items.counts
+    assert sqlite_ledger.items('otherjob').get(ids) == [None] * len(ids)
+
+
+def test_scan(items):
+    items.set([3, 2 * PAGE_ITEMS + 1], RECEIVED)
+    items.set([8], SERVED)
+    assert list(items.scan()) == [(3, RECEIVED), (8, SERVED),
+                                  (2 * PAGE_ITEMS + 1, RECEIVED)]
+    assert items.ids(RECEIVED) == [3, 2 * PAGE_ITEMS + 1]
+    assert items.end() == 2 * PAGE_ITEMS + 4
+    # items without a record up to the end are pending
+    assert len(items.pending(4)) == items.end() - 4 - 1
+    assert items.recount() == {SERVED: 1, RECEIVED: 2, ERROR: 0}
+
+
+def test_first_incomplete(items):
+    items.set(list(range(10)), RECEIVED)
+    items.set([10], SERVED)
+    items.set([11, 12], ERROR)
+    assert items.first_incomplete(0, 20) == 10
+    assert items.first_incomplete(0, 8) == 8
+    assert items.first_incomplete(11, 13) == 13
+    assert items.first_incomplete(11, 20) == 13
+    assert items.first_incomplete(30, 40) == 30
+
+
+def test_checkpoint_and_leases(items):
+    assert items.get_checkpoint() is None
+    items.set_checkpoint(10, 200)
+    assert items.get_checkpoint() == (10, 200)
+    items.lease([1, 2, 3], 10)
+    items.lease([4], 30)
+    assert items.extend([3, 5], 20) == 1
+    assert items.reclaim(5, 15, 40) == [1, 2]
+    assert items.reclaim(5, 15, 40) == []
+    items.release([3])
+    assert items.reclaim(1, 35, 50) == [4]
+    items.delete()
+    assert items.get_checkpoint() is None
+    assert items.reclaim(5, 100, 200) == []
+
+
+def test_job(sqlite_ledger, input_fp, output_fp):
+    metadata = {'input_file_path': input_fp, 'output_file_path': output_fp}
+    job = Job('somejob', CsvReader(metadata), CsvWriter(metadata),
+              sqlite_ledger)
+    assert isinstance(job.items, SqliteItemLedger)
+    items = job.serve(10)
+    job.receive(items, False)
+    restored = Job('somejob', CsvReader(metadata), CsvWriter(metadata),
+                   sqlite_ledger)
+    assert restored.stats['received'] == 10
+    restored.receive(restored.serve(100), False)
+    assert restored.status == COMPLETE
+    assert restored.stats['received'] == CSV_SIZE
+
+
+def test_service(sqlite_ledger, jsonl_paths, monkeypatch):
+    input_fp, output_fp = jsonl_paths
+    monkeypatch.setattr(service, 'LEDGER', sqlite_ledger)
+    monkeypatch.setattr(service, '_LOOP_STATES', weakref.WeakKeyDictionary())
+    monkeypatch.setattr(service, 'JOB_LOG', {})
+    monkeypatch.setattr(service, 'OUTPUT_REGISTRY', set())
+    params = {'job_name': 'sqlite-job'}
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://planchet') as client:
+            await client.post('/scramble', params={
+                **params, 'reader_name': 'JsonlReader',
+                'writer_name': 'JsonlWriter', 'token': 'secret'},
+                json={'input_file_path': input_fp,
+                      'output_file_path': output_fp})
+            forbidden = await client.post('/serve', params=params)
+            params['token'] = 'secret'
+            items = (await client.post('/serve', params={
+                **params, 'batch_size': 100})).json()
+            await client.post('/receive', params={
+                **params, 'overwrite': False}, json=items)
+            report = (await client.get('/report', params=params)).json()
+            await client.get('/delete', params=params)
+            return forbidden, report
+
+    forbidden, report = asyncio.run(run())
+    assert forbidden.status_code == 403
+    assert report == {'served': 0, 'received': 25, 'status': COMPLETE}
+    assert sqlite_ledger.get('JOB:sqlite-job') is None
+    assert sqlite_ledger.items('sqlite-job').load_counts()[RECEIVED] == 0
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from planchet.util import Compressor, Decompressor, JsonCodec, compress
+
+
+@pytest.mark.parametrize('name', ['json', 'orjson', 'auto'])
+def test_codec(name):
+    if name != 'json':
+        pytest.importorskip('orjson')
+    codec = JsonCodec(name)
+    assert codec.name == ('json' if name == 'json' else 'orjson')
+    items = [[0, {'k': 'välue', 'n': [1, 2.5, None, True]}]]
+    assert codec.loads(codec.dumps(items)) == items
+    assert codec.loads(codec.dumpb(items)) == items
+    assert json.loads(codec.dumpb(items).decode('utf8')) == items
+    with pytest.raises(json.JSONDecodeError):
+        codec.loads(b'{"k": ')
+
+
+def test_codec_unknown():
+    with pytest.raises(ValueError):
+        JsonCodec('simplejson')
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_compression(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    parts = [b'{"k": "value"}\n' * 100] * 3
+    compressor = Compressor(encoding)
+    decompressor = Decompressor(encoding)
+    body = [compressor.compress(parts[0]), compressor.compress(parts[1]),
+            compressor.compress(parts[2], end=True)]
+    # each part is decompressed as soon as it arrives
+    assert [decompressor.decompress(part) for part in body] == parts
+    assert decompressor.decompress(b'') == b''
+    assert Decompressor(encoding).decompress(
+        compress(parts[0], encoding)) == parts[0]
+    with pytest.raises(ValueError):
+        Decompressor(encoding).decompress(b'not compressed')
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_decompression_limit(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    body = compress(b'0' * 10**7, encoding)
+    decompressor = Decompressor(encoding)
+    sizes = [len(decompressor.decompress(body, 2**16))]
+    while decompressor.pending:
+        sizes.append(len(decompressor.decompress(b'', 2**16)))
+    assert max(sizes) == 2**16
+    assert sum(sizes) == 10**7
+
+
+def test_compression_unknown():
+    with pytest.raises(ValueError):
+        Compressor('br')